@@ -0,0 +1,199 @@
+### ADMISSION.PY
+###
+### When a whole room clicks Submit at once, every one of those requests
+### wants to write to the database at the same moment, and SQLite only lets
+### one of them write at a time: the rest pile up on its lock, and the
+### unlucky ones give up with "database is locked". AdmissionMiddleware lets
+### at most ADMISSION_LIMIT submissions (POSTs to the trial and diagnostics
+### pages) into each worker process at a time. The rest wait their turn, and
+### turns go round the participants who are waiting, so somebody who clicks
+### twice waits behind everybody else rather than taking two turns. Anybody
+### still waiting after ADMISSION_TIMEOUT seconds is told the site is busy
+### (a 503, which the page can simply be submitted again after; see
+### caching.claim_submission). Everything else -- every page that's only
+### being looked at -- goes straight through.
+###
+### How the queue is doing (how many are writing and waiting, how many were
+### turned away, and how long submissions waited) is on the dashboard, and
+### at /dashboard/admission/. Each worker process has its own queue, so
+### these are for whichever worker answers. Set ADMISSION_LIMIT to 0 to let
+### everybody straight in, as before.
+
+from   django.conf import settings
+from   django.http import HttpResponse
+from   collections import deque
+import threading
+import time
+
+from   stats import percentile
+
+
+# The views that write to the database when they're posted to.
+WRITE_VIEWS = ["training", "experiment", "diagnostics"]
+
+# How many of the latest waits the wait times are worked out from.
+WAITS_KEPT = 1000
+
+
+
+#############
+### QUEUE ###
+#############
+
+""" GATE
+    Lets up to limit requests in at a time, and queues the rest, a queue per
+    participant. When a place comes free, it goes to the participant at the
+    front of the line, who then goes to the back of it if they have anything
+    else waiting.
+"""
+class Gate(object):
+
+    def __init__(self, limit):
+        self.limit     = limit
+        self.condition = threading.Condition()
+        self.writing   = 0
+        self.waiting   = {}         # participant -> deque of their tickets
+        self.line      = deque()    # participants with tickets, in turn order
+        self.depth     = 0
+        self.peak      = 0
+        self.admitted  = 0
+        self.rejected  = 0
+        self.waits     = deque(maxlen = WAITS_KEPT)
+
+    """ Waits for a place, for up to timeout seconds. Returns whether the
+        request got one; if it did, it has to leave() when it's done. """
+    def enter(self, participant, timeout):
+        start = time.time()
+        with self.condition:
+            if self.writing < self.limit and not self.line:
+                self.writing += 1
+                self.record(start)
+                return True
+
+            ticket = {"admitted": False}
+            if participant not in self.waiting:
+                self.waiting[participant] = deque()
+                self.line.append(participant)
+            self.waiting[participant].append(ticket)
+            self.depth += 1
+            self.peak   = max(self.peak, self.depth)
+
+            while not ticket["admitted"]:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self.withdraw(participant, ticket)
+                    self.rejected += 1
+                    return False
+                self.condition.wait(remaining)
+            self.record(start)
+            return True
+
+    """ Gives up a place, and hands it on to whoever's next. """
+    def leave(self):
+        with self.condition:
+            self.writing -= 1
+            while self.writing < self.limit and self.line:
+                participant = self.line.popleft()
+                tickets     = self.waiting[participant]
+                tickets.popleft()["admitted"] = True
+                if tickets:
+                    self.line.append(participant)
+                else:
+                    del self.waiting[participant]
+                self.writing += 1
+                self.depth   -= 1
+            self.condition.notify_all()
+
+    # The condition is held for both of these.
+    def withdraw(self, participant, ticket):
+        tickets = self.waiting[participant]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[participant]
+            self.line.remove(participant)
+        self.depth -= 1
+
+    def record(self, start):
+        self.admitted += 1
+        self.waits.append(time.time() - start)
+
+    """ How the queue is doing, with wait times in milliseconds. """
+    def status(self):
+        with self.condition:
+            waits = sorted(self.waits)
+            data  = {"limit":    self.limit,    "writing":     self.writing,
+                     "waiting":  self.depth,    "peak":        self.peak,
+                     "admitted": self.admitted, "turned_away": self.rejected}
+        for name, percent in [("median", 50), ("95", 95), ("99", 99)]:
+            data["wait_" + name] = round(percentile(waits, percent) * 1000, 1) if waits else 0.
+        data["wait_worst"] = round(waits[-1] * 1000, 1) if waits else 0.
+        return data
+
+
+""" This process's gate, or None if admission control is off. A new gate is
+    made if ADMISSION_LIMIT changes. """
+_gate      = None
+_gate_lock = threading.Lock()
+
+def get_gate():
+    global _gate
+    limit = getattr(settings, "ADMISSION_LIMIT", 0)
+    if not limit:
+        return None
+    if _gate is None or _gate.limit != limit:
+        with _gate_lock:
+            if _gate is None or _gate.limit != limit:
+                _gate = Gate(limit)
+    return _gate
+
+
+""" How this process's queue is doing (see Gate.status), or None if
+    admission control is off. """
+def status():
+    gate = get_gate()
+    return gate.status() if gate is not None else None
+
+
+
+##################
+### MIDDLEWARE ###
+##################
+
+""" Queues submissions to the write views. It goes after
+    AuthenticationMiddleware in MIDDLEWARE_CLASSES, since participants are
+    queued by who they are. """
+class AdmissionMiddleware(object):
+
+    def process_view(self, request, view, arguments, keywords):
+        if request.method != "POST" or getattr(view, "__name__", None) not in WRITE_VIEWS:
+            return None
+        gate = get_gate()
+        if gate is None:
+            return None
+
+        if request.user.is_authenticated():
+            participant = request.user.id
+        else:
+            participant = request.META.get("REMOTE_ADDR")
+        if not gate.enter(participant, getattr(settings, "ADMISSION_TIMEOUT", 15)):
+            response = HttpResponse("The experiment is busy right now. Please wait a moment "
+                                    "and submit your answer again.",
+                                    status = 503, mimetype = "text/plain")
+            response["Retry-After"] = "1"
+            return response
+        request.admission_gate = gate
+        return None
+
+    def process_exception(self, request, exception):
+        self.release(request)
+        return None
+
+    def process_response(self, request, response):
+        self.release(request)
+        return response
+
+    def release(self, request):
+        gate = getattr(request, "admission_gate", None)
+        if gate is not None:
+            request.admission_gate = None
+            gate.leave()
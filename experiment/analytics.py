@@ -0,0 +1,161 @@
+### ANALYTICS.PY
+###
+### The payment page only ever looks at one of a user's trials. Researchers
+### want to know how every user did on every trial, so this file works out a
+### handful of measures for every completed TrialAnswer and stores them in
+### the TrialAnalytics table (see models.py for what each one means). Run it
+### from 'python manage.py shell':
+###
+###     from experiment.analytics import analyze
+###     analyze()
+###
+### It can be run as often as we like. Each row remembers a fingerprint of
+### what it was computed from, so only trials that are new or have changed
+### since the last run are recomputed. To analyze an archived study instead
+### of the live database, pass the archive's database (see archive.py) as
+### using.
+
+from   django.db import transaction
+from   hashlib   import sha1
+from   math      import sqrt
+from   models    import TrialAnswer, TrialAnalytics, UserProfile
+from   payoffs   import get_payoff, cached_optimum
+
+
+""" What every trial on a design shares, under a given payoff: the
+    incomes, the growth of money overnight, the optimum and its wags.
+    incomes and interests are lists, as split from a TrialAnswer. """
+def design_metrics(incomes, interests, payoff):
+    optimum = cached_optimum(incomes, interests, payoff)
+    return {"incomes":      map(float, incomes),
+            "growth":       [float(interest) / 100. + 1 for interest in interests],
+            "optimum":      optimum,
+            "optimum_wags": sum(payoff.wags(optimum))}
+
+
+""" Works out every measure for a single completed trial. incomes, interests,
+    responses and submitted are lists, as split from a TrialAnswer; responses
+    are the validated ones, last day included, and submitted is empty for
+    trials validated before submissions were kept. design is what
+    design_metrics gives for the trial's design, if it's already been worked
+    out for another trial. """
+def trial_metrics(incomes, interests, responses, submitted, payoff, design = None):
+    design       = design or design_metrics(incomes, interests, payoff)
+    optimum      = design["optimum"]
+    responses    = map(float, responses)
+    wags         = sum(payoff.wags(responses))
+    optimum_wags = design["optimum_wags"]
+    errors       = [response - food for response, food in zip(responses, optimum)]
+
+    # Follow the money through the week to see how much the user borrowed.
+    # A user is borrowing whenever they carry a negative amount overnight.
+    carry_over, carries = 0., []
+    for income, growth, response in zip(design["incomes"], design["growth"], responses):
+        carry_over = (carry_over + income - response) * growth
+        carries.append(carry_over)
+    debts = [-carry for carry in carries if carry < -0.005]
+
+    # And see what validation did to what the user asked for.
+    clipped_days = clipped_amount = None
+    if submitted:
+        cuts           = [float(asked) - given for asked, given in zip(submitted, responses)]
+        cuts           = [cut for cut in cuts if cut > 0.005]
+        clipped_days   = len(cuts)
+        clipped_amount = round(sum(cuts), 2)
+
+    return {"wags":          wags,          "optimum_wags":   optimum_wags,
+            "shortfall":     optimum_wags - wags,
+            "path_error":    sqrt(sum(error**2 for error in errors) / len(errors)),
+            "max_debt":      max(debts) if debts else 0.,
+            "days_borrowed": len(debts),
+            "clipped_days":  clipped_days,  "clipped_amount": clipped_amount}
+
+
+""" A hash of everything a row of TrialAnalytics depends on. If any of it
+    changes -- the responses, the design, or the payoff (including k) -- the
+    row gets recomputed. """
+def fingerprint(incomes, interests, responses, submitted, payoff):
+    text = "|".join([incomes, interests, responses, submitted, repr(payoff.key())])
+    return sha1(text).hexdigest()
+
+
+# What's read of each trial.
+COLUMNS = ["id", "user", "question", "design__incomes", "design__interests",
+           "responses", "submitted"]
+
+""" Brings TrialAnalytics up to date. The trials are read a column at a time
+    (no model instances), batch_size trials at once, and each batch is
+    written back in a single transaction: rows for changed trials are
+    deleted and everything new is bulk inserted. Trials that aren't finished
+    yet (fewer responses than days) are skipped. Returns how many rows were
+    created, updated, left alone and skipped.
+"""
+def analyze(batch_size = 500, using = "default"):
+    payoffs = dict((user, get_payoff(name)) for user, name in
+                   UserProfile.objects.using(using).values_list("user", "payoff"))
+    known   = dict(TrialAnalytics.objects.using(using).values_list("trial", "fingerprint"))
+    counts  = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    write   = transaction.commit_on_success(using = using)(analyze_batch)
+
+    columns = TrialAnswer.objects.using(using).exclude(responses = "").order_by("id") \
+                         .values_list(*COLUMNS)
+    batch   = []
+    for row in columns.iterator():
+        batch.append(row)
+        if len(batch) == batch_size:
+            write(batch, payoffs, known, counts, using)
+            batch = []
+    if batch:
+        write(batch, payoffs, known, counts, using)
+    return counts
+
+
+""" The same, for just a few trials (say, one that a user has just finished).
+    Returns the counts, as analyze does. """
+def analyze_trials(trial_ids):
+    batch   = list(TrialAnswer.objects.filter(id__in = trial_ids).values_list(*COLUMNS))
+    users   = set(row[1] for row in batch)
+    payoffs = dict((user, get_payoff(name)) for user, name in
+                   UserProfile.objects.filter(user__in = users).values_list("user", "payoff"))
+    known   = dict(TrialAnalytics.objects.filter(trial__in = trial_ids)
+                                         .values_list("trial", "fingerprint"))
+    counts  = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    transaction.commit_on_success()(analyze_batch)(batch, payoffs, known, counts)
+    return counts
+
+
+""" Works out and writes one batch. Trials in a batch mostly share a
+    handful of designs, so what depends only on the design and the payoff
+    (see design_metrics) is worked out once per batch rather than once per
+    trial. """
+def analyze_batch(batch, payoffs, known, counts, using = "default"):
+    rows, changed, designs = [], [], {}
+    for trial, user, question, incomes, interests, responses, submitted in batch:
+        incomes_list, responses_list = incomes.split(","), responses.split(",")
+        if len(responses_list) != len(incomes_list):
+            counts["skipped"] += 1
+            continue
+
+        payoff = payoffs.get(user) or get_payoff()
+        digest = fingerprint(incomes, interests, responses, submitted, payoff)
+        if known.get(trial) == digest:
+            counts["unchanged"] += 1
+            continue
+
+        if trial in known:
+            changed.append(trial)
+            counts["updated"] += 1
+        else:
+            counts["created"] += 1
+
+        key = (incomes, interests, payoff.key())
+        if key not in designs:
+            designs[key] = design_metrics(incomes_list, interests.split(","), payoff)
+        metrics = trial_metrics(incomes_list, interests.split(","), responses_list,
+                                submitted.split(",") if submitted else [], payoff, designs[key])
+        rows.append(TrialAnalytics(trial_id = trial, user_id = user, question = question,
+                                   payoff = payoff.name, fingerprint = digest, **metrics))
+
+    if changed:
+        TrialAnalytics.objects.using(using).filter(trial__in = changed).delete()
+    TrialAnalytics.objects.db_manager(using).bulk_create(rows)
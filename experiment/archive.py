@@ -0,0 +1,149 @@
+### ARCHIVE.PY
+###
+### Every participant leaves a User, a UserProfile, a TrialAnswer for each of
+### their trials and so on behind, and nothing ever takes them out again, so
+### the live database ends up holding every study we've ever run. Once a
+### study is over and everybody has been paid, move them out into an archive
+### of their own -- a separate SQLite file per study, with the same tables --
+### and shrink the live database back down. Run it from
+### 'python manage.py shell':
+###
+###     from experiment.archive import archive, open_archive
+###     archive("spring_2026")
+###
+### With shards (see sharding.py), every shard is archived at the same time,
+### each into an archive of its own named after the study and the shard
+### ("spring_2026_room2"), so that their ids can't collide.
+###
+### The archive can be read with the same tools as the live database; just
+### tell them which database to use:
+###
+###     from experiment.analytics import analyze
+###     from experiment.rescore   import rescore, load_recorded
+###     analyze(using = open_archive("spring_2026"))
+###     rescore([0.4, 0.5], [0.01], records = load_recorded(using = open_archive("spring_2026")))
+
+from   django.conf                import settings
+from   django.contrib.auth.models import User
+from   django.core.management     import call_command
+from   django.db                  import connections, transaction
+import os
+import re
+
+from   models   import UserProfile, TrialAnswer, DiagnosticAnswer, Progress, TrialAnalytics
+from   models   import TrialDesign
+from   helpers  import count_stage
+from   sharding import databases, delete_users, fan_out
+
+
+# Everything that belongs to a participant, in the order it's copied.
+MODELS = [User, UserProfile, TrialAnswer, DiagnosticAnswer, Progress, TrialAnalytics]
+
+
+""" The database alias for a study's archive, which lives in ARCHIVE_DIR.
+    The archive is created (tables and all) if it doesn't exist yet. """
+def open_archive(study):
+    if not re.match(r"^\w+$", study):
+        raise ValueError("Study names may only have letters, digits and underscores: %r" % study)
+
+    alias = "archive_" + study
+    if alias not in connections.databases:
+        if not os.path.isdir(settings.ARCHIVE_DIR):
+            os.makedirs(settings.ARCHIVE_DIR)
+        path = os.path.join(settings.ARCHIVE_DIR, study + ".db")
+        connections.databases[alias] = {"ENGINE": "django.db.backends.sqlite3", "NAME": path,
+                                        "USER": "", "PASSWORD": "", "HOST": "", "PORT": ""}
+        call_command("syncdb", database = alias, interactive = False, verbosity = 0)
+    return alias
+
+
+""" The archive that a database's participants go into. """
+def archive_name(study, using = "default"):
+    if using == "default":
+        return study
+    return "%s_%s" % (study, using[len("shard_"):])
+
+
+""" The users who are done with everything: the experiment, and the
+    diagnostics if they're dynamic (the "finished" stage; see
+    helpers.calculate_stage). What they're paid doesn't come into it --
+    somebody who finished with nothing to show for it is done all the same. """
+def finished_users(using = "default"):
+    finished = UserProfile.objects.using(using).filter(finished_experiment = True)
+    finished = finished.exclude(user_class = "dynamic", finished_diagnostics = False)
+    return list(finished.order_by("user").values_list("user", flat = True))
+
+
+""" Moves every finished participant into the study's archive, batch_size users
+    at a time, then vacuums the live database. Each batch is copied and
+    committed to the archive before it's deleted from the live database, so
+    if anything goes wrong part way, just run it again. Returns how many
+    users were moved. """
+def archive(study, batch_size = 200):
+    for using in databases():
+        open_archive(archive_name(study, using))
+    return sum(fan_out(archive_database, study, batch_size).values())
+
+
+""" The same, for one database's participants. """
+def archive_database(study, batch_size = 200, using = "default"):
+    alias = open_archive(archive_name(study, using))
+    users = finished_users(using)
+    for start in range(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+        copy_users(batch, alias, using)
+        remove_users(batch, using)
+    vacuum(using)
+    return len(users)
+
+
+""" Everything of the given kind that belongs to the users, in a database. """
+def owned(model, users, using = "default"):
+    field = "id" if model is User else "user"
+    return model.objects.using(using).filter(**{field + "__in": users})
+
+
+""" Copies the users, and everything of theirs, into the archive. Anything
+    of theirs already there (from a run that didn't finish) is replaced. The
+    designs of their trials are copied over too, unless the archive already
+    has them; they stay in the live database, since other users share them. """
+def copy_users(users, alias, using = "default"):
+    with transaction.commit_on_success(using = alias):
+        for model in reversed(MODELS):
+            owned(model, users, alias).delete()
+
+        designs  = list(TrialDesign.objects.using(using).filter(trialanswer__user__in = users).distinct())
+        digests  = [design.digest for design in designs]
+        existing = set()
+        for start in range(0, len(digests), 500):
+            existing.update(TrialDesign.objects.using(alias)
+                                       .filter(digest__in = digests[start:start + 500])
+                                       .values_list("digest", flat = True))
+        designs  = [design for design in designs if design.digest not in existing]
+        for design in designs:
+            design.pk = None
+        TrialDesign.objects.db_manager(alias).bulk_create(designs)
+
+        # Users come from the default database; a shard only has copies.
+        for model in MODELS:
+            source = "default" if model is User else using
+            model.objects.db_manager(alias).bulk_create(list(owned(model, users, source).order_by("pk")))
+
+
+""" Deletes the users from the live database (and their shard). Everything
+    of theirs goes with them, and they come off the dashboard's count of
+    finished users. """
+def remove_users(users, using = "default"):
+    with transaction.commit_on_success(using = using):
+        delete_users(users)
+        count_stage("finished", -len(users))
+
+
+""" Gives the space freed up by the archived users back to the disk. Only
+    SQLite needs (or has) this, and it can't be done in the middle of a
+    transaction, so it's skipped if we're in one. """
+def vacuum(using = "default"):
+    connection = connections[using]
+    if connection.vendor == "sqlite" and not transaction.is_managed(using = using):
+        transaction.commit_unless_managed(using = using)
+        connection.cursor().execute("VACUUM")
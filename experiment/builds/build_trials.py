@@ -1,12 +1,19 @@
 
-# A couple of essential imports. We'll need random.uniform to be able to
-# randomly assign income values when desired, shuffle so that we can randmoize
-# the order of the life cycles, and xlrd is so that we can read the Excel
-# document where the trials are stored.
-from   random  import uniform, shuffle
+# A couple of essential imports. We'll need a random number generator to be
+# able to randomly assign income values when desired and to randomize the
+# order of the life cycles (each user gets their own, seeded, so that their
+# trials can always be rebuilt), hashlib to turn a study's seed into each
+# user's seed, and xlrd is so that we can read the Excel document where the
+# trials are stored.
+from   random  import Random
 from   ..helpers import k
+from   ..trials  import Trial
+import hashlib
 import xlrd
 
+# Where all of the pre-made trials live.
+file_name = "experiment/builds/trials.xls"
+
 """ TRIAL
     The trial class is going to represent a single round of the game. Trials
     will vary in certain aspects, including the number of days in the trial,
@@ -15,6 +22,9 @@ import xlrd
     primarily a difference in user experience, not in coding, so it will not
     matter here.
 
+    This is the same Trial the experiment runs on (see trials.py); all it
+    adds is what's needed to store a trial on a TrialAnswer.
+
     PARAMETERS
     incomes   -- A vector of integers, each representing how many bucks the
                  user will be given each day. The length of the vector will
@@ -27,86 +37,17 @@ import xlrd
                  that income is allotted in all periods, but interest does not
                  accumulate on the last day (because there is no next day).
 """
-class trial:
-
-    def __init__(self, incomes, interests):
-        self.incomes   = incomes
-        self.interests = interests
-        
-        # Whenever we print a trial, we print the days of the week too.
-        # We only want to print as many as needed though.
-        days      = ["Monday", "Tuesday",  "Wednesday", "Thursday",
-                     "Friday", "Saturday", "Sunday"]
-        self.days = days[0:len(incomes)]
-
-    def __repr__(self):
-        text = "Trial Object: (length %i)" % len(self.incomes)
-        return text
-
+class trial(Trial):
+    __slots__ = ()
 
     """ Returns a comma-separated list of the incomes. """
     def get_incomes(self):
-        values = ""
-        for income in self.incomes:
-            values += "%i," % income
-        return values[:-1]
+        return ",".join(["%i" % income for income in self.incomes])
 
 
-    """ Returns a comma-separated list of the incomes. """
+    """ Returns a comma-separated list of the interests. """
     def get_interests(self):
-        values = ""
-        for interest in self.interests:
-            values += "%i," % interest
-        return values[:-1]
-
-
-    """ We'll need to know the optimal solution to the decision problem.
-        This method finds it for us. """
-    def calculate_optimum(self):
-
-        # The optimal solution relies on the food-to-wag function. This
-        # function is of the form wags = food^k, where k is a constant.
-        # Grab k, defined in helpers
-        from ..helpers import k
-
-        # The list we'll be building
-        optimum = []
-
-        # Extend the interest vector for simplicity, and convert it
-        interests = self.interests
-        interests.append(0)
-        interests = map(lambda x: float(x) / 100 + 1, interests)
-
-        
-        # First of all, calculate the optimal spending for the first day.
-        # This will be instrumental in calculating the optimal spending
-        # for all subsequent days.
-        numerator = 0
-        for day in range(len(self.days)):
-            interest = 1
-            for later_day in range(day,len(self.days)):
-                interest *= interests[later_day]
-            numerator += float(self.incomes[day]) * interest
-        print numerator
-
-        denominator = 0
-        for day in range(len(self.days)):
-            interest = 1
-            for later_day in range(day, len(self.days)):
-                interest *= interests[later_day]
-            denominator += pow(interest, 1. / (1 - k))
-        optimum.append(round(numerator / denominator, 2))
-
-
-        # Now calculate the optimum value for every subsequent day
-        for day in range(1, len(self.days)):
-            interest = 1
-            for earlier_day in range(day):
-                interest *= interests[earlier_day]
-            optimum.append(round(pow(interest, 1 / (1 - k)) * optimum[0], 2))
-
-        # Done. Return the optimum.
-        return optimum
+        return ",".join(["%i" % interest for interest in self.interests])
 
 
 """ Every user has a list of trials to complete during the experiment. The
@@ -127,49 +68,133 @@ class trial:
     classes. Static users have many more trials to answer, and so there are
     more trials to build. All of the trials are pre-made, and can be found in
     the Excel document 'trials.xls'.
+
+    All of the randomness (the order of the life cycles, the order of the
+    trials within them and the RAND incomes) comes from a single random number
+    generator. Give the same seed and you get exactly the same trials back.
+    Leave the seed out and you get a fresh set every time, as before. We can
+    also hand in a generator directly if we want to keep drawing from it.
 """
-def build_trials(user_class):
+def build_trials(user_class, seed = None, rng = None):
 
-    # Grab the trial data.
-    file_name = "experiment/builds/trials.xls"
-    data      = xlrd.open_workbook(file_name)
+    # Grab the trial data. This is read from the Excel document only once.
+    templates = load_templates()
+    rng       = rng or Random(seed)
 
-    # Construct the dictionary that will hold all of the trials. This
-    # has only two entries: the training trials and the experimental trials.
+    # Construct the list that will hold all of the trials.
     trials = []
 
 
-    # First thing's first: Build the training trials. Grab the number of
-    # training questions and build them all.
-    training_data       = data.sheet_by_name("training")
-    base                = {"row": 2, "col": 1}
-    num_training_trials = int(training_data.cell(base["row"] + 1,
-                                                 base["col"] - 1).value)
-    for index in range(num_training_trials):
-        row_incomes   = base["row"] + 2*index
-        row_interests = base["row"] + 2*index + 1
-
-        # Scroll through the row and grab the income and interest values
-        income_values   = cleanse(training_data.row_values(row_incomes)[base["col"]:])
-        interest_values = cleanse(training_data.row_values(row_interests)[base["col"]:])
-        trials.append(trial(income_values, interest_values))
+    # First thing's first: Build the training trials.
+    for incomes, interests in templates["training"]:
+        trials.append(trial(cleanse(list(incomes), rng), cleanse(list(interests), rng)))
 
 
     # Now, depending on whether the user is static or dynamic, we have two
     # branches to take. If the user is static, we pull the trials from the
     # 'static' sheet of the Excel file; otherwise we pull from the 'dynamic'
     # sheet. In either case we want to randomize the order of the life cycles.
-    data        = data.sheet_by_name(user_class)
+    cycles      = templates[user_class]
     cycle_order = range(1,4)
-    shuffle(cycle_order)
+    rng.shuffle(cycle_order)
     for life_cycle in cycle_order:
-        trials.extend(build_life_cycle(data, life_cycle))
+        trials.extend(build_life_cycle(cycles[life_cycle], rng))
 
     # Done. Return the trials
     return trials
 
 
 
+""" A user's schedule is their trials plus the trial we'll pay them for,
+    which is picked at random from the experimental (non-training) trials.
+    Both come from the same seed, so the seed is all we need to store to
+    rebuild everything about a user's schedule.
+"""
+def build_schedule(user_class, seed):
+    rng           = Random(seed)
+    trials        = build_trials(user_class, rng = rng)
+    payment_trial = rng.choice(range(2, len(trials)))
+    return trials, payment_trial
+
+
+""" The batch version of build_schedule, for building lots of users at once
+    (or for checking lots of seeds). The Excel document is only read once no
+    matter how many schedules we ask for.
+"""
+def generate_schedules(user_class, seeds):
+    return [build_schedule(user_class, seed) for seed in seeds]
+
+
+""" Every user gets their own seed. If the study has a seed, each user's seed
+    is derived from it and their username, so that the whole study can be
+    rebuilt from one number. Otherwise we just draw a fresh one. Seeds are
+    kept under 2^60 so that they fit comfortably in the database.
+"""
+def participant_seed(username, study_seed = None):
+    if study_seed is None:
+        return Random().getrandbits(60)
+    digest = hashlib.sha1("%s:%s" % (study_seed, username)).hexdigest()
+    return int(digest[:15], 16)
+
+
+
+""" Sometimes we want every trial in the Excel document at once, rather than
+    one user's worth of them -- for instance, to solve the optimum of every
+    design ahead of time. Every sheet lists its trials as pairs of rows
+    (incomes, then interests) starting from the third row, so we just walk
+    down each sheet. Designs with RAND incomes are skipped, since they aren't
+    known until a user is built. Each design appears only once.
+"""
+def build_catalog():
+    data    = xlrd.open_workbook(file_name)
+    designs = []
+    for sheet in data.sheets():
+        for row in range(2, sheet.nrows - 1, 2):
+            incomes   = sheet.row_values(row)[1:]
+            interests = sheet.row_values(row + 1)[1:]
+            if "RAND" in incomes:
+                continue
+            design = (cleanse(incomes), cleanse(interests))
+            if design not in designs:
+                designs.append(design)
+    return designs
+
+
+
+""" Reading the Excel document is by far the slowest part of building a
+    user's trials, and the document never changes while we're running. So we
+    read it once and keep the raw rows (still with their 'RAND's and '-'s)
+    around as templates:
+
+    {"training": [(incomes, interests), ...],
+     "static":   {1: [(incomes, interests), ...], 2: [...], 3: [...]},
+     "dynamic":  {1: [...], 2: [...], 3: [...]}}
+"""
+_templates = None
+
+def load_templates():
+    global _templates
+    if _templates is None:
+        data      = xlrd.open_workbook(file_name)
+        templates = {}
+
+        # The training trials. The number of them sits just below the label.
+        training_data       = data.sheet_by_name("training")
+        base                = {"row": 2, "col": 1}
+        num_training_trials = int(training_data.cell(base["row"] + 1,
+                                                     base["col"] - 1).value)
+        templates["training"] = read_trials(training_data, base, num_training_trials)
+
+        # And the life cycles of each class.
+        for user_class in ["static", "dynamic"]:
+            sheet                 = data.sheet_by_name(user_class)
+            templates[user_class] = dict((cycle, read_life_cycle(sheet, cycle))
+                                         for cycle in range(1,4))
+        _templates = templates
+    return _templates
+
+
+
 """ Every life cycle is formatted the exact same way within the Excel document.
     This method takes advantage of that uniformity to simplify translating
     the trial data. The start of every life cycle is indicated by a label in
@@ -178,7 +203,7 @@ def build_trials(user_class):
     trials in the life cycle. Together, that's all the information we'll need
     to build the cycle.
 """
-def build_life_cycle(data, cycle):
+def read_life_cycle(data, cycle):
 
     # First task: Find the base address of the current life cycle.
     label    = "LIFE CYCLE %i" % cycle
@@ -189,23 +214,37 @@ def build_life_cycle(data, cycle):
         else:
             base["row"] += 1
 
-    # Found the base address. Grab the number of trials.
+    # Found the base address. Grab the number of trials, and the trials.
     num_trials = int(data.cell(base["row"] + 1, 0).value)
+    return read_trials(data, base, num_trials)
 
-    # Time to build the trials.
-    trials = []
+
+""" Grabs the raw rows for num_trials trials, starting at base. Each trial is
+    two rows: the incomes, then the interests.
+"""
+def read_trials(data, base, num_trials):
+    rows = []
     for index in range(num_trials):
         row_incomes   = base["row"] + 2*index
         row_interests = base["row"] + 2*index + 1
+        rows.append((tuple(data.row_values(row_incomes)[base["col"]:]),
+                     tuple(data.row_values(row_interests)[base["col"]:])))
+    return rows
+
 
-        # Scroll through the row and grab the income and interest values
-        income_values   = cleanse(data.row_values(row_incomes)[base["col"]:])
-        interest_values = cleanse(data.row_values(row_interests)[base["col"]:])
-        trials.append(trial(income_values, interest_values))
+""" Builds the trials of a single life cycle from its template, then shuffles
+    them to randomize the order.
+"""
+def build_life_cycle(rows, rng):
+
+    # Time to build the trials.
+    trials = []
+    for incomes, interests in rows:
+        trials.append(trial(cleanse(list(incomes), rng), cleanse(list(interests), rng)))
 
     # Got em all. Shuffle them to randomize the order, and then return the
     # life cycle.
-    shuffle(trials)
+    rng.shuffle(trials)
     return  trials
 
 
@@ -221,9 +260,9 @@ def build_life_cycle(data, cycle):
     Secondly, some of the values in Excel will be strings, either '-' or 'RAND'.
     In the former case, we interpret this to mean there is no value for the
     given day, and the trial is over. In the latter case, we are looking to
-    generate a random number.
+    generate a random number, which we draw from rng (or a fresh generator).
 """
-def cleanse(values):
+def cleanse(values, rng = None):
     for index in range(len(values)):
         value = values[index]
 
@@ -241,5 +280,6 @@ def cleanse(values):
                 values = values[:index]
                 break
             else:
-                values[index] = int(uniform(20,200))
+                rng           = rng or Random()
+                values[index] = int(rng.uniform(20,200))
     return values
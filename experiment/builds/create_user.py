@@ -21,7 +21,9 @@ from random import shuffle, uniform, choice
 
 # Import our own UserProfile model
 from ..models     import UserProfile, TrialAnswer
-from build_trials import build_trials
+from ..helpers    import record_progress, count_stage, calculate_stage
+from ..sharding   import open_shard, place_users, delete_users, use_database, database_for
+from build_trials import build_schedule, participant_seed
 
 
 """ Method to create a new user profile. sender is the User model, instance
@@ -36,12 +38,10 @@ from build_trials import build_trials
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
 
-        # We want to randomly pick a trial for the user's payment.
-        max_trial     = 17 if user_class == "static" else 5
-        payment_trial = choice(range(2, max_trial))
-        
+        # We don't know the user's class yet, so we can't pick their payment
+        # trial here; add_user picks it along with the rest of their schedule.
         # Create the actual UserProfile object.
-        UserProfile.objects.create(user = instance, payment_trial = payment_trial)
+        UserProfile.objects.create(user = instance, payment_trial = 0)
 
 # I think this call is to indicate that the User model should also call
 # create_user_profile after a save. 
@@ -49,8 +49,27 @@ post_save.connect(create_user_profile, sender=User)
 
 
 # Here's the method that actually creates the user. First we will create a
-# User object, then we create a profile.
-def add_user(new_username, new_password, user_class = None):
+# User object, then we create a profile. Everything random about the user's
+# trials comes from their seed, which is stored on their profile. Pass a
+# seed to pick it, or a study_seed to derive it from the study and username.
+# Pass a shard to place the user in that shard (see sharding.py).
+def add_user(new_username, new_password, user_class = None, payoff = "power",
+             seed = None, study_seed = None, shard = None):
+    with use_database(open_shard(shard) if shard else "default"):
+        return create_user(new_username, new_password, user_class, payoff,
+                           seed, study_seed, shard)
+
+
+""" Takes users that are about to be deleted out of the stage counts, in
+    whichever database each of them is in. """
+def uncount_users(users):
+    for user in users:
+        with use_database(database_for(user.id)):
+            for profile in UserProfile.objects.filter(user = user.id):
+                count_stage(calculate_stage(profile), -1)
+
+
+def create_user(new_username, new_password, user_class, payoff, seed, study_seed, shard):
 
     # Boolean to represent whether we will actually add a new user or
     # not. This may be set to false if the username already exists and
@@ -68,9 +87,11 @@ def add_user(new_username, new_password, user_class = None):
         while overwrite != "yes" and overwrite != "no":
             overwrite = raw_input("Please enter yes or no.  ")
 
-        # If they want to overwrite, then delete the old entry.
+        # If they want to overwrite, then delete the old entry, and take
+        # them out of the dashboard's counts.
         if overwrite == "yes":
-            already_exists.delete()
+            uncount_users(already_exists)
+            delete_users([user.id for user in already_exists])
 
         # Otherwise, set create to False so we don't attempt to make a
         # new identical user.
@@ -82,6 +103,8 @@ def add_user(new_username, new_password, user_class = None):
         new_user = User.objects.create_user(username = new_username,
                                             email    = "fake@fake.com",
                                             password = new_password)
+        if shard:
+            place_users([new_user], shard)
 
         # Set the user's class. If this hasn't been specified already,
         # or if it is set to something other than 'static' or 'dynamic'
@@ -93,13 +116,21 @@ def add_user(new_username, new_password, user_class = None):
         while user_class not in classes:
             user_class = raw_input("The user's class must be either 'static' or 'dynamic'. You entered %s. Please choose one of the two: " % user_class)
 
-        # Got an acceptable user class.
-        profile            = new_user.get_profile()
-        profile.user_class = user_class
+        # Got an acceptable user class. Build the user's schedule from
+        # their seed.
+        if seed is None:
+            seed = participant_seed(new_username, study_seed)
+        user_trials, payment_trial = build_schedule(user_class, seed)
+
+        profile               = UserProfile.objects.get(user = new_user)
+        profile.user_class    = user_class
+        profile.payoff        = payoff
+        profile.seed          = seed
+        profile.payment_trial = payment_trial
         profile.save()
+        record_progress(new_user, profile, None)
             
         # Time to build the trial objects to be populated by this user.
-        user_trials = build_trials(user_class)
         index = 0
         for trial in user_trials:
             TrialAnswer.objects.create(user      = new_user,
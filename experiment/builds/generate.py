@@ -0,0 +1,186 @@
+### GENERATE.PY
+###
+### Fills the database with synthetic participants, so that we can load test
+### and benchmark against a database the size of a real study (or of ten).
+### Participants are built exactly the way add_user builds them -- same
+### schedules, from the same seeds -- and are then played part or all of the
+### way through the experiment by the simulator's agents (see simulate.py),
+### with their trials validated and their payments worked out just as the
+### site would. Run it from 'python manage.py shell':
+###
+###     from experiment.builds.generate import generate
+###     generate(100000, arms   = {("static", "power"): 1, ("dynamic", "power"): 1},
+###                      stages = {"training": 1, "experiment": 3, "finished": 6})
+###
+### Everything is written with bulk inserts, batch_size users at a time, so
+### unlike add_user this never asks anything and never saves a row at a time.
+### Pair it with restart_database.snapshot and restore to start every run
+### from the same data.
+
+from   django.contrib.auth.hashers import make_password
+from   django.contrib.auth.models  import User
+from   django.db                   import transaction
+from   random                      import Random
+
+from   ..models   import UserProfile, TrialAnswer, TrialDesign, DiagnosticAnswer, Progress
+from   ..models   import design_digest
+from   ..helpers  import calculate_stage, calculate_payment, count_stage, STAGES
+from   ..payoffs  import get_payoff, cached_optimum
+from   ..simulate import AGENTS, cumulate, pick
+from   ..sharding import open_shard, place_users, use_database
+from   build_trials import build_schedule, participant_seed
+
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+""" Generates participants and stores them.
+
+    users      -- How many participants to make.
+    arms       -- {(user_class, payoff): weight}. By default half static and
+                  half dynamic, both with the usual payoff.
+    stages     -- {stage: weight}, stages from helpers.STAGES: how far along
+                  each participant is. Static participants have no
+                  diagnostics, so any drawn for "diagnostics" are finished.
+                  By default everybody is finished.
+    agents     -- {agent name: weight}, names from simulate.AGENTS. By
+                  default an even mix of all of them.
+    seed       -- The study's seed. Each participant's seed is derived from
+                  it and their username, as add_user does with a study_seed.
+    prefix     -- Usernames are the prefix followed by a number, from 0. They
+                  mustn't be taken already.
+    password   -- Everybody's password.
+    shard      -- The shard to place them in (see sharding.py), if any.
+
+    Returns how many participants ended up in each stage.
+"""
+def generate(users, arms = None, stages = None, agents = None, seed = 0,
+             prefix = "synthetic", password = "password", batch_size = 500, shard = None):
+    arms   = arms   or {("static", "power"): 1, ("dynamic", "power"): 1}
+    stages = stages or {"finished": 1}
+    agents = agents or dict((name, 1) for name in AGENTS)
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage: %s" % stage)
+
+    rng      = Random(seed)
+    choices  = (cumulate(arms), cumulate(stages), cumulate(agents))
+    hashed   = make_password(password)
+    counts   = dict((stage, 0) for stage in STAGES)
+
+    # A shard's batches are committed to the shard as well as to the
+    # default database (which has the Users).
+    alias    = open_shard(shard) if shard else "default"
+    write    = generate_batch if alias == "default" else \
+               transaction.commit_on_success(using = alias)(generate_batch)
+    with use_database(alias):
+        for start in range(0, users, batch_size):
+            names = ["%s%i" % (prefix, index) for index in range(start, min(start + batch_size, users))]
+            for stage, count in write(names, hashed, seed, rng, choices, shard).items():
+                counts[stage] += count
+
+        for stage, count in counts.items():
+            if count:
+                count_stage(stage, count)
+    return counts
+
+
+""" Builds and stores one batch of participants. Returns how many ended up
+    in each stage. """
+@transaction.commit_on_success
+def generate_batch(names, hashed, study_seed, rng, choices, shard = None):
+    (arm_keys, arm_totals), (stage_keys, stage_totals), (agent_keys, agent_totals) = choices
+
+    User.objects.bulk_create([User(username = name, email = "fake@fake.com", password = hashed)
+                              for name in names])
+    users = list(User.objects.filter(username__in = names))
+    ids   = dict((user.username, user.id) for user in users)
+    if shard:
+        place_users(users, shard)
+
+    profiles, answers, progress, diagnostics, designs = [], [], [], [], {}
+    counts = {}
+    for name in names:
+        user_class, payoff = pick(rng, arm_keys, arm_totals)
+        stage  = pick(rng, stage_keys, stage_totals)
+        agent  = AGENTS[pick(rng, agent_keys, agent_totals)]
+        if user_class == "static" and stage == "diagnostics":
+            stage = "finished"
+
+        seed = participant_seed(name, study_seed)
+        trials, payment_trial = build_schedule(user_class, seed)
+        profile = UserProfile(user_id = ids[name], user_class = user_class, payoff = payoff,
+                              seed = seed, payment_trial = payment_trial)
+
+        # How far along they are. Dynamic users can be part way through a
+        # trial, in which case day is how many days of it they've done.
+        if stage == "training":
+            done = rng.randint(0, 1)
+        elif stage == "experiment":
+            done = rng.randint(2, len(trials) - 1)
+        else:
+            done = len(trials)
+        day = rng.randrange(len(trials[done].incomes) - 1) \
+              if done < len(trials) and user_class == "dynamic" else 0
+
+        for question, problem in enumerate(trials):
+            answer = TrialAnswer(user_id   = ids[name],            question  = question,
+                                 incomes   = problem.get_incomes(), interests = problem.get_interests())
+            if question < done or (question == done and day):
+                optimum   = cached_optimum(problem.incomes, problem.interests, payoff)
+                responses = map(str, agent(problem.incomes, problem.interests, optimum, rng))
+                if question < done:
+                    answer.add_response(None, responses, commit = False, static = True)
+                    answer.validate(commit = False)
+                else:
+                    answer.add_response(None, responses[:day], commit = False, static = True)
+
+            digest            = design_digest(answer.incomes, answer.interests)
+            designs[digest]   = (answer.incomes, answer.interests)
+            answer.design_id  = digest
+            answers.append(answer)
+
+            if question == payment_trial and done == len(trials):
+                payoff_object   = get_payoff(payoff)
+                optimum         = cached_optimum(problem.incomes, problem.interests, payoff)
+                profile.payment = calculate_payment(sum(payoff_object.wags(answer.responses.split(","))),
+                                                    sum(payoff_object.wags(optimum)))
+
+        profile.trials_done          = done
+        profile.day                  = DAYS[day]
+        profile.finished_training    = done >= 2
+        profile.finished_experiment  = done == len(trials)
+        profile.finished_diagnostics = user_class == "dynamic" and stage == "finished"
+        profiles.append(profile)
+
+        if profile.finished_diagnostics:
+            diagnostics.append(DiagnosticAnswer(user_id    = ids[name],
+                                                question_1 = "%.2f" % rng.uniform(0, 100),
+                                                question_2 = "%.2f" % rng.uniform(0, 100),
+                                                question_3 = "%.2f" % rng.uniform(0, 100),
+                                                question_4 = "%.2f" % rng.uniform(0, 100)))
+
+        stage = calculate_stage(profile)
+        progress.append(Progress(user_id = ids[name], username = name, stage = stage,
+                                 trial   = done,      day      = profile.day))
+        counts[stage] = counts.get(stage, 0) + 1
+
+    store_designs(designs)
+    UserProfile.objects.bulk_create(profiles)
+    TrialAnswer.objects.bulk_create(answers)
+    DiagnosticAnswer.objects.bulk_create(diagnostics)
+    Progress.objects.bulk_create(progress)
+    return counts
+
+
+""" Stores the designs ({digest: (incomes, interests)}) that aren't stored
+    yet, with one bulk insert. """
+def store_designs(designs):
+    digests  = designs.keys()
+    existing = set()
+    for start in range(0, len(digests), 500):
+        existing.update(TrialDesign.objects.filter(digest__in = digests[start:start + 500])
+                                           .values_list("digest", flat = True))
+    TrialDesign.objects.bulk_create([TrialDesign(digest = digest, incomes = incomes, interests = interests)
+                                     for digest, (incomes, interests) in designs.items()
+                                     if digest not in existing])
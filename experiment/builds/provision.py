@@ -0,0 +1,181 @@
+### PROVISION.PY
+###
+### Sets up a whole study's participants at once. add_user makes them one at
+### a time, on one core: hashing every password (slow on purpose), building
+### every schedule and saving every trial row by row, which for thousands of
+### participants takes the better part of an hour. Here the slow part --
+### making up each participant's password, hashing it and building their
+### schedule -- is spread over a pool of processes (one per core unless told
+### otherwise), and this process alone writes what they send back, with bulk
+### inserts, in a single transaction: either everybody is set up or nobody
+### is. Run it from 'python manage.py shell':
+###
+###     from experiment.builds.provision import provision, write_accounts
+###     accounts = provision(10000, prefix = "s4_", study_seed = 4,
+###                          arms = {("static", "power"): 1, ("dynamic", "power"): 1})
+###     write_accounts(accounts, "s4_accounts.csv")
+###
+### Everybody gets a password of their own, unless they're given one to
+### share. Participants who will only ever log in with a login link (see
+### links.py) don't need one at all -- pass links_only = True, and no
+### passwords are made or hashed.
+
+from   django.contrib.auth.hashers import make_password, UNUSABLE_PASSWORD
+from   django.contrib.auth.models  import User
+from   django.db                   import transaction
+from   itertools                   import imap
+from   multiprocessing             import Pool, cpu_count
+from   random                      import Random, SystemRandom
+import csv
+
+from   ..models   import UserProfile, TrialAnswer, Progress, design_digest
+from   ..helpers  import count_stage
+from   ..simulate import cumulate, pick
+from   ..sharding import open_shard, place_users, use_database
+from   build_trials import build_schedule, participant_seed, load_templates
+from   generate     import store_designs
+
+
+# Made-up passwords leave out letters and digits that are easily mistaken
+# for each other on a printout (0 and O, 1 and l, and so on).
+PASSWORD_CHARACTERS = "abcdefghjkmnpqrstuvwxyz23456789"
+PASSWORD_LENGTH     = 8
+
+
+
+#################
+### PROVISION ###
+#################
+
+""" Sets up participants, ready to start training.
+
+    users      -- How many participants to make.
+    arms       -- {(user_class, payoff): weight}. By default half static and
+                  half dynamic, both with the usual payoff.
+    prefix     -- Usernames are the prefix followed by a number, from 0. They
+                  mustn't be taken already.
+    study_seed -- The study's seed, from which each participant's seed (and
+                  their arm) is derived, as add_user does with a study_seed.
+                  Leave it out for fresh ones.
+    password   -- A password for everybody. By default everybody gets one of
+                  their own.
+    links_only -- Make no passwords at all: participants log in with links.
+    processes  -- How many processes to build participants in. Defaults to
+                  one per core; 1 builds them all in this process.
+    shard      -- The shard to place them in (see sharding.py), if any.
+
+    Returns each participant's (username, password), in order. Passwords
+    are only ever seen here, so keep them (see write_accounts).
+"""
+def provision(users, arms = None, prefix = "participant", study_seed = None, password = None,
+              links_only = False, processes = None, shard = None, batch_size = 500):
+    arms  = arms or {("static", "power"): 1, ("dynamic", "power"): 1}
+    names = ["%s%i" % (prefix, index) for index in range(users)]
+    for start in range(0, users, 500):
+        taken = User.objects.filter(username__in = names[start:start + 500])
+        if taken.exists():
+            raise ValueError("Username %s is already taken." % taken[0].username)
+
+    rng        = Random(study_seed)
+    arm_keys, arm_totals = cumulate(arms)
+    tasks      = [(name, pick(rng, arm_keys, arm_totals), study_seed,
+                   None if links_only else password, links_only) for name in names]
+
+    # The templates are read before the pool starts, so that every process
+    # starts out with them rather than reading the Excel document itself.
+    load_templates()
+    processes = processes or cpu_count()
+    if processes == 1:
+        pool  = None
+        built = imap(build_participant, tasks)
+    else:
+        pool  = Pool(processes)
+        built = pool.imap(build_participant, tasks, chunksize = 50)
+
+    # A shard's participants are committed to the shard as well as to the
+    # default database (which has the Users).
+    alias = open_shard(shard) if shard else "default"
+    write = write_participants if alias == "default" else \
+            transaction.commit_on_success(using = alias)(write_participants)
+    try:
+        with use_database(alias):
+            accounts = write(built, shard, batch_size)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return accounts
+
+
+""" Builds one participant: their password, its hash and their schedule.
+    This is what every process in the pool runs, so it never touches the
+    database. The trials come back as the strings they're stored as. """
+def build_participant(task):
+    name, (user_class, payoff), study_seed, password, links_only = task
+    if links_only:
+        hashed = UNUSABLE_PASSWORD
+    else:
+        if password is None:
+            chooser  = SystemRandom()
+            password = "".join([chooser.choice(PASSWORD_CHARACTERS) for _ in range(PASSWORD_LENGTH)])
+        hashed = make_password(password)
+
+    seed = participant_seed(name, study_seed)
+    trials, payment_trial = build_schedule(user_class, seed)
+    return (name, password, hashed, user_class, payoff, seed, payment_trial,
+            [(problem.get_incomes(), problem.get_interests()) for problem in trials])
+
+
+""" Stores participants as they come out of the pool, batch_size at a time,
+    all in one transaction. Returns their (username, password)s. """
+@transaction.commit_on_success
+def write_participants(built, shard, batch_size):
+    accounts, batch = [], []
+    for participant in built:
+        batch.append(participant)
+        if len(batch) == batch_size:
+            accounts.extend(write_batch(batch, shard))
+            batch = []
+    if batch:
+        accounts.extend(write_batch(batch, shard))
+    if accounts:
+        count_stage("training", len(accounts))
+    return accounts
+
+
+""" Stores one batch of built participants, with a bulk insert per table.
+    (Bulk inserts don't set off create_user_profile, so the profiles are
+    made here.) """
+def write_batch(batch, shard):
+    User.objects.bulk_create([User(username = name, email = "fake@fake.com", password = hashed)
+                              for name, _, hashed, _, _, _, _, _ in batch])
+    users = list(User.objects.filter(username__in = [participant[0] for participant in batch]))
+    ids   = dict((user.username, user.id) for user in users)
+    if shard:
+        place_users(users, shard)
+
+    profiles, answers, progress, designs = [], [], [], {}
+    for name, password, hashed, user_class, payoff, seed, payment_trial, trials in batch:
+        profiles.append(UserProfile(user_id = ids[name], user_class = user_class, payoff = payoff,
+                                    seed    = seed,      payment_trial = payment_trial))
+        progress.append(Progress(user_id = ids[name], username = name, stage = "training",
+                                 trial   = 0,         day      = "Monday"))
+        for question, (incomes, interests) in enumerate(trials):
+            digest          = design_digest(incomes, interests)
+            designs[digest] = (incomes, interests)
+            answers.append(TrialAnswer(user_id = ids[name], question = question, design_id = digest))
+
+    store_designs(designs)
+    UserProfile.objects.bulk_create(profiles)
+    TrialAnswer.objects.bulk_create(answers)
+    Progress.objects.bulk_create(progress)
+    return [(participant[0], participant[1]) for participant in batch]
+
+
+""" Writes participants' usernames and passwords to a CSV file, to hand out
+    (or to feed to links.make_links). """
+def write_accounts(accounts, path):
+    with open(path, "wb") as sheet:
+        writer = csv.writer(sheet)
+        writer.writerow(["username", "password"])
+        for username, password in accounts:
+            writer.writerow([username, password or ""])
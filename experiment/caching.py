@@ -0,0 +1,256 @@
+### CACHING.PY
+###
+### We run several worker processes, and left to themselves each of them
+### works out the same optimum paths and reads the same UserProfile and
+### TrialAnswer rows over and over. This file puts a cache that all of the
+### workers share (Django's cache framework; see CACHES in settings.py) in
+### front of two kinds of things:
+###
+### 1) Trial designs. Everything that only depends on a trial's incomes,
+###    interests and payoff -- the growth factors, the optimum and the wags
+###    the optimum earns. These never go stale, short of us changing the
+###    solver, in which case DESIGN_VERSION gets bumped.
+### 2) Users. A user's profile and their whole schedule of trials, loaded
+###    in one go (usually as they log in; see warm_user). Every user has a
+###    version number in the cache, and their entries are stored under it.
+###    Whenever something is written for a user, their version is bumped
+###    (invalidate_user), and the old entries are simply never read again.
+### 3) Submissions. Which trial forms have already been submitted, so that a
+###    double-click or a refresh doesn't submit the same responses twice.
+
+from   django.core.cache import cache
+from   hashlib           import sha1
+from   random            import randint
+from   uuid              import uuid4
+import time
+
+from   models  import UserProfile, TrialAnswer, load_designs, claim_key, release_key
+from   payoffs import get_payoff, growth_factors, cached_optimum, borrowable
+
+
+# Bump this whenever the way designs are solved changes.
+DESIGN_VERSION = 1
+
+# How long things live in the cache, in seconds. Each entry gets a bit of
+# random extra time, so that entries set at the same moment (say, just after
+# a restart) don't all expire at the same moment too.
+DESIGN_TIMEOUT  = 24 * 60 * 60
+USER_TIMEOUT    = 60 * 60
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+JITTER          = 0.1
+
+# How long a worker will wait on another worker who is already computing
+# the entry it wants before giving up and computing it itself.
+LOCK_TIMEOUT = 10
+LOCK_WAIT    = 0.5
+
+# How long we remember that a form was submitted.
+SUBMISSION_TIMEOUT = 60 * 60
+
+
+""" Fetches key from the cache, or computes it with compute() and caches it.
+    If several workers miss on the same key at once, only the first one to
+    grab the key's lock computes it; the rest wait a little for it to show
+    up, so that a cold cache doesn't send everybody to the database at once.
+    The lock is only a courtesy: with a cache that can't add atomically, two
+    workers can both get it, and then both compute the same value, which is
+    no worse than having no lock at all. If the cache can't be reached at
+    all (memcached is down, say), every add fails and no lock can be read
+    back, so there's nobody to wait for and the value is just computed.
+"""
+def get_or_compute(key, compute, timeout):
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock = key + ":lock"
+    if not cache.add(lock, 1, LOCK_TIMEOUT) and cache.get(lock) is not None:
+        waited = 0.
+        while waited < LOCK_WAIT:
+            time.sleep(0.02)
+            waited += 0.02
+            value   = cache.get(key)
+            if value is not None:
+                return value
+
+    try:
+        value = compute()
+        cache.set(key, value, timeout + randint(0, int(timeout * JITTER)))
+    finally:
+        cache.delete(lock)
+    return value
+
+
+
+###############
+### DESIGNS ###
+###############
+
+""" Everything about a trial design that doesn't depend on the user's
+    responses: the growth factors, the optimum under the given payoff (and
+    borrowing limit), the wags the optimum earns, day by day, and how much
+    can be borrowed against later incomes on each day but the last. """
+def design_info(incomes, interests, payoff = None, limit = None):
+    payoff = get_payoff(payoff)
+    design = repr((map(float, incomes), map(float, interests), payoff.key(), limit))
+    key    = "design:%i:%s" % (DESIGN_VERSION, sha1(design).hexdigest())
+
+    def compute():
+        optimum = cached_optimum(incomes, interests, payoff, limit)
+        values  = map(float, incomes)
+        rates   = [float(interest) / 100. for interest in interests]
+        return {"factors":      growth_factors(interests),
+                "optimum":      optimum,
+                "optimum_wags": payoff.wags(optimum),
+                "borrowable":   [borrowable(values, rates, day) for day in range(len(rates))]}
+    return get_or_compute(key, compute, DESIGN_TIMEOUT)
+
+
+
+#############
+### USERS ###
+#############
+
+""" The version a user's entries are currently stored under. If the version
+    has fallen out of the cache, we start a new one from the clock, so that
+    we can never land back on an old version's entries. """
+def user_version(user_id):
+    key     = "user_version:%i" % user_id
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(key, version, VERSION_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+
+""" Call this whenever anything is written for a user. Their cached entries
+    won't be read again. """
+def invalidate_user(user):
+    key = "user_version:%i" % user.id
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), VERSION_TIMEOUT)
+
+
+""" A key for one of a user's entries, under their current version. """
+def user_key(user, name):
+    return "user:%i:%i:%s" % (user.id, user_version(user.id), name)
+
+
+""" The fields we keep for each user. Model instances carry a fair bit of
+    baggage, so the cache holds plain tuples of field values instead and we
+    rebuild the instances when they're asked for. """
+PROFILE_FIELDS = [field.attname for field in UserProfile._meta.fields]
+TRIAL_FIELDS   = [field.attname for field in TrialAnswer._meta.fields]
+
+
+""" A user's profile and all of their trials, as tuples of field values. The
+    trials are loaded with a single query, in order. In write-behind mode,
+    the database can be behind, so anything of the user's still waiting to
+    be written is applied on top. (writebehind needs this file, hence the
+    late import.) """
+def user_schedule(user):
+    def compute():
+        from writebehind import catch_up
+        profile = UserProfile.objects.filter(user = user).values_list(*PROFILE_FIELDS)[0]
+        trials  = TrialAnswer.objects.filter(user = user).order_by("question") \
+                                     .values_list(*TRIAL_FIELDS)
+        return catch_up(user, profile, tuple(trials))
+    return get_or_compute(user_key(user, "schedule"), compute, USER_TIMEOUT)
+
+
+""" Called as a user logs in, since they're about to go through every trial
+    in their schedule. Loads the schedule into the cache, and works out every
+    trial's design (optimum, budget and all) while we're at it. """
+def warm_user(user):
+    profile, trials = user_schedule(user)
+    payoff  = dict(zip(PROFILE_FIELDS, profile))["payoff"]
+    design  = TRIAL_FIELDS.index("design_id")
+    load_designs(trial[design] for trial in trials)
+    for trial in trials:
+        trial_object = TrialAnswer(**dict(zip(TRIAL_FIELDS, trial)))
+        design_info(trial_object.incomes.split(","), trial_object.interests.split(","), payoff)
+
+
+""" A user's TrialAnswer for the given question, from their cached schedule
+    (None if there's no such trial). Like everything else in here, it's only
+    for reading. """
+def user_trial(user, question):
+    index = TRIAL_FIELDS.index("question")
+    for trial in user_schedule(user)[1]:
+        if trial[index] == question:
+            return TrialAnswer(**dict(zip(TRIAL_FIELDS, trial)))
+    return None
+
+
+""" Puts a profile and one of their trials back into the user's cached
+    schedule, without going through the database. Only write-behind mode
+    (see writebehind.py) does this, since there the cache is ahead of the
+    database until the next batch is written. """
+def store_state(user, profile, trial_object):
+    index   = TRIAL_FIELDS.index("question")
+    row     = tuple(getattr(trial_object, field) for field in TRIAL_FIELDS)
+    trials  = tuple(row if trial[index] == trial_object.question else trial
+                    for trial in user_schedule(user)[1])
+    profile = tuple(getattr(profile, field) for field in PROFILE_FIELDS)
+    cache.set(user_key(user, "schedule"), (profile, trials), USER_TIMEOUT)
+
+
+""" A user's profile and the TrialAnswer for the trial they're on (None if
+    they're done with all of their trials). Both are real model instances,
+    so they can be used exactly like the ones straight from the database --
+    but they're only for reading. Anything that writes must go to the
+    database and then call invalidate_user. """
+def user_state(user):
+    profile = UserProfile(**dict(zip(PROFILE_FIELDS, user_schedule(user)[0])))
+    return profile, user_trial(user, profile.trials_done)
+
+
+
+###################
+### SUBMISSIONS ###
+###################
+
+""" Every trial form goes out with a token of its own (a hidden field). The
+    first time a token comes back we claim it and process the submission;
+    any time after that, the submission is a repeat and is simply sent
+    wherever the first one was. """
+def new_token():
+    return uuid4().hex
+
+
+def submission_key(user, token):
+    return "submission:%i:%s" % (user.id, token)
+
+
+""" Claims a submitted form's token. Returns None if this is the first time
+    we've seen it, in which case the caller should process the submission
+    and then call finish_submission. Otherwise returns where the first
+    submission was sent ("" if it's still being processed). Repeats are
+    usually answered from the cache, without going near the database; only
+    a token the cache doesn't know is claimed in the database (see
+    models.Claim), which makes sure that only one worker ever gets it. """
+def claim_submission(user, token):
+    key  = submission_key(user, token)
+    seen = cache.get(key)
+    if seen is not None:
+        return seen
+    if claim_key(key):
+        cache.set(key, "", SUBMISSION_TIMEOUT)
+        return None
+    return cache.get(key, "")
+
+
+""" Remembers where a submission was sent, for any repeats of it. """
+def finish_submission(user, token, url):
+    cache.set(submission_key(user, token), url, SUBMISSION_TIMEOUT)
+
+
+""" Gives up the claim on a submission that couldn't be processed, so that
+    submitting the form again is taken as a first try rather than a repeat. """
+def release_submission(user, token):
+    key = submission_key(user, token)
+    release_key(key)
+    cache.delete(key)
@@ -0,0 +1,444 @@
+### CROSSCHECK.PY
+###
+### Before a faster way of scoring trials goes in, we want proof that it
+### scores them exactly the way the experiment always has. This file keeps
+### the original scoring code -- trial.calculate_optimum, TrialAnswer.validate,
+### the trial pages' borrowing loop and calculate_wags, as they were first
+### written -- and runs it side by side with what the experiment uses now
+### (or with a new engine) on the same trials and the same responses: every
+### design in trials.xls, then as many random designs and response paths as
+### we like. The largest difference each check finds is reported to the
+### cent, along with the trial that produced it. Run it from
+### 'python manage.py shell':
+###
+###     from experiment.crosscheck import crosscheck, report, passed
+###     results = crosscheck(1000000)
+###     report(results)
+###
+### A new engine is checked by handing it in in place of the current one,
+### under the name of the check it should pass:
+###
+###     results = crosscheck(1000000, engines = {"settle": fast_settle})
+###     assert passed(results)
+###
+### passed() gates the optimum against the original's loops with the
+### denominator put right, and the budget against the page given the
+### settled responses, since the current code is meant to differ from the
+### original there; passed(results, strict = True) holds everything to the
+### original code as written.
+###
+### Engines are given a trial's incomes, interests (in percents) and the
+### user's responses, all as lists of strings as stored on a TrialAnswer,
+### and return a list of numbers to compare (see CHECKS). They're run in a
+### pool of processes (one per core unless told otherwise), so they have to
+### be module-level functions.
+
+from   multiprocessing     import Pool, cpu_count
+from   random              import Random
+
+from   helpers             import calculate_wags, calculate_budget, k
+from   models              import TrialAnswer
+from   payoffs             import get_payoff, settle
+from   trials              import Trial
+from   builds.build_trials import load_templates, cleanse
+
+
+
+##############
+### LEGACY ###
+##############
+
+""" The original optimum, from build_trials.trial.calculate_optimum (less
+    its debugging print, and without appending to the trial's interests as
+    it used to). Its denominator compounds each day's growth from that day
+    to the end of the week, rather than from Monday to that day, so it
+    doesn't spend the trial's wealth; it was replaced by the payoffs' solvers,
+    and is only checked to show by how much they differ. """
+def legacy_optimum(incomes, interests):
+    incomes   = map(float, incomes)
+    interests = map(lambda x: float(x) / 100 + 1, interests) + [1]
+    days      = len(incomes)
+    optimum   = []
+
+    numerator = 0
+    for day in range(days):
+        interest = 1
+        for later_day in range(day, days):
+            interest *= interests[later_day]
+        numerator += incomes[day] * interest
+
+    denominator = 0
+    for day in range(days):
+        interest = 1
+        for later_day in range(day, days):
+            interest *= interests[later_day]
+        denominator += pow(interest, 1. / (1 - k))
+    optimum.append(round(numerator / denominator, 2))
+
+    for day in range(1, days):
+        interest = 1
+        for earlier_day in range(day):
+            interest *= interests[earlier_day]
+        optimum.append(round(pow(interest, 1 / (1 - k)) * optimum[0], 2))
+    return optimum
+
+
+""" The original optimum's loops with the denominator put right: each day's
+    food grows from Monday's, and is paid for at that day's price. Monday's
+    food is only rounded along with the rest, since rounding it first gets
+    multiplied up on every later day. This is what the optimum is checked
+    against. """
+def reference_optimum(incomes, interests):
+    incomes   = map(float, incomes)
+    interests = map(lambda x: float(x) / 100 + 1, interests) + [1]
+    days      = len(incomes)
+
+    numerator = 0
+    for day in range(days):
+        interest = 1
+        for later_day in range(day, days):
+            interest *= interests[later_day]
+        numerator += incomes[day] * interest
+
+    shape       = []
+    denominator = 0
+    for day in range(days):
+        earlier, later = 1, 1
+        for earlier_day in range(day):
+            earlier *= interests[earlier_day]
+        for later_day in range(day, days):
+            later   *= interests[later_day]
+        shape.append(pow(earlier, 1. / (1 - k)))
+        denominator += shape[-1] * later
+
+    first = numerator / denominator
+    return [round(weight * first, 2) for weight in shape]
+
+
+""" The original TrialAnswer.validate, returning the settled responses
+    rather than saving them. """
+def legacy_validate(incomes, interests, responses):
+    carry_over = 0.
+    index      = 0
+    incomes    = map(float,                     incomes)
+    interests  = map(lambda x: float(x) / 100., interests)
+    responses  = map(float,                     responses)
+
+    for response in responses:
+        today_money = carry_over + incomes[index]
+        borrowable  = float(incomes[-1])
+        for day in reversed(range(index, len(interests))):
+            borrowable = borrowable / (1 + interests[day]) + (incomes[day] if day != index else 0)
+
+        spendable = today_money + borrowable
+        if response > spendable:
+            responses[index] = round(spendable, 2)
+        carry_over = (today_money - responses[index]) * (1 + interests[index])
+        index += 1
+
+    responses.append(round(carry_over + incomes[-1], 2))
+    return responses
+
+
+""" The original trial pages' budget for a dynamic user on a given day: the
+    money they have, and what they can borrow. """
+def legacy_budget(incomes, interests, spendings, today_index):
+    incomes   = map(float, incomes)
+    interests = map(float, interests)
+    spendings = map(float, spendings)
+
+    carry_over = 0
+    for index in range(today_index):
+        carry_over += incomes[index] - spendings[index]
+        carry_over *= (interests[index] / 100. + 1)
+    today_money = round(carry_over + incomes[today_index], 2)
+
+    borrowable = float(incomes[-1])
+    for day in reversed(range(today_index, len(interests))):
+        borrowable = borrowable / (1 + interests[day] / 100.) + (incomes[day] if day != today_index else 0)
+    borrowable = round(borrowable, 2)
+    return today_money, borrowable
+
+
+""" The original calculate_wags. """
+def legacy_wags(food):
+    return round(pow(food, k), 2)
+
+
+
+##############
+### CHECKS ###
+##############
+
+""" What the experiment does now, in the form the checks call it in. """
+def current_optimum(incomes, interests, responses):
+    return Trial(incomes, interests).calculate_optimum()
+
+def current_settle(incomes, interests, responses):
+    return settle(incomes, interests, responses)
+
+# The way the site settles a trial: a response at a time through the
+# checkpoint for dynamic users, all at once for static ones (see
+# TrialAnswer.add_response), then validate. Dynamic users' budget for each
+# day is read off the checkpoint, as the trial pages do.
+def current_validate(incomes, interests, responses, static = True):
+    answer = TrialAnswer(incomes = ",".join(incomes), interests = ",".join(interests))
+    if static:
+        answer.add_response(None, responses, commit = False, static = True)
+    else:
+        for response in responses:
+            answer.add_response(None, [response], commit = False, static = False)
+    answer.validate(commit = False)
+    return map(float, answer.responses.split(","))
+
+def current_validate_daily(incomes, interests, responses):
+    return current_validate(incomes, interests, responses, static = False)
+
+def current_budget(incomes, interests, responses):
+    answer = TrialAnswer(incomes = ",".join(incomes), interests = ",".join(interests))
+    budget = []
+    for day in range(len(responses)):
+        budget.extend(calculate_budget(answer, day))
+        answer.add_response(None, [responses[day]], commit = False, static = False)
+    return budget
+
+def current_wags(incomes, interests, responses):
+    return get_payoff().wags(responses)
+
+def current_calculate_wags(incomes, interests, responses):
+    return [calculate_wags(float(food)) for food in responses]
+
+
+def legacy_budgets(incomes, interests, responses):
+    budget = []
+    for day in range(len(responses)):
+        budget.extend(legacy_budget(incomes, interests, responses, day))
+    return budget
+
+# The page worked out the money carried over from the responses as typed.
+# The checkpoint works it out from the responses as validate settles them,
+# which is what the user is paid on. They only differ when a response is
+# the most the page said could be spent: that's today's money and what can
+# be borrowed, each rounded to the cent, which can be a cent more than
+# validate allows. So the budget is checked against the page given the
+# settled responses.
+def legacy_budgets_settled(incomes, interests, responses):
+    settled = legacy_validate(incomes, interests, responses)[:-1]
+    return legacy_budgets(incomes, interests, settled)
+
+def legacy_wags_list(incomes, interests, responses):
+    return [legacy_wags(float(food)) for food in responses]
+
+def legacy_optimum_check(incomes, interests, responses):
+    return legacy_optimum(incomes, interests)
+
+def reference_optimum_check(incomes, interests, responses):
+    return reference_optimum(incomes, interests)
+
+
+""" Every check: its name, the original code, what it's compared with, the
+    responses it runs on ("any" for every path, or "affordable" for only
+    those a dynamic user could enter, since the page won't take a day's
+    response above what they can spend), the largest difference allowed,
+    and whether it counts towards passed(). The optimum and the budget are
+    worked out in a different order than they used to be, so a number that
+    lands right on half a cent can round either way: they're allowed a
+    cent. Anything else has to match to the cent. """
+CHECKS = [
+    ("optimum",           reference_optimum_check, current_optimum,        "any",        0.01, True),
+    ("optimum (legacy)",  legacy_optimum_check,    current_optimum,        "any",        0.01, False),
+    ("settle",            legacy_validate,         current_settle,         "any",        0.,   True),
+    ("validate",          legacy_validate,         current_validate,       "any",        0.,   True),
+    ("validate (daily)",  legacy_validate,         current_validate_daily, "affordable", 0.,   True),
+    ("budget",            legacy_budgets_settled,  current_budget,         "affordable", 0.01, True),
+    ("budget (as typed)", legacy_budgets,          current_budget,         "affordable", 0.01, False),
+    ("wags",              legacy_wags_list,        current_wags,           "any",        0.,   True),
+    ("calculate_wags",    legacy_wags_list,        current_calculate_wags, "any",        0.,   True),
+]
+
+
+
+##############
+### TRIALS ###
+##############
+
+""" Every design in trials.xls, with fresh incomes wherever it says RAND. """
+def spreadsheet_designs(rng):
+    templates = load_templates()
+    rows      = list(templates["training"])
+    for user_class in ["static", "dynamic"]:
+        for cycle in sorted(templates[user_class]):
+            rows.extend(templates[user_class][cycle])
+    return [(map(str, cleanse(list(incomes), rng)), map(str, cleanse(list(interests), rng)))
+            for incomes, interests in rows]
+
+
+""" A random design, shaped like the ones in trials.xls: two to seven days,
+    incomes from 0 to 200 (often none at all), interest from 0 to 100%. """
+def random_design(rng):
+    days      = rng.randint(2, 7)
+    incomes   = [0 if rng.random() < 0.4 else rng.randint(0, 200) for day in range(days)]
+    interests = [0 if rng.random() < 0.3 else rng.randint(0, 100) for day in range(days - 1)]
+    return map(str, incomes), map(str, interests)
+
+
+""" A random response path for a design: what a user types in for every day
+    but the last, as the form takes it (0 to 999.99, in cents). Affordable
+    paths never go over what the trial page says can be spent that day;
+    the others can ask for anything. """
+def random_path(rng, incomes, interests, affordable):
+    responses = []
+    for day in range(len(incomes) - 1):
+        if affordable:
+            money, borrowable = legacy_budget(incomes, interests, responses, day)
+            ceiling = max(money + borrowable, 0.)
+        else:
+            ceiling = 2 * sum(map(float, incomes)) + 1
+        roll = rng.random()
+        if roll < 0.1:
+            food = 0.
+        elif roll < 0.2:
+            food = ceiling
+        else:
+            food = rng.uniform(0, ceiling)
+        responses.append("%.2f" % min(round(food, 2), 999.99))
+    return responses
+
+
+
+###############
+### COMPARE ###
+###############
+
+""" Runs every check on one chunk of trials. This is what every process in
+    the pool runs. Returns, for each check, how many numbers it compared
+    and its largest difference, with the trial it came from. """
+def crosscheck_chunk(task):
+    seed, count, spreadsheet, engines = task
+    rng     = Random(seed)
+    designs = spreadsheet_designs(rng) if spreadsheet else []
+    results = dict((check[0], {"compared": 0, "largest": 0., "worst": None}) for check in CHECKS)
+
+    for index in xrange(len(designs) + count):
+        incomes, interests = designs[index] if index < len(designs) else random_design(rng)
+        paths = {"any":        random_path(rng, incomes, interests, False),
+                 "affordable": random_path(rng, incomes, interests, True)}
+
+        for name, legacy, current, path, tolerance, gate in CHECKS:
+            engine    = engines.get(name, current)
+            responses = paths[path]
+            expected  = legacy(incomes, interests, responses)
+            try:
+                found = engine(incomes, interests, responses)
+            except Exception, error:
+                found = error
+            result = results[name]
+            result["compared"] += len(expected)
+
+            if isinstance(found, Exception) or len(found) != len(expected):
+                difference = float("inf")
+            else:
+                difference = max([abs(float(a) - float(b)) for a, b in zip(expected, found)] or [0.])
+            if difference > result["largest"] or result["worst"] is None:
+                result["largest"] = difference
+                result["worst"]   = {"incomes": incomes, "interests": interests,
+                                     "responses": responses, "expected": expected,
+                                     "found": found if not isinstance(found, Exception) else repr(found)}
+    return results
+
+
+""" Runs the original code and the current code (or new engines, by check
+    name) side by side.
+
+    trials     -- How many random designs to check, each with a fresh
+                  response path of each kind.
+    engines    -- {check name: engine} to check in place of what the
+                  experiment uses now.
+    processes  -- How many processes to use. Defaults to one per core; 1
+                  runs everything right here without a pool.
+    seed       -- Everything is derived from this, so the same arguments
+                  always check the same trials.
+
+    Every design in trials.xls is checked as well. Returns, for each check,
+    how many numbers it compared, its largest difference and the trial it
+    came from, and whether it's within its tolerance.
+"""
+def crosscheck(trials = 100000, engines = None, processes = None, seed = 0, chunk_size = 20000):
+    engines   = engines or {}
+    processes = processes or cpu_count()
+    for name in engines:
+        if name not in [check[0] for check in CHECKS]:
+            raise ValueError("Unknown check: %s" % name)
+
+    # Split the trials into chunks, each with its own seed. The first chunk
+    # also does the spreadsheet's designs.
+    rng   = Random(seed)
+    tasks = [(rng.getrandbits(60), 0, True, engines)]
+    for start in range(0, trials, chunk_size):
+        tasks.append((rng.getrandbits(60), min(chunk_size, trials - start), False, engines))
+
+    load_templates()
+    if processes == 1:
+        chunks = map(crosscheck_chunk, tasks)
+    else:
+        pool   = Pool(processes)
+        chunks = pool.map(crosscheck_chunk, tasks)
+        pool.close()
+        pool.join()
+
+    results = {}
+    for name, legacy, current, path, tolerance, gate in CHECKS:
+        result = {"compared": 0, "largest": 0., "worst": None,
+                  "tolerance": tolerance, "gate": gate}
+        for chunk in chunks:
+            found = chunk[name]
+            result["compared"] += found["compared"]
+            if result["worst"] is None or found["largest"] > result["largest"]:
+                result["largest"], result["worst"] = found["largest"], found["worst"]
+        result["within"] = result["largest"] <= tolerance + 1e-9    # Float noise.
+        results[name]    = result
+    return results
+
+
+""" Whether every check that counts came out within its tolerance. Two of
+    the checks don't count by default, because the current code is known to
+    differ from the original as written: the optimum is gated against
+    reference_optimum (the original loops with the denominator put right),
+    not legacy_optimum, and the budget against the page given the settled
+    responses, not the responses as typed. strict counts them too, so it
+    only passes if the current code matches the original code exactly. """
+def passed(results, strict = False):
+    return all(result["within"] for result in results.values() if result["gate"] or strict)
+
+
+""" Prints what crosscheck found: each check, the original code it's
+    compared against, and whether it counts towards passed(). The last line
+    says what passing was measured against, and how far off the checks that
+    don't count are. """
+def report(results):
+    print "Gated checks compare against the original code, except:"
+    print "    optimum -- reference_optimum (the original's denominator put right)"
+    print "    budget  -- legacy_budgets_settled (the page, given the settled responses)"
+    print
+    print "%-20s %-24s %12s %12s" % ("Check", "Against", "Compared", "Largest")
+    for name, legacy, current, path, tolerance, gate in CHECKS:
+        result = results[name]
+        status = ("ok" if result["within"] else "FAILED") if gate else \
+                 ("(not gated, ok)" if result["within"] else "(not gated, differs)")
+        print "%-20s %-24s %12i %10.2f c  %s" % (name, legacy.__name__, result["compared"],
+                                                  result["largest"] * 100, status)
+        if not result["within"] and result["worst"]:
+            worst = result["worst"]
+            print "    incomes %s, interests %s, responses %s" % \
+                  (",".join(worst["incomes"]), ",".join(worst["interests"]), ",".join(worst["responses"]))
+            print "    expected %s" % worst["expected"]
+            print "    found    %s" % worst["found"]
+    differs = ["%s by %.2f c" % (name, results[name]["largest"] * 100)
+               for name, legacy, current, path, tolerance, gate in CHECKS
+               if not gate and not results[name]["within"]]
+    print "%s against the corrected optimum and the settled budget." % \
+          ("Passed" if passed(results) else "FAILED")
+    if differs:
+        print "Differs from the original code as written: %s." % ", ".join(differs)
+    else:
+        print "Matches the original code as written, too."
@@ -35,6 +35,10 @@ class DogForm(forms.Form):
     Saturday  = forms.DecimalField(max_digits = 5, decimal_places = 2, required = False, widget = forms.TextInput(attrs={'class': 'response'}))
     Sunday    = forms.DecimalField(max_digits = 5, decimal_places = 2, required = False, widget = forms.TextInput(attrs={'class': 'response'}))
 
+    # Identifies this copy of the form, so that submitting it twice only
+    # counts once (see caching.claim_submission).
+    token     = forms.CharField(max_length = 32, required = False, widget = forms.HiddenInput())
+
 
 
 # The diagnostic form! This has several fields, one per question we
@@ -1,33 +1,60 @@
 
-from math   import sqrt
-from models import TrialAnswer
+from math    import sqrt
+from models  import UserProfile, TrialAnswer, Progress, StageCount
+from django.db        import transaction
+from django.db.models import F
+from payoffs import get_payoff
+from caching import invalidate_user
+from trials  import trial_for
+from sharding import database_for
+import writebehind
+import tasks
 
 """ This helper method calculates which days we want to display inputs
     for. If the user is static, we show all of the days relevant to the trial
     (minus the last one, for which the user does not input anything). If
-    they are dynamic, we need to know which day they are on.
+    they are dynamic, we need to know which day they are on, which we get
+    from their profile.
 """
-def calculate_days(problem, user):
+def calculate_days(problem, profile):
     days = {"Monday":   True,  "Tuesday": False, "Wednesday": False,
             "Thursday": False, "Friday":  False, "Saturday":  False,
             "Sunday":   False}
-    user_class     = user.get_profile().user_class
+    user_class     = profile.user_class
     if user_class == "static":
         for day in problem.days[0:-1]:
             days[day] = True
     else:
         for day, show in days.iteritems():
             days[day] = False
-        days[user.get_profile().day] = True
+        days[profile.day] = True
     return days
 
 
+""" This helper tells a user how much money they have on a given day of a
+    trial, and how much they can borrow against their later incomes. The
+    trial keeps a checkpoint of its budget as each day is answered, so this
+    normally just reads it off. If the checkpoint isn't at today (a trial
+    answered before checkpoints existed, say), it's rebuilt from the
+    recorded responses first; this isn't saved, since we're only reading.
+"""
+def calculate_budget(trial_object, today_index):
+    if trial_object.checkpoint_day != today_index or trial_object.discounted_income is None:
+        trial_object.reset_checkpoint()
+        trial_object.advance_checkpoint([])
+
+    income      = float(trial_object.incomes.split(",")[today_index])
+    today_money = round(trial_object.carry_over + income, 2)
+    borrowable  = round(trial_object.discounted_income or 0., 2)
+    return today_money, borrowable
+
+
 """ This helper processes the user's input. The data has already been
     validated, so all we need to do is store it and augment whatever
-    variables need updating.
+    variables need updating. In write-behind mode (see writebehind.py) the
+    storing happens a moment later, in a batch with everybody else's.
 """
 def process_input(form, user, training):
-    profile   = user.get_profile()
 
     # Grab all of the non-meaningless fields.
     responses = filter(lambda x: x != "None",
@@ -35,26 +62,55 @@ def process_input(form, user, training):
                                  form.cleaned_data["Thursday"], form.cleaned_data["Friday"],  form.cleaned_data["Saturday"],
                                  form.cleaned_data["Sunday"]]))
 
-    # Before we can submit the responses, we need to confirm that they're
-    # legal responses given the trial's incomes and interests. To do that,
-    # send the incomes, interests and responses over to our other helper.
+    if writebehind.enabled():
+        writebehind.submit(user, responses)
+        return
+
+    # The cached state is only dropped once the submission is committed, so
+    # that nobody can cache it again from before. The transaction is on
+    # whichever database the user lives in (see sharding.py).
+    store = transaction.commit_on_success(using = database_for(user))(record_submission)
+    store(user, responses)
+    invalidate_user(user)
+
+
+""" Stores a submission (process_input runs this in a single transaction,
+    on the user's database). The user's profile row is
+    locked first (on databases that can; SQLite locks the whole database
+    anyway), so that two of the same user's submissions arriving at once are
+    stored one after the other rather than on top of each other.
+"""
+def record_submission(user, responses):
+    profile       = UserProfile.objects.select_for_update().get(user = user)
+    stage         = calculate_stage(profile)
     problem_index = profile.trials_done
     trial_object  = TrialAnswer.objects.filter(user     = user,
                                                question = problem_index)[0]
-    from builds.build_trials import trial
-    problem = trial(trial_object.incomes.split(","), trial_object.interests.split(","))
+    done_with_trial = apply_responses(user, profile, trial_object, responses)
+
+    # Save the profile and the trial, and let the dashboard know where
+    # the user is now. We're done!
+    profile.save()
+    trial_object.save()
+    record_progress(user, profile, stage)
+    queue_followups(profile, trial_object, done_with_trial)
+
+
+""" Adds a submission's responses to the trial the user is on, and moves the
+    user along: to the next day, or if they're done with the trial, to the
+    next trial (validating the one they just finished). Nothing is saved;
+    that's up to the caller. Returns whether the trial is done.
+"""
+def apply_responses(user, profile, trial_object, responses):
+    problem = trial_for(trial_object)
 
     # Add the responses to the trial object.
-    trial_object.add_response(user, responses)
+    trial_object.add_response(user, responses, commit = False,
+                              static = profile.user_class == "static")
 
     # Check if we're done with the trial. If the user is static, this is
     # automatically true. If they're dynamic, we need to check that the
-    # current day is the last day of their trial. First we need to get the
-    # trial itself to confirm this.
-    problem_index = profile.trials_done
-    trial_object  = TrialAnswer.objects.filter(user     = user,
-                                               question = problem_index)[0]
-
+    # current day is the last day of their trial.
     done_with_trial =  profile.user_class == "static"  or \
                       (profile.user_class == "dynamic" and profile.day == problem.days[-2])
 
@@ -66,7 +122,7 @@ def process_input(form, user, training):
         profile.day         = "Monday"
 
         # Validate the responses
-        trial_object.validate()
+        trial_object.validate(commit = False)
 
         # If there are 2 trials completed, we just finished the training.
         if profile.trials_done == 2:
@@ -85,19 +141,83 @@ def process_input(form, user, training):
                     "Sunday":   "Monday"}
         profile.day = next_day[profile.day]
 
-    # Save the profile, and we're done!
-    profile.save()
-    trial_object.save()
-    return
+    return done_with_trial
+
+
+""" Queues up whatever needs doing once a submission is saved, but not before
+    the user sees their next page (see tasks.py): the analytics for a trial
+    they've finished, and their payment once they're done. """
+def queue_followups(profile, trial_object, done_with_trial):
+    if done_with_trial:
+        tasks.enqueue("analyze_trial", trial_object.id)
+        if profile.finished_experiment:
+            tasks.enqueue("freeze_payment", profile.user_id)
 
 
-""" We may want to change the food-to-wag function. The function will always
-    be of the form w = x^k where w is the number of wags, x is the food and
+""" Which stage of the experiment a user is in, going by their profile.
+    Static users skip the diagnostics, so they're finished as soon as
+    they're done with the experiment.
+"""
+STAGES = ["training", "experiment", "diagnostics", "finished"]
+
+def calculate_stage(profile):
+    if not profile.finished_training:
+        return "training"
+    if not profile.finished_experiment:
+        return "experiment"
+    if profile.user_class == "dynamic" and not profile.finished_diagnostics:
+        return "diagnostics"
+    return "finished"
+
+
+""" Keeps the dashboard's summary tables up to date. Call this after a
+    user's profile has been saved, with the stage they were in before (or
+    None if they're brand new). Their Progress row is rewritten, and if they
+    changed stages, the counts are moved along. Users from before the
+    dashboard existed get their Progress row the first time they move.
+"""
+def record_progress(user, profile, previous_stage):
+    stage   = calculate_stage(profile)
+    updated = Progress.objects.filter(user = user).update(stage = stage,
+                                                          trial = profile.trials_done,
+                                                          day   = profile.day)
+    if not updated:
+        Progress.objects.create(user  = user,                username = user.username,
+                                stage = stage,               trial    = profile.trials_done,
+                                day   = profile.day)
+        previous_stage = None
+
+    if stage != previous_stage:
+        if previous_stage:
+            count_stage(previous_stage, -1)
+        count_stage(stage, 1)
+
+
+""" Adds change to the count of users in a stage. The update happens in the
+    database (count = count + change), so two users moving at the same time
+    can't clobber each other. """
+def count_stage(stage, change):
+    if not StageCount.objects.filter(stage = stage).update(count = F("count") + change):
+        StageCount.objects.get_or_create(stage = stage)
+        StageCount.objects.filter(stage = stage).update(count = F("count") + change)
+
+
+""" We may want to change the food-to-wag function. By default the function
+    is of the form w = x^k where w is the number of wags, x is the food and
     k is some constant. k may change, however, so we are best off leaving it
-    as a variable.
+    as a variable. Other arms of the experiment can use a different function
+    altogether; pass the name of the payoff (see payoffs.py) to use it.
 """
 k = 0.5
-def calculate_wags(food):
-    global k
-    wags = round(pow(food, k), 2)
+def calculate_wags(food, payoff = None):
+    wags = round(get_payoff(payoff).value(food), 2)
     return wags
+
+
+""" The user's payment depends on how far their wags fell short of the wags
+    the optimal allocation would have earned. b is a scaling parameter.
+"""
+def calculate_payment(wags, optimum_wags, b = 0.01):
+    dif     = optimum_wags - wags
+    payment = round(40 - b * (dif**2), 2)
+    return payment
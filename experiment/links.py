@@ -0,0 +1,133 @@
+### LINKS.PY
+###
+### Logging in with a password is slow on purpose: checking it means hashing
+### it thousands of times. That's fine for one participant, but when a whole
+### room logs in at the start of a session, everybody waits on everybody
+### else's hashing. Instead, participants can be handed a login link (or a
+### QR code of one), which is checked with a single HMAC:
+###
+###     /login/<user id>-<expiry>-<signature>/
+###
+### The signature covers the user's id, their password hash and when they
+### last logged in, as well as the expiry, all signed with SECRET_KEY. Logging
+### in (with the link or a password) changes last_login, so every link only
+### works once; changing the password voids it too. Opening a link only asks
+### the participant to confirm, and it's the confirmation that logs them in,
+### so a chat app's preview or a QR scanner fetching it doesn't use it up.
+### Make a room's links from 'python manage.py shell', and print them out:
+###
+###     from experiment.links import make_links, link_sheet
+###     links = make_links(["room1_%i" % index for index in range(40)],
+###                        "http://lab.example.edu", hours = 4)
+###     link_sheet(links, "room1_links.html")
+###
+### The sheet has a QR code for each link if the qrcode package is installed,
+### and just the links if it isn't.
+
+from   django.conf                import settings
+from   django.contrib.auth.models import User
+from   django.utils.crypto        import salted_hmac, constant_time_compare
+from   django.utils.http          import int_to_base36, base36_to_int
+from   cgi                        import escape
+import base64
+import time
+
+from   models                     import claim_key
+
+
+LINK_SALT = "experiment.links"
+
+
+
+##############
+### TOKENS ###
+##############
+
+""" The signature for a user's link, expiring at the given time (seconds
+    since the epoch). """
+def link_hash(user, expires):
+    seen  = user.last_login.strftime("%Y-%m-%d %H:%M:%S.%f") if user.last_login else ""
+    value = "%i|%s|%s|%i" % (user.id, user.password, seen, expires)
+    return salted_hmac(LINK_SALT, value).hexdigest()[::2]
+
+
+""" A login token for the user, good for hours (by default LOGIN_LINK_HOURS)
+    or until they next log in. """
+def make_token(user, hours = None):
+    if hours is None:
+        hours = settings.LOGIN_LINK_HOURS
+    expires = int(time.time() + hours * 60 * 60)
+    return "%i-%s-%s" % (user.id, int_to_base36(expires), link_hash(user, expires))
+
+
+""" The user a token logs in, or None if it's malformed, expired, forged or
+    already used. Whether the user is active is up to the caller. """
+def check_token(token):
+    try:
+        user_id, expires, digest = token.split("-")
+        user_id, expires         = int(user_id), base36_to_int(expires)
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+
+    try:
+        user = User.objects.get(id = user_id)
+    except User.DoesNotExist:
+        return None
+    if not constant_time_compare(link_hash(user, expires), digest):
+        return None
+    return user
+
+
+""" Claims a token for a login, so that two clicks on the same link that
+    arrive together can't both get in before last_login changes. Returns
+    whether this was the first claim. """
+def claim_token(token):
+    return claim_key("login-link:%s" % token)
+
+
+
+##############
+### SHEETS ###
+##############
+
+""" Login links for the users with the given usernames, as (username, url)
+    pairs in the order given. Users that don't exist are skipped. """
+def make_links(usernames, base_url, hours = None):
+    users = {}
+    for start in range(0, len(usernames), 500):
+        for user in User.objects.filter(username__in = usernames[start:start + 500]):
+            users[user.username] = user
+    base_url = base_url.rstrip("/")
+    return [(username, "%s/login/%s/" % (base_url, make_token(users[username], hours)))
+            for username in usernames if username in users]
+
+
+""" Writes an HTML page with a card for each link, ready to print and cut
+    up: the username, the link and, if qrcode is installed, a QR code. """
+def link_sheet(links, path):
+    try:
+        import qrcode
+        import qrcode.image.svg
+    except ImportError:
+        qrcode = None
+
+    cards = []
+    for username, url in links:
+        image = ""
+        if qrcode is not None:
+            svg   = qrcode.make(url, image_factory = qrcode.image.svg.SvgImage).to_string()
+            image = '<img src="data:image/svg+xml;base64,%s" />' % base64.b64encode(svg)
+        cards.append('<div class="card"><b>%s</b>%s<br/><tt>%s</tt></div>' %
+                     (escape(username), image, escape(url)))
+
+    with open(path, "w") as sheet:
+        sheet.write("<html><head><style>\n"
+                    ".card { display: inline-block; width: 30%; margin: 1%; padding: 8px;\n"
+                    "        border: 1px dashed gray; text-align: center; }\n"
+                    ".card img { display: block; width: 60%; margin: 8px auto; }\n"
+                    "</style></head><body>\n")
+        sheet.write("\n".join(cards))
+        sheet.write("\n</body></html>\n")
+    return len(cards)
@@ -0,0 +1,156 @@
+### LOADTEST.PY
+###
+### How the site holds up when whole rooms of participants click Submit at
+### the same moment. Every room gets a process of its own (as if it had its
+### own web server workers), and every participant a thread in it, which
+### logs in and then, round after round, waits for the rest of their room,
+### submits their next answer and loads the page it's sent to, just as a
+### browser would. Rooms don't wait for each other. The clicks go through
+### the whole of Django (the same views, the same cache, the same database)
+### but not through a web server.
+###
+### Run it from 'python manage.py shell', against participants made with
+### builds/generate.py:
+###
+###     from experiment.builds.generate import generate
+###     from experiment.loadtest        import load_test, report
+###     generate(160, stages = {"experiment": 1}, prefix = "load")
+###     report(load_test(rooms = 4, room_size = 40, rounds = 10, prefix = "load"))
+###
+### To compare databases, run the same thing from the same data (see
+### restart_database.snapshot and restore) once with the usual SQLite
+### settings and once with FEED_THE_DOG_DATABASE=postgresql (see
+### settings.py), or with each room in a shard of its own (see sharding.py).
+### Clicks that fail -- "database is locked", say -- are counted as errors
+### rather than stopping the test.
+
+from   django.conf                import settings
+from   django.contrib.auth.models import User
+from   django.db                  import connections
+from   django.test.client         import Client
+from   multiprocessing            import Pool
+import threading
+import time
+
+from   caching  import user_state, new_token
+from   trials   import trial_for
+from   stats    import percentile
+from   sharding import database_for, use_database
+import pooling
+
+
+""" Plays rooms of room_size participants (usernames starting with prefix,
+    in order, who must be in training or the experiment) for the given
+    number of rounds. Participants who finish early just stop.
+
+    Returns the time every click took, how many clicks failed and how long
+    the whole test took.
+"""
+def load_test(rooms = 1, room_size = 40, rounds = 10, prefix = "synthetic", value = "10"):
+    users = list(User.objects.filter(username__startswith = prefix).order_by("id")
+                             .values_list("id", flat = True)[:rooms * room_size])
+    if len(users) < rooms * room_size:
+        raise ValueError("Only %i users start with %r." % (len(users), prefix))
+
+    # The rooms' processes each open connections of their own.
+    for alias in connections:
+        connections[alias].close()
+    tasks   = [(users[room * room_size:(room + 1) * room_size], rounds, value)
+               for room in range(rooms)]
+    pool    = Pool(rooms)
+    start   = time.time()
+    played  = pool.map(play_room, tasks)
+    results = {"times":   sum([room["times"] for room in played], []),
+               "errors":  sum(room["errors"] for room in played),
+               "elapsed": time.time() - start,
+               "engine":  settings.DATABASES["default"]["ENGINE"].split(".")[-1]}
+    pool.close()
+    return results
+
+
+""" Plays a single room, in a process of its own. """
+def play_room(task):
+    members, rounds, value = task
+    pooling.keep_connections()
+    results = {"times": [], "errors": 0}
+    lock    = threading.Lock()
+    barrier = Barrier(len(members))
+    threads = [threading.Thread(target = participant,
+                                args   = (user, rounds, barrier, value, results, lock))
+               for user in User.objects.filter(id__in = members)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+""" One participant's thread. Whatever goes wrong, it keeps turning up at
+    the barrier, so that the rest of the room isn't left waiting. """
+def participant(user, rounds, barrier, value, results, lock):
+    client = Client()
+    try:
+        client.login(username = user.username, password = "password")
+    except Exception:
+        client = None
+
+    for round in range(rounds):
+        barrier.wait()
+        try:
+            if client is None:
+                raise ValueError("%s couldn't log in" % user.username)
+            with use_database(database_for(user)):
+                profile, trial_object = user_state(user)
+                if profile.finished_experiment or trial_object is None:
+                    continue
+                days = trial_for(trial_object).days[:-1] if profile.user_class == "static" \
+                                                         else [profile.day]
+            data = dict((day, value) for day in days)
+            data["token"] = new_token()
+            page = "/experiment/" if profile.finished_training else "/training/"
+
+            start    = time.time()
+            response = client.post(page, data)
+            if response.status_code != 302:
+                raise ValueError("POST %s answered %i" % (page, response.status_code))
+            client.get(response["Location"])
+            taken    = time.time() - start
+        except Exception:
+            with lock:
+                results["errors"] += 1
+        else:
+            with lock:
+                results["times"].append(taken)
+
+
+""" Lets a room's threads all go at once. (threading has no barrier of its
+    own until Python 3.) """
+class Barrier(object):
+    def __init__(self, parties):
+        self.parties   = parties
+        self.waiting   = 0
+        self.round     = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            round         = self.round
+            self.waiting += 1
+            if self.waiting == self.parties:
+                self.waiting  = 0
+                self.round   += 1
+                self.condition.notify_all()
+            while round == self.round:
+                self.condition.wait()
+
+
+""" Prints what load_test found. """
+def report(results):
+    times = sorted(results["times"])
+    print "Database:        %s" % results["engine"]
+    print "Clicks:          %i (%i failed)" % (len(times), results["errors"])
+    print "Clicks a second: %.1f" % (len(times) / results["elapsed"])
+    if times:
+        print "Time per click:  median %.0f ms, 95%% %.0f ms, 99%% %.0f ms, worst %.0f ms" % \
+              (percentile(times, 50) * 1000, percentile(times, 95) * 1000,
+               percentile(times, 99) * 1000, times[-1] * 1000)
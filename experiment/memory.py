@@ -0,0 +1,287 @@
+### MEMORY.PY
+###
+### A worker lives for the whole of a day's sessions, so anything it keeps
+### hold of and never lets go of -- a cache that never gets cleared, a list
+### that's only ever appended to -- grows all day, until the worker hits its
+### memory limit and is killed partway through somebody's trial. This file
+### keeps an eye on each worker's memory, so that growth like that shows up
+### long before then. Every MEMORY_INTERVAL seconds, a thread in each worker
+### (see warmup.py) takes a snapshot of:
+###
+### * the worker's resident memory (RSS);
+### * how many objects of each type are alive;
+### * how big each of our own in-process caches is (see CACHES below);
+### * how much the worker's memory grew while each view was running;
+### * and, if the tracemalloc backport (pytracemalloc) is installed and
+###   MEMORY_TRACE is set, which lines of code allocated the most.
+###
+### Each snapshot is compared with the one before, and a line goes to the
+### 'experiment.memory' log saying how big the worker is, what grew, and,
+### if MEMORY_LIMIT is set, how long it will take to reach it at the rate
+### it's growing. It's a warning once that's within MEMORY_WARN_HOURS, or
+### the worker's past MEMORY_WARN_FRACTION of the limit. Staff can see the
+### same, and how it's changed since the worker started, at
+### /dashboard/memory/; or from 'python manage.py shell':
+###
+###     from experiment.memory import take_snapshot, compare
+###     before = take_snapshot()
+###     ...
+###     print compare(before, take_snapshot())
+
+from   django.conf import settings
+from   collections import deque
+import gc
+import logging
+import os
+import resource
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import admission
+import models
+import payoffs
+import sharding
+import trials
+import writebehind
+
+
+# How many snapshots each worker keeps: at the default interval, the last
+# four hours. The first one, taken as the worker starts, is kept as well.
+SNAPSHOTS_KEPT = 48
+
+# How many types, caches, allocation sites and views a comparison lists.
+TOP = 15
+
+# Warn when the worker is this close to MEMORY_LIMIT, as a fraction of it,
+# or will get there within this many hours.
+MEMORY_WARN_FRACTION = 0.8
+MEMORY_WARN_HOURS    = 2
+
+logger = logging.getLogger("experiment.memory")
+
+_first     = None
+_snapshots = deque(maxlen = SNAPSHOTS_KEPT)
+_views     = {}
+_lock      = threading.Lock()
+_watcher   = None
+
+
+
+###############
+### READING ###
+###############
+
+""" The worker's resident memory, in bytes. Where /proc isn't around, this
+    is the most it has ever been rather than what it is now. """
+def rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+""" Our own in-process caches, and anything else of ours that's kept for
+    the life of the worker, with how to count what's in each. The caches
+    clear themselves when they get too big, so any of these that keeps on
+    growing is a leak. """
+CACHES = [
+    ("trials",             lambda: len(trials._trials)),
+    ("optimums",           lambda: len(payoffs._optimum_cache)),
+    ("designs",            lambda: len(models._designs)),
+    ("placements",         lambda: len(sharding._placements)),
+    ("write-behind queue", lambda: len(writebehind._queue)),
+    ("admission waits",    lambda: len(admission._gate.waits) if admission._gate else 0),
+]
+
+def cache_sizes():
+    return dict((name, size()) for name, size in CACHES)
+
+
+""" How many objects of each type are alive. Only objects the garbage
+    collector keeps track of are counted: containers and instances, but not
+    strings or numbers (which live inside them). This takes a moment, with
+    every object in the worker to look at. """
+def count_objects():
+    counts = {}
+    for thing in gc.get_objects():
+        name = type(thing).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+""" The lines that allocated the most memory that's still in use, as
+    {"file:line": (bytes, blocks)}, if tracemalloc is tracing. """
+def allocation_sites(limit = 100):
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return {}
+    sites = {}
+    for statistic in tracemalloc.take_snapshot().statistics("lineno")[:limit]:
+        frame = statistic.traceback[0]
+        sites["%s:%i" % (frame.filename, frame.lineno)] = (statistic.size, statistic.count)
+    return sites
+
+
+""" Everything above, as of now. """
+def take_snapshot():
+    with _lock:
+        views = dict((name, list(totals)) for name, totals in _views.items())
+    return {"time":    time.time(),
+            "rss":     rss(),
+            "objects": count_objects(),
+            "caches":  cache_sizes(),
+            "sites":   allocation_sites(),
+            "views":   views}
+
+
+
+###################
+### COMPARISONS ###
+###################
+
+""" What changed between two snapshots: the seconds between them, how much
+    RSS grew (in bytes), and the types, caches, allocation sites and views
+    that grew the most, biggest first. """
+def compare(old, new):
+    def grown(before, after):
+        changes = [(name, after[name] - before.get(name, 0), after[name]) for name in after]
+        changes = [change for change in changes if change[1] > 0]
+        return sorted(changes, key = lambda change: -change[1])[:TOP]
+
+    sites = [(site, size - old["sites"].get(site, (0, 0))[0], size)
+             for site, (size, count) in new["sites"].items()]
+    views = []
+    for name, (requests, growth) in new["views"].items():
+        before = old["views"].get(name, (0, 0))
+        if requests > before[0]:
+            views.append((name, requests - before[0], growth - before[1]))
+
+    return {"seconds": round(new["time"] - old["time"], 1),
+            "rss":     new["rss"] - old["rss"],
+            "objects": grown(old["objects"], new["objects"]),
+            "caches":  grown(old["caches"],  new["caches"]),
+            "sites":   sorted([site for site in sites if site[1] > 0], key = lambda site: -site[1])[:TOP],
+            "views":   sorted(views, key = lambda view: -view[2])[:TOP]}
+
+
+""" How fast the worker is growing (bytes an hour, over the snapshots it
+    has kept) and, with MEMORY_LIMIT set, how many hours it has left at that
+    rate (None if it isn't growing). """
+def trend(latest):
+    oldest = _snapshots[0] if _snapshots else _first
+    if oldest is None or latest["time"] <= oldest["time"]:
+        return {"per_hour": 0, "hours_left": None}
+    per_hour = (latest["rss"] - oldest["rss"]) * 3600. / (latest["time"] - oldest["time"])
+    limit    = memory_limit()
+    left     = (limit - latest["rss"]) / per_hour if limit and per_hour > 0 else None
+    return {"per_hour": int(per_hour), "hours_left": round(left, 1) if left is not None else None}
+
+
+""" MEMORY_LIMIT (in megabytes) in bytes, or None if there isn't one. """
+def memory_limit():
+    limit = getattr(settings, "MEMORY_LIMIT", None)
+    return limit * 1024 * 1024 if limit else None
+
+
+
+################
+### WATCHING ###
+################
+
+""" Takes a snapshot, keeps it, and logs how it compares with the one
+    before. Returns the snapshot. """
+def watch():
+    global _first
+    snapshot = take_snapshot()
+    previous = _snapshots[-1] if _snapshots else None
+    if _first is None:
+        _first = snapshot
+    _snapshots.append(snapshot)
+
+    megabytes = snapshot["rss"] / 1048576.
+    line      = "pid %i: %.1f MB" % (os.getpid(), megabytes)
+    if previous is not None:
+        changes = compare(previous, snapshot)
+        line   += " (%+.1f MB in %i s)" % (changes["rss"] / 1048576., changes["seconds"])
+        grew    = changes["caches"][:3] + changes["objects"][:3]
+        if grew:
+            line += "; grew: " + ", ".join("%s %+i" % (name, change) for name, change, now in grew)
+
+    limit = memory_limit()
+    left  = trend(snapshot)["hours_left"]
+    if limit and (snapshot["rss"] > limit * MEMORY_WARN_FRACTION or
+                  (left is not None and left < MEMORY_WARN_HOURS)):
+        logger.warning("%s; reaches MEMORY_LIMIT (%i MB) in %s hours" %
+                       (line, limit / 1048576, left if left is not None else "?"))
+    else:
+        logger.info(line)
+    return snapshot
+
+
+""" Starts the watching thread, if it isn't running (see warmup.py). Turns
+    on tracemalloc too, if it's installed and MEMORY_TRACE is set. """
+def start():
+    global _watcher
+    if _watcher is None:
+        if getattr(settings, "MEMORY_TRACE", False) and tracemalloc is not None:
+            tracemalloc.start()
+        _watcher        = threading.Thread(target = run)
+        _watcher.daemon = True
+        _watcher.start()
+
+
+def run():
+    while True:
+        try:
+            watch()
+        except Exception:
+            logger.exception("Taking a memory snapshot failed.")
+        time.sleep(settings.MEMORY_INTERVAL)
+
+
+""" What the staff page shows: this worker's memory now, how fast it's
+    growing, and what grew since the last snapshot and since it started. """
+def status():
+    now  = take_snapshot()
+    data = {"pid":     os.getpid(),
+            "rss":     now["rss"],
+            "limit":   memory_limit(),
+            "trend":   trend(now),
+            "caches":  now["caches"],
+            "tracing": bool(now["sites"])}
+    if _snapshots:
+        data["since_last"]  = compare(_snapshots[-1], now)
+        data["since_start"] = compare(_first, now)
+    return data
+
+
+
+##################
+### MIDDLEWARE ###
+##################
+
+""" Keeps track of how much the worker's memory grows while each view runs
+    (requests, bytes) -- a view that always grows it is worth a look. The
+    worker's other threads carry on meanwhile, so for any one request this
+    is only a rough guide; it's over a day's requests that it tells. """
+class MemoryMiddleware(object):
+
+    def process_view(self, request, view, arguments, keywords):
+        request.memory_view  = getattr(view, "__name__", "unknown")
+        request.memory_start = rss()
+        return None
+
+    def process_response(self, request, response):
+        name = getattr(request, "memory_view", None)
+        if name is not None:
+            growth = rss() - request.memory_start
+            with _lock:
+                totals     = _views.setdefault(name, [0, 0])
+                totals[0] += 1
+                totals[1] += growth
+        return response
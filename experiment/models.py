@@ -1,11 +1,15 @@
 
 # Necessary import to be able to use Django's model library.
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
 
 # Another import, this one to allow us to sync our own UserInfo database
 # with a given user from Django's User database.
 from django.contrib.auth.models import User
 
+# The budget calculations are shared with the optimum solvers.
+from payoffs import settle, settle_day, borrowable
+from hashlib import sha1
+
 """ USER
     The user model holds all of the information pertaining to a given user,
     aside from the username and password; these are held by Django's own
@@ -55,12 +59,89 @@ class UserProfile(models.Model):
     payment_trial = models.IntegerField()
 
 
+    # The seed that the user's trials (and payment trial) were built from.
+    # build_trials.build_schedule(user_class, seed) rebuilds them exactly.
+    seed = models.BigIntegerField(null = True)
+
+
+    # Which food-to-wag function this user's dog has. This is the name of
+    # one of the payoffs registered in payoffs.py.
+    payoff = models.CharField(max_length = 20, default = "power")
+
+
     # Return URL. This is only relevant to TESS subjects, as it holds the
     # URL that the user should return to once they have completed the survey.
     return_url = models.CharField(max_length = 150, default = "")
 
 
 
+""" TRIAL DESIGN
+    A trial's incomes and interests. Everybody gets the same training trials,
+    and most experimental trials only differ between users in their RAND
+    incomes, so rather than every TrialAnswer carrying its own copy, each
+    distinct design is stored once and TrialAnswers point at it.
+
+    Designs are identified by a hash of their contents (see design_digest),
+    so a design never changes once it's stored, and can be remembered for
+    as long as we're running: lookup only ever reads a design from the
+    database once per process.
+"""
+class TrialDesign(models.Model):
+    digest    = models.CharField(max_length = 16, unique = True)
+    incomes   = models.CommaSeparatedIntegerField(max_length = 30)
+    interests = models.CommaSeparatedIntegerField(max_length = 30)
+
+    def __unicode__(self):
+        return u"%s / %s" % (self.incomes, self.interests)
+
+
+""" The digest for a design, from its incomes and interests as stored. 64
+    bits of SHA-1 is plenty to tell a few thousand designs apart. """
+def design_digest(incomes, interests):
+    return sha1("%s|%s" % (incomes, interests)).hexdigest()[:16]
+
+
+DESIGN_CACHE_SIZE = 10000
+_designs          = {}
+
+""" The TrialDesign with the given digest, read from the given database if
+    it has to be read (by default, wherever the router sends it). Digests
+    are hashes of the designs' contents, so the same digest is the same
+    design whichever database it came from. """
+def lookup_design(digest, using = None):
+    design = _designs.get(digest)
+    if design is None:
+        design = TrialDesign.objects.using(using).get(digest = digest)
+        remember_design(design)
+    return design
+
+
+""" Reads all of the given designs that we don't have yet, in one query. """
+def load_designs(digests):
+    missing = [digest for digest in set(digests) if digest not in _designs]
+    if missing:
+        for design in TrialDesign.objects.filter(digest__in = missing):
+            remember_design(design)
+
+
+def remember_design(design):
+    if len(_designs) >= DESIGN_CACHE_SIZE:
+        _designs.clear()
+    _designs[design.digest] = design
+
+
+""" The TrialDesign for the given incomes and interests (comma-separated
+    strings), stored (in the given database) if it isn't already. """
+def store_design(incomes, interests, using = None):
+    design, created = TrialDesign.objects.using(using) \
+                                 .get_or_create(digest   = design_digest(incomes, interests),
+                                                defaults = {"incomes":   incomes,
+                                                            "interests": interests})
+    remember_design(design)
+    return design
+
+
+
 """ TRIAL ANSWER
     This model will store each user's answers to each trial. Every answer
     to every trial from the experimental half of the project from every
@@ -76,7 +157,9 @@ class UserProfile(models.Model):
                 nth question, this field will be set to n.
 
     And then a crap ton of variables to hold the info about the trial at hand
-    and the user's responses to it.
+    and the user's responses to it. The trial's incomes and interests live on
+    its TrialDesign, but can be read (and, before the answer is first saved,
+    set) as trial_answer.incomes and trial_answer.interests all the same.
     
 """
 class TrialAnswer(models.Model):
@@ -84,82 +167,160 @@ class TrialAnswer(models.Model):
     question = models.IntegerField()
 
     # Info about the question
-    incomes   = models.CommaSeparatedIntegerField(max_length = 30)
-    interests = models.CommaSeparatedIntegerField(max_length = 30)
-    responses = models.CommaSeparatedIntegerField(max_length = 30)
+    # A week of responses can run to 40-odd characters, and PostgreSQL (unlike
+    # SQLite) turns away anything longer than max_length, so the responses
+    # get plenty of room.
+    design    = models.ForeignKey(TrialDesign, to_field = "digest")
+    responses = models.CommaSeparatedIntegerField(max_length = 200)
+
+    # A running checkpoint of the budget, brought up to date every time a
+    # response is added, so that nobody has to replay the week from Monday.
+    # checkpoint_day is the index of the next day to be answered, carry_over
+    # the money carried into that day, discounted_income what can be borrowed
+    # on that day against later incomes, and settled the responses so far as
+    # validate will settle them.
+    checkpoint_day    = models.IntegerField(default = 0)
+    carry_over        = models.FloatField(default = 0.)
+    discounted_income = models.FloatField(null = True)
+    settled           = models.CommaSeparatedIntegerField(max_length = 200, default = "")
+
+    # Once the trial is validated, responses holds the settled responses.
+    # What the user actually submitted is kept here.
+    submitted = models.CommaSeparatedIntegerField(max_length = 200, default = "")
+
+    # Every page looks an answer up by its user and question, and each user
+    # only answers each question once.
+    class Meta:
+        unique_together = ("user", "question")
+
+
+    """ The incomes and interests, from the trial's design. A new answer can
+        be given its incomes and interests instead of a design (as in
+        TrialAnswer(incomes = "50,50", interests = "10")); the design is
+        then found, or stored, as the answer is saved. """
+    def get_design_fields(self):
+        if self.design_id is None:
+            return getattr(self, "_incomes", None), getattr(self, "_interests", None)
+        design = lookup_design(self.design_id, self._state.db)
+        return design.incomes, design.interests
+
+    def set_incomes(self, incomes):
+        self._incomes  = incomes
+
+    def set_interests(self, interests):
+        self._interests = interests
+
+    incomes   = property(lambda self: self.get_design_fields()[0], set_incomes)
+    interests = property(lambda self: self.get_design_fields()[1], set_interests)
+
+    def save(self, *args, **kwargs):
+        if self.design_id is None:
+            using       = kwargs.get("using") or router.db_for_write(TrialAnswer, instance = self)
+            self.design = store_design(self._incomes, self._interests, using)
+        super(TrialAnswer, self).save(*args, **kwargs)
 
 
     """ Whenever the user submits a response we need to add it to the
         trial object. The way in which this is done differs for dynamic
         and static users. If the user is static, we just set self.responses
         equal to response; if the user is dynamic, however, we need to add
-        to self.responses rather than reset it.
+        to self.responses rather than reset it. If we already know whether
+        the user is static, we can say so and save a trip to their profile;
+        with commit = False nothing is saved.
     """
-    def add_response(self, user, response):
+    def add_response(self, user, response, commit = True, static = None):
+
+        # Static users answer the whole trial at once, so their checkpoint
+        # starts over.
+        if static is None:
+            static = UserProfile.objects.get(user = user).user_class == "static"
+        if static:
+            self.responses = ""
+            self.reset_checkpoint()
+        self.advance_checkpoint(response)
 
         # When we get the responses, they're in a list form.
         response = ','.join(response)
         
-        if user.get_profile().user_class == "static":
+        if static:
             self.responses      = response
         else:
             if self.responses:
                 self.responses += "," + response
             else:
                 self.responses   = response
-        self.save()
+        if commit:
+            self.save()
+
+
+    """ Empties the checkpoint, back to Monday morning. """
+    def reset_checkpoint(self):
+        self.checkpoint_day    = 0
+        self.carry_over        = 0.
+        self.discounted_income = None
+        self.settled           = ""
+
+
+    """ Brings the checkpoint forward over the given responses, settling each
+        one exactly as validate would. If the checkpoint has fallen behind
+        the stored responses (say, for a trial answered before checkpoints
+        existed), it catches up on those first.
+    """
+    def advance_checkpoint(self, responses):
+        incomes = map(float,                     self.incomes.split(','))
+        rates   = map(lambda x: float(x) / 100., self.interests.split(','))
+        settled = self.settled.split(',') if self.settled else []
+
+        recorded = self.responses.split(',') if self.responses else []
+        if self.checkpoint_day < len(recorded):
+            responses = recorded[self.checkpoint_day:] + list(responses)
+
+        for response in responses:
+            response, self.carry_over = settle_day(incomes, rates, self.checkpoint_day,
+                                                   self.carry_over, float(response))
+            settled.append(str(response))
+            self.checkpoint_day += 1
+
+        self.settled = ','.join(settled)
+        if self.checkpoint_day < len(incomes) - 1:
+            self.discounted_income = borrowable(incomes, rates, self.checkpoint_day)
+        else:
+            self.discounted_income = None
 
 
     """ We need to check that the user's responses are legal. That is, are their
         responses OK for the given trial, given that trial's incomes and interests?
         If they are, then we just return the responses exactly as given, adding. If they're
-        not, we change the later responses so that they are legal.
+        not, we change the later responses so that they are legal. With
+        commit = False nothing is saved.
     """
-    def validate(self):
-
-        # Couple of initial variables. carry_over represents how much money
-        # we have carried from the previous day.
-        carry_over = 0.
-        index      = 0
-
-        # Convert all the incomes, interests and responses from Django's unicode
-        # to floats. It will be helpful to divide everything in interests by 100
-        # to change the values from percents to decimal figures.
-        incomes   = map(float,                     self.incomes.split(','))
-        interests = map(lambda x: float(x) / 100., self.interests.split(','))
-        responses = map(float,                     self.responses.split(','))
-        
-        for response in responses:
+    def validate(self, commit = True):
+
+        # If the checkpoint is up to date, it has already settled every
+        # response; all that's left is to give the user whatever's left over
+        # to spend on the last day.
+        recorded = self.responses.split(',') if self.responses else []
+        if self.settled and self.checkpoint_day == len(recorded):
+            last_income = float(self.incomes.split(',')[-1])
+            responses   = self.settled + "," + str(round(self.carry_over + last_income, 2))
+
+        # Otherwise settle the whole week. The budgeting itself lives in
+        # payoffs.settle, so that anything else that needs to know what a
+        # user's responses turn into (the simulator, for one) does exactly
+        # the same thing.
+        else:
+            responses = settle(self.incomes.split(','), self.interests.split(','),
+                               recorded)
+
+            # Convert into CommaSeparatedInteger form
+            responses = ','.join(map(str, responses))
 
-            # The first thing we do for every day of the week is find out
-            # how much money we could possibly have to spend. This is calculated
-            # as the amount of money carried over from the previous day, plus
-            # today's income, plus money that we could borrow.
-            today_money = carry_over + incomes[index]
-            borrowable  = float(incomes[-1])
-            for day in reversed(range(index, len(interests))):
-                borrowable = borrowable / (1 + interests[day]) + (incomes[day] if day != index else 0)
-
-            # The amount of cash we can spend today is how much we have physically
-            # plus how much we can borrow
-            spendable = today_money + borrowable
-
-            # If the amount we want to spend is less than what we can spend, then
-            # allow it. Otherwise, the amount we get to spend is restricted to
-            # to what we can spend.
-            if response > spendable:
-                responses[index] = round(spendable, 2)
-            carry_over = (today_money - responses[index]) * (1 + interests[index])
-            index += 1
-
-        # Lastly, give the user whatever's left over to spend on the last day.
-        # Convert into CommaSeparatedInteger form
-        responses.append(round(carry_over + incomes[-1], 2))
-        responses = ','.join(map(str, responses))
-
-        # Save that shit.
+        # Keep what the user actually typed in, so we can always tell how
+        # much validation changed. Save that shit.
+        self.submitted = ','.join(recorded)
         self.responses = responses
-        self.save()
+        if commit:
+            self.save()
 
 
 
@@ -178,3 +339,133 @@ class DiagnosticAnswer(models.Model):
 
 
 
+""" PROGRESS
+    While a session is running, the experimenter wants to see where everybody
+    is. Working that out from UserProfile means reading every profile on every
+    refresh, right when the participants are busy writing to them. Instead,
+    every time a user moves along we update two small summary tables, and
+    the dashboard only ever reads those.
+
+    Progress holds one row per user: which stage they're in ("training",
+    "experiment", "diagnostics" or "finished"), which trial they're on and,
+    for dynamic users, which day. The username is copied over so that the
+    dashboard doesn't need to look at the User table either.
+
+    StageCount holds one row per stage, counting the users in that stage.
+"""
+class Progress(models.Model):
+    user     = models.OneToOneField(User)
+    username = models.CharField(max_length = 30)
+    stage    = models.CharField(max_length = 11, default = "training", db_index = True)
+    trial    = models.IntegerField(default = 0)
+    day      = models.CharField(max_length = 9, default = "Monday")
+
+
+class StageCount(models.Model):
+    stage = models.CharField(max_length = 11, unique = True)
+    count = models.IntegerField(default = 0)
+
+
+
+""" TRIAL ANALYTICS
+    How well a user did on a single completed trial, as worked out by
+    analytics.analyze. There is one row per completed TrialAnswer.
+
+    wags, optimum_wags   The wags the user earned, and the wags the optimum
+                         would have earned.
+    shortfall            optimum_wags - wags.
+    path_error           The root mean square difference, per day, between
+                         what the user fed the dog and the optimum.
+    max_debt             The most the user ever owed at the end of a day (0 if
+                         they never borrowed), and
+    days_borrowed        on how many days they ended up owing.
+    clipped_days         On how many days validation had to cut back what the
+    clipped_amount       user asked for, and by how much in total. Both are
+                         null for trials validated before submissions were kept.
+    fingerprint          A hash of everything the row was computed from, so
+                         that re-running the analysis only touches trials
+                         that are new or have changed.
+"""
+class TrialAnalytics(models.Model):
+    trial    = models.OneToOneField(TrialAnswer)
+    user     = models.ForeignKey(User)
+    question = models.IntegerField()
+    payoff   = models.CharField(max_length = 20)
+
+    wags           = models.FloatField()
+    optimum_wags   = models.FloatField()
+    shortfall      = models.FloatField()
+    path_error     = models.FloatField()
+    max_debt       = models.FloatField()
+    days_borrowed  = models.IntegerField()
+    clipped_days   = models.IntegerField(null = True)
+    clipped_amount = models.FloatField(null = True)
+
+    fingerprint = models.CharField(max_length = 40)
+
+
+
+""" TASK
+    A piece of work to be done after the fact, off the participant's click
+    (see tasks.py): name is one of the tasks registered there, arguments a
+    JSON list of what to call it with. status goes from "pending" to
+    "running" to "done", or back to "pending" (after run_after) if it fails
+    and has tries left, or to "failed" if it doesn't. error holds the last
+    failure's traceback.
+"""
+class Task(models.Model):
+    name      = models.CharField(max_length = 40)
+    arguments = models.TextField(default = "[]")
+    status    = models.CharField(max_length = 8, default = "pending", db_index = True)
+    attempts  = models.IntegerField(default = 0)
+    run_after = models.DateTimeField(db_index = True)
+    started   = models.DateTimeField(null = True)
+    finished  = models.DateTimeField(null = True)
+    error     = models.TextField(default = "")
+
+
+
+""" PLACEMENT
+    Which shard (see sharding.py) a participant's data lives in, by the
+    shard's name in SHARDS. Only participants placed in a shard have one;
+    everybody else is in the default database. Placements always live in
+    the default database.
+"""
+class Placement(models.Model):
+    user  = models.OneToOneField(User)
+    shard = models.CharField(max_length = 40)
+
+
+
+""" CLAIM
+    Something that only one request, in any worker, gets to do: submit a
+    given trial form, or log in with a given login link. Claiming is
+    inserting a row with the claim's key, and the database only lets one
+    row with each key in, however many workers try at once (the shared
+    cache can't promise that: a directory of files has no atomic add).
+    Claims live in whichever database the request is using, and old ones
+    are cleared out now and then by tasks.py.
+"""
+class Claim(models.Model):
+    key     = models.CharField(max_length = 100, unique = True)
+    created = models.DateTimeField(auto_now_add = True, db_index = True)
+
+
+""" Claims the given key. Returns whether this was the first claim of it. A
+    failed insert is rolled back to a savepoint, so that it doesn't spoil
+    any transaction we're in the middle of. """
+def claim_key(key):
+    using = router.db_for_write(Claim) or "default"
+    point = transaction.savepoint(using = using)
+    try:
+        Claim.objects.using(using).create(key = key)
+    except IntegrityError:
+        transaction.savepoint_rollback(point, using = using)
+        return False
+    return True
+
+
+""" Gives up a claim, so that the key can be claimed again. """
+def release_key(key):
+    using = router.db_for_write(Claim) or "default"
+    Claim.objects.using(using).filter(key = key).delete()
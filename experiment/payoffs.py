@@ -0,0 +1,479 @@
+### PAYOFFS.PY
+###
+### This file holds every food-to-wag function that the experiment knows
+### about, along with the machinery needed to find the optimal way to feed
+### the dog under each of them. Originally the experiment only ever used
+### wags = food^k, and that assumption was baked into both calculate_wags and
+### trial.calculate_optimum. Now each arm of the experiment can be assigned
+### its own payoff by name (see UserProfile.payoff), and everything that
+### needs wags or an optimum looks the payoff up in the registry below.
+
+from math import exp, log
+
+
+##############
+### BUDGET ###
+##############
+
+""" Every trial gives the user an income each day and an interest rate on
+    whatever they carry over to the next day. Rather than working with the
+    interest rates directly, it's handy to work with growth factors: the
+    growth factor for a day is how much a single buck saved on Monday would
+    be worth by that day. Monday's growth factor is therefore always 1.
+
+    interests are given in percents, exactly as they are stored on the
+    TrialAnswer model (strings are fine; they get converted). The returned
+    list has one entry per day of the trial, i.e. one more than interests.
+"""
+def growth_factors(interests):
+    factors = [1.]
+    for interest in interests:
+        factors.append(factors[-1] * (float(interest) / 100. + 1))
+    return factors
+
+
+""" The total wealth of a trial, measured in Monday bucks. That is, the sum
+    of every day's income discounted back to Monday. Any optimal allocation
+    has to spend exactly this much (again, measured in Monday bucks).
+"""
+def wealth(incomes, factors):
+    total = 0.
+    for income, factor in zip(incomes, factors):
+        total += float(income) / factor
+    return total
+
+
+""" How much the user could borrow on a given day against all of their
+    future incomes. This is the same calculation that TrialAnswer.validate
+    and the trial pages have always done; it lives here so that validation
+    and the optimum share a single definition of the budget. Note that rates
+    here are fractions (0.05), not percents.
+"""
+def borrowable(incomes, rates, index):
+    amount = float(incomes[-1])
+    for day in reversed(range(index, len(rates))):
+        amount = amount / (1 + rates[day]) + (incomes[day] if day != index else 0)
+    return amount
+
+
+""" Settles a single day of a trial. Given the money carried over into the
+    day and what the user wants to spend, returns what they actually get to
+    spend and the money they carry into the next day. The amount of cash we
+    can spend today is how much we have physically plus how much we can
+    borrow; if the user wants to spend more than that, they only get to spend
+    that. incomes are floats and rates fractions, as in borrowable.
+"""
+def settle_day(incomes, rates, index, carry_over, response):
+    today_money = carry_over + incomes[index]
+    spendable   = today_money + borrowable(incomes, rates, index)
+    if response > spendable:
+        response = round(spendable, 2)
+    return response, (today_money - response) * (1 + rates[index])
+
+
+""" Settles a user's responses against a trial's budget, exactly the way
+    TrialAnswer.validate does: any day on which the user tried to spend more
+    than they had (plus what they could borrow) is cut back to what they
+    could spend, and whatever's left over is spent on the last day. incomes,
+    interests and responses are as stored on a TrialAnswer (interests in
+    percents). Returns the settled responses, last day included.
+"""
+def settle(incomes, interests, responses):
+
+    # Couple of initial variables. carry_over represents how much money
+    # we have carried from the previous day.
+    carry_over = 0.
+    incomes    = map(float,                     incomes)
+    rates      = map(lambda x: float(x) / 100., interests)
+    responses  = map(float,                     responses)
+
+    for index in range(len(responses)):
+        responses[index], carry_over = settle_day(incomes, rates, index,
+                                                  carry_over, responses[index])
+
+    # Lastly, give the user whatever's left over to spend on the last day.
+    responses.append(round(carry_over + incomes[-1], 2))
+    return responses
+
+
+
+###############
+### PAYOFFS ###
+###############
+
+""" PAYOFF
+    The base class for all food-to-wag functions. Every payoff needs to be
+    able to do three things:
+
+    value    -- Turn an amount of food into a (possibly fractional) number
+                of wags.
+    demand   -- Given a price for wags, say how much food the dog should be
+                fed on a day. Formally this is the amount of food at which the
+                marginal wag equals the price, and never less than zero. The
+                numeric solver only needs this.
+    solve    -- Given the growth factors and the wealth of a trial, find the
+                optimal amount of food for every day. By default this runs
+                the numeric solver, but payoffs with a closed-form solution
+                override closed_form to skip it.
+
+    wags() is the vectorized version of value() that the views use: it
+    takes a whole list of foods and hands back the rounded wags for each.
+    key() identifies the payoff and its parameters; solved optima are cached
+    under it.
+"""
+class Payoff(object):
+    name = None
+
+    def value(self, food):
+        raise NotImplementedError
+
+    def demand(self, price):
+        raise NotImplementedError
+
+    def closed_form(self, factors, total):
+        return None
+
+    def key(self):
+        return (self.name,)
+
+    def wags(self, foods):
+        value = self.value
+        return [round(value(float(food)), 2) for food in foods]
+
+    def solve(self, factors, total):
+        optimum = self.closed_form(factors, total)
+        if optimum is None:
+            optimum = solve_numeric(self, factors, total)
+        return optimum
+
+    def __repr__(self):
+        return "Payoff Object: (%s)" % self.name
+
+
+""" wags = food^k. This is the payoff the experiment has always used. If k is
+    not given, we use helpers.k, which is looked up at call time so that
+    changing helpers.k keeps working the way it always has.
+
+    The closed form follows from the Euler condition: the optimal food on any
+    day is Monday's food times that day's growth factor to the 1/(1-k).
+"""
+class PowerPayoff(Payoff):
+    name = "power"
+
+    def __init__(self, k = None):
+        self.k = k
+
+    def exponent(self):
+        if self.k is not None:
+            return self.k
+        from helpers import k
+        return k
+
+    def key(self):
+        return (self.name, self.exponent())
+
+    def value(self, food):
+        return pow(food, self.exponent())
+
+    def wags(self, foods):
+        k = self.exponent()
+        return [round(pow(float(food), k), 2) for food in foods]
+
+    def demand(self, price):
+        k = self.exponent()
+        return pow(price / k, 1. / (k - 1))
+
+    def closed_form(self, factors, total):
+        power       = 1. / (1 - self.exponent())
+        shape       = [pow(factor, power) for factor in factors]
+        denominator = sum(weight / factor for weight, factor in zip(shape, factors))
+        first       = total / denominator
+        return [first * weight for weight in shape]
+
+
+""" wags = scale * log(1 + food). The +1 keeps an empty bowl at zero wags
+    instead of minus infinity. The Euler condition makes (1 + food) grow with
+    the growth factor, which gives us a closed form.
+"""
+class LogPayoff(Payoff):
+    name = "log"
+
+    def __init__(self, scale = 10.):
+        self.scale = scale
+
+    def key(self):
+        return (self.name, self.scale)
+
+    def value(self, food):
+        return self.scale * log(1 + food)
+
+    def demand(self, price):
+        return max(0., self.scale / price - 1)
+
+    def closed_form(self, factors, total):
+        level = (total + sum(1. / factor for factor in factors)) / len(factors)
+        return [level * factor - 1 for factor in factors]
+
+
+""" Constant absolute risk aversion: wags = (1 - e^(-a * food)) / a. Here the
+    Euler condition says the food grows by log(growth factor) / a each day,
+    so again there's a closed form.
+"""
+class CaraPayoff(Payoff):
+    name = "cara"
+
+    def __init__(self, a = 0.02):
+        self.a = a
+
+    def key(self):
+        return (self.name, self.a)
+
+    def value(self, food):
+        return (1 - exp(-self.a * food)) / self.a
+
+    def demand(self, price):
+        return max(0., -log(price) / self.a)
+
+    def closed_form(self, factors, total):
+        shifts = [log(factor) / self.a for factor in factors]
+        first  = (total - sum(shift / factor for shift, factor in zip(shifts, factors))) / \
+                 sum(1. / factor for factor in factors)
+        return [first + shift for shift in shifts]
+
+
+""" A concave piecewise-linear payoff. The dog wags slopes[0] times per unit
+    of food up to kinks[0], slopes[1] times per unit up to kinks[1], and so
+    on; the last slope applies to everything beyond the last kink. There's no
+    tidy closed form for this one (the optimum sits on the kinks), so it goes
+    through the numeric solver.
+"""
+class PiecewiseLinearPayoff(Payoff):
+    name = "linear"
+
+    def __init__(self, kinks = (60.,), slopes = (0.2, 0.05)):
+        self.kinks  = tuple(float(kink) for kink in kinks)
+        self.slopes = tuple(float(slope) for slope in slopes)
+
+    def key(self):
+        return (self.name, self.kinks, self.slopes)
+
+    def value(self, food):
+        wags  = 0.
+        start = 0.
+        for kink, slope in zip(self.kinks, self.slopes):
+            if food <= kink:
+                return wags + slope * (food - start)
+            wags  += slope * (kink - start)
+            start  = kink
+        return wags + self.slopes[-1] * (food - start)
+
+    def demand(self, price):
+        food = 0.
+        for kink, slope in zip(self.kinks, self.slopes):
+            if slope <= price:
+                return food
+            food = kink
+        if self.slopes[-1] > price:
+            return float("inf")
+        return food
+
+
+
+##############
+### SOLVER ###
+##############
+
+""" The numeric solver. We search for the price of a wag (in Monday bucks) at
+    which the dog's demand, summed over the week, spends exactly the trial's
+    wealth. Spending only ever goes down as the price goes up, so bisection
+    does the trick; we bisect on the log of the price since we have no idea
+    what order of magnitude it lives at.
+
+    Bisection only ever gets us close, and for payoffs with kinks the demand
+    jumps right at the answer. So we finish by mixing the allocations just
+    below and just above the answer so that the budget is hit exactly. For
+    smooth payoffs the two are practically identical anyway.
+
+    Nobody ever eats more than the whole budget, so demand is capped there.
+    Demand is never negative either, so the answer always respects the
+    no-negative-spending rule. Returns the foods and the price; if there's
+    nothing to spend, the price is infinite.
+"""
+def bisect_price(payoff, factors, total, iterations = 50):
+    if total <= 0:
+        return [0.] * len(factors), float("inf")
+    demand = payoff.demand
+    caps   = [total * factor for factor in factors]
+
+    def allocate(price):
+        return [min(demand(price / factor), cap) for factor, cap in zip(factors, caps)]
+
+    def spend(foods):
+        return sum(food / factor for food, factor in zip(foods, factors))
+
+    # Bracket the price first.
+    low, high = 1., 1.
+    while spend(allocate(low))  < total: low  /= 2
+    while spend(allocate(high)) > total: high *= 2
+
+    for iteration in range(iterations):
+        middle = (low * high) ** 0.5
+        if spend(allocate(middle)) > total:
+            low  = middle
+        else:
+            high = middle
+
+    over, under = allocate(low), allocate(high)
+    spent_over, spent_under = spend(over), spend(under)
+    if spent_over == spent_under:
+        return under, high
+    mix = (total - spent_under) / (spent_over - spent_under)
+    return [below + mix * (above - below) for above, below in zip(over, under)], high
+
+
+def solve_numeric(payoff, factors, total, iterations = 50):
+    return bisect_price(payoff, factors, total, iterations)[0]
+
+
+
+###################
+### CONSTRAINTS ###
+###################
+
+""" The closed forms above only know about the budget as a whole. They happily
+    tell the user to spend a negative amount on some day if that's what the
+    Euler condition says, which TrialAnswer.validate would never allow. This
+    solver finds the best allocation the user could actually have made:
+
+    1) No day's food may be negative.
+    2) Whatever is left on the last day gets spent on the last day (the
+       end-of-week settlement), so the budget is spent exactly.
+    3) Optionally, a borrowing limit: the user may never carry more than
+       limit bucks of debt into the next day. With no limit (the default)
+       the user may borrow against every future income, which is exactly
+       what validate allows.
+
+    Without a borrowing limit, the closed form is used whenever it's already
+    non-negative, and otherwise the numeric solver (which clips demand at zero
+    and so satisfies the KKT conditions) takes over.
+
+    With a borrowing limit, we sweep over the days. Starting from the first
+    unsolved day, we try ending a stretch of days on each later day, with the
+    debt limit binding at the end of the stretch (or, for the last day, the
+    budget settling). The stretch that forces the highest price -- i.e. the
+    one where the limit bites hardest -- is the one that actually binds. We
+    keep its foods, carry its savings forward, and carry on from the next day.
+"""
+def solve_constrained(payoff, incomes, interests, limit = None):
+    payoff  = get_payoff(payoff)
+    factors = growth_factors(interests)
+    values  = [float(income) / factor for income, factor in zip(incomes, factors)]
+    days    = len(factors)
+
+    if limit is None:
+        total   = sum(values)
+        optimum = payoff.closed_form(factors, total)
+        if optimum is None or min(optimum) < 0:
+            optimum = solve_numeric(payoff, factors, total)
+        return optimum
+
+    optimum = []
+    start   = 0
+    savings = 0.
+    while start < days:
+        best = None
+        for end in range(start, days):
+            total = savings + sum(values[start:end + 1])
+            if end < days - 1:
+                total += limit / factors[end + 1]
+            foods, price = bisect_price(payoff, factors[start:end + 1], total)
+            if best is None or price >= best[2]:
+                best = (end, foods, price)
+
+        end, foods, price = best
+        savings += sum(values[start:end + 1])
+        savings -= sum(food / factor for food, factor in zip(foods, factors[start:end + 1]))
+        optimum.extend(foods)
+        start = end + 1
+    return optimum
+
+
+
+################
+### REGISTRY ###
+################
+
+""" All of the payoffs, by name. UserProfile.payoff holds one of these names.
+    New payoffs (or new parameterizations of existing ones) get added with
+    register_payoff.
+"""
+PAYOFFS = {}
+
+def register_payoff(payoff, name = None):
+    PAYOFFS[name or payoff.name] = payoff
+    return payoff
+
+register_payoff(PowerPayoff())
+register_payoff(LogPayoff())
+register_payoff(CaraPayoff())
+register_payoff(PiecewiseLinearPayoff())
+
+
+""" Look up a payoff. Accepts a name, a Payoff (handed straight back) or None,
+    which means the experiment's default, wags = food^k.
+"""
+def get_payoff(payoff = None):
+    if payoff is None or payoff == "":
+        return PAYOFFS["power"]
+    if isinstance(payoff, Payoff):
+        return payoff
+    return PAYOFFS[payoff]
+
+
+""" Find the optimal food for every day of a single trial, honoring every
+    constraint validate enforces (and the borrowing limit, if given). incomes
+    and interests are exactly as stored on a TrialAnswer (interests in
+    percents). Returns the foods rounded to cents, as the views show them.
+"""
+def solve_optimum(incomes, interests, payoff = None, limit = None):
+    optimum = solve_constrained(payoff, incomes, interests, limit)
+    return [round(food, 2) for food in optimum]
+
+
+
+#############
+### CACHE ###
+#############
+
+""" The optimum only depends on the trial design and the payoff, and the
+    same designs come up over and over (the training trials are the same
+    for everybody, and most experimental trials only differ in their RAND
+    incomes). So we remember every optimum we've solved, keyed on the
+    design, the payoff's key() and the borrowing limit. The cache is
+    dropped wholesale if it ever gets big; that only costs us re-solving.
+"""
+OPTIMUM_CACHE_SIZE = 10000
+_optimum_cache     = {}
+
+def cached_optimum(incomes, interests, payoff = None, limit = None):
+    payoff = get_payoff(payoff)
+    key    = (tuple(float(income)   for income   in incomes),
+              tuple(float(interest) for interest in interests),
+              payoff.key(), limit)
+    optimum = _optimum_cache.get(key)
+    if optimum is None:
+        if len(_optimum_cache) >= OPTIMUM_CACHE_SIZE:
+            _optimum_cache.clear()
+        optimum = tuple(solve_optimum(incomes, interests, payoff, limit))
+        _optimum_cache[key] = optimum
+    return list(optimum)
+
+
+""" The batch version of cached_optimum: takes a list of (incomes, interests)
+    pairs and solves them all under the same payoff, filling the cache as it
+    goes. Run it over build_trials.build_catalog() to have every fixed design
+    solved before anybody asks for it.
+"""
+def solve_optima(designs, payoff = None, limit = None):
+    payoff = get_payoff(payoff)
+    return [cached_optimum(incomes, interests, payoff, limit) for incomes, interests in designs]
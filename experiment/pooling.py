@@ -0,0 +1,70 @@
+### POOLING.PY
+###
+### Django opens a database connection the first time a request needs one
+### and closes it when the request is over. For SQLite that's nothing more
+### than opening a file, but for PostgreSQL (see DATABASES in settings.py) it
+### means a new server process and a log-in for every click. With
+### CONNECTION_MAX_AGE set, each worker thread keeps its connection open
+### from one request to the next instead, for up to that many seconds:
+###
+### * At the end of every request anything still open on the connection is
+###   rolled back, so that the next request starts clean and the connection
+###   doesn't sit "idle in transaction", holding on to locks.
+### * A connection that has gone bad (the server restarted, say) is closed,
+###   and the next request opens a fresh one.
+###
+### So every worker thread holds one connection, which together make up the
+### pool. PostgreSQL turns away connections beyond its max_connections (100
+### unless it's been raised), so every worker's threads added up have to stay
+### under it: loadtest.py's 4 rooms of 40, for one, need 160. To share a
+### smaller pool between lots of workers (or machines), put pgbouncer in
+### transaction mode in front of PostgreSQL and point HOST and PORT at it.
+### This is turned on as the worker starts (see warmup.start_services).
+
+from   django.conf                import settings
+from   django.core                import signals
+from   django.db                  import connections, close_connection, transaction
+from   django.db.backends.signals import connection_created
+import time
+
+
+def max_age():
+    return getattr(settings, "CONNECTION_MAX_AGE", 0)
+
+
+""" Stops Django from closing the connections after every request, and looks
+    after them ourselves. Safe to call more than once. """
+def keep_connections():
+    if not max_age():
+        return
+    signals.request_finished.disconnect(close_connection)
+    signals.request_finished.connect(release_connections, dispatch_uid = "release_connections")
+    connection_created.connect(stamp_connection, dispatch_uid = "stamp_connection")
+
+
+""" Notes when a connection was opened, so that it can be retired once it's
+    too old. """
+def stamp_connection(sender, connection, **kwargs):
+    connection.opened = time.time()
+
+
+""" Gets this thread's connections ready for the next request: rolls back
+    whatever the request left open, and closes any connection that's broken
+    or past CONNECTION_MAX_AGE. """
+def release_connections(**kwargs):
+    now = time.time()
+    for alias in connections:
+        connection = connections[alias]
+        if connection.connection is None:
+            continue
+        try:
+            transaction.abort(alias)
+            connection._rollback()
+            if now - getattr(connection, "opened", now) < max_age():
+                continue
+        except Exception:
+            pass
+        try:
+            connection.close()
+        except Exception:
+            connection.connection = None
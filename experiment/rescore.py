@@ -0,0 +1,103 @@
+### RESCORE.PY
+###
+### "What would we have paid if k had been 0.4, or b had been 0.02?" This
+### file answers that for every user who has finished the experiment, using
+### the responses they actually gave on their payment trial. Nothing about
+### the users is changed; UserProfile.payment is never touched. Run it from
+### 'python manage.py shell':
+###
+###     from experiment.rescore import rescore, report
+###     report(rescore(ks = [0.3, 0.4, 0.5, 0.6], bs = [0.005, 0.01, 0.02]))
+###
+### Keep in mind that the users' responses stay fixed; only the scoring
+### changes. Only users on the power payoff (wags = food^k) are rescored,
+### since k means nothing to the other payoffs.
+
+from   multiprocessing import Pool, cpu_count
+from   models          import TrialAnswer, UserProfile
+from   payoffs         import PowerPayoff, cached_optimum
+from   helpers         import calculate_payment
+from   simulate        import summarize, histogram
+
+
+""" Loads every finished power-payoff user's payment trial, once. Returns a
+    list of (incomes, interests, responses) tuples, each a list of strings
+    exactly as stored. Everything is read with two queries, from the live
+    database unless told otherwise (an archive, say; see archive.py). """
+def load_recorded(using = "default"):
+    profiles = UserProfile.objects.using(using) \
+                          .filter(finished_experiment = True, payoff = "power") \
+                          .values_list("user", "payment_trial")
+    payment_trials = dict(profiles)
+    answers  = TrialAnswer.objects.using(using).filter(user__in = payment_trials.keys()) \
+                                  .values_list("user", "question", "design__incomes",
+                                               "design__interests", "responses")
+    records  = []
+    for user, question, incomes, interests, responses in answers.iterator():
+        if payment_trials[user] == question:
+            records.append((incomes.split(","), interests.split(","), responses.split(",")))
+    return records
+
+
+""" The recorded trials, as seen by each process in the pool. They're handed
+    over once when the process starts rather than with every task. """
+_records = []
+
+def set_records(records):
+    global _records
+    _records = records
+
+
+""" Scores every recorded trial under a single k, then pays it under every b.
+    The wags only depend on k, so they're worked out once per k; each b is
+    then just the payment formula. Returns {b: payments}. """
+def rescore_k(task):
+    k, bs  = task
+    payoff = PowerPayoff(k)
+    totals = []
+    for incomes, interests, responses in _records:
+        optimum = cached_optimum(incomes, interests, payoff)
+        totals.append((sum(payoff.wags(responses)), sum(payoff.wags(optimum))))
+    return dict((b, [calculate_payment(wags, optimum_wags, b) for wags, optimum_wags in totals])
+                for b in bs)
+
+
+""" Rescores every finished user's payment trial under every combination of
+    ks and bs. Each k is scored in its own process (one per core unless told
+    otherwise; 1 runs everything here). Returns {(k, b): summary}, where each
+    summary is as from simulate.summarize with the histogram added. """
+def rescore(ks, bs, processes = None, records = None):
+    records   = load_recorded() if records is None else records
+    processes = processes or min(cpu_count(), len(ks))
+    tasks     = [(k, bs) for k in ks]
+
+    if processes == 1:
+        set_records(records)
+        results = map(rescore_k, tasks)
+    else:
+        pool    = Pool(processes, initializer = set_records, initargs = (records,))
+        results = pool.map(rescore_k, tasks)
+        pool.close()
+        pool.join()
+
+    grid = {}
+    for k, payments in zip(ks, results):
+        for b in bs:
+            summary              = summarize(payments[b])
+            summary["histogram"] = histogram(payments[b])
+            grid[(k, b)]         = summary
+    return grid
+
+
+""" Prints a grid from rescore in a readable form. """
+def report(grid):
+    print "%-6s %-7s %-8s %-9s %-8s %-8s %-8s %-8s" % ("k", "b", "users", "total", "mean",
+                                                     "p5", "p50", "p95")
+    for (k, b), stats in sorted(grid.items()):
+        if not stats["count"]:
+            print "%-6s %-7s (nobody)" % (k, b)
+            continue
+        percentiles = dict(stats["percentiles"])
+        print "%-6s %-7s %-8i %-9.2f %-8.2f %-8.2f %-8.2f %-8.2f" % (
+            k, b, stats["count"], stats["total"], stats["mean"],
+            percentiles[5], percentiles[50], percentiles[95])
@@ -0,0 +1,42 @@
+### ROUTERS.PY
+###
+### Sends the participants' models to whichever database (see sharding.py)
+### the participant lives in. Django loads this as it starts up, before the
+### models can be imported, so sharding is only imported once it's needed.
+
+from   django.conf import settings
+
+
+class ShardRouter(object):
+
+    """ A participant's model goes to the database of the instance it's
+        being looked up from (a User, or another of the participant's
+        models), or failing that to the thread's current database. Anything
+        else is left to the default database. """
+    def route(self, model, hints):
+        if not getattr(settings, "SHARDS", None):
+            return None
+        import sharding
+        if model._meta.app_label != "experiment" or model._meta.object_name not in sharding.SHARDED:
+            return None
+
+        instance = hints.get("instance")
+        if instance is not None:
+            if instance._meta.object_name == "User":
+                return sharding.database_for(instance)
+            if instance._state.db is not None and instance._meta.object_name in sharding.SHARDED:
+                return instance._state.db
+        return sharding.current()
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    # Users are copied into their shard, so relations hold across databases.
+    def allow_relation(self, first, second, **hints):
+        return True
+
+    def allow_syncdb(self, db, model):
+        return True
@@ -0,0 +1,200 @@
+### SHARDING.PY
+###
+### When several lab rooms run at once, they all write to the same database,
+### and SQLite only lets one of them write at a time. Instead, each room (or
+### study session) can get a shard of its own: a separate SQLite file, named
+### in SHARDS in settings.py, holding everything of its participants' --
+### their UserProfile, TrialAnswers, DiagnosticAnswer, Progress, analytics
+### and so on -- so that the rooms never wait on each other.
+###
+### The User table and the sessions stay in the default database, so logging
+### in works as it always has. Every participant placed in a shard gets a
+### Placement (in the default database) saying which one, and a copy of
+### their User row in the shard so that queries that join on it still work. Anybody without a
+### Placement (staff, and everybody from before shards) lives in the default
+### database, as before. Participants are placed as they're created:
+###
+###     from experiment.builds.create_user import add_user
+###     from experiment.builds.generate    import generate
+###     add_user("room2_07", "password", "static", shard = "room2")
+###     generate(40, prefix = "room3_", shard = "room3")
+###
+### During a request, ShardMiddleware points every query at the logged-in
+### user's database (see ShardRouter in routers.py); elsewhere, say which
+### database to use with use_database. Tools that look at everybody run once
+### per database, all at the same time, with fan_out:
+###
+###     from experiment.analytics import analyze
+###     from experiment.rescore   import load_recorded
+###     from experiment.sharding  import fan_out
+###     fan_out(analyze)
+###     records = sum(fan_out(load_recorded).values(), [])
+
+from   django.conf                import settings
+from   django.contrib.auth.models import User
+from   django.core.management     import call_command
+from   django.db                  import connections
+from   contextlib                 import contextmanager
+import os
+import threading
+
+from   models import Placement
+
+
+# The participants' models, which live in their shard, along with the tasks
+# queued for them. Everything else (users, sessions) lives in the default
+# database.
+SHARDED = ["UserProfile", "TrialDesign", "TrialAnswer", "DiagnosticAnswer",
+           "Progress", "StageCount", "TrialAnalytics", "Task",
+           "Claim"]
+
+# Which database each user's data is in, by user id. Placements never
+# change, so these are kept for good (until there are too many).
+PLACEMENT_CACHE_SIZE = 100000
+_placements          = {}
+
+_local      = threading.local()
+_shard_lock = threading.Lock()
+
+
+
+#################
+### DATABASES ###
+#################
+
+""" The database alias for a shard, which lives in SHARD_DIR. The shard is
+    created (tables and all) if it doesn't exist yet. """
+def open_shard(name):
+    if name not in getattr(settings, "SHARDS", []):
+        raise ValueError("Unknown shard (add it to SHARDS in settings.py): %r" % name)
+    alias = "shard_" + name
+    if alias not in connections.databases:
+        with _shard_lock:
+            if alias not in connections.databases:
+                if not os.path.isdir(settings.SHARD_DIR):
+                    os.makedirs(settings.SHARD_DIR)
+                path = os.path.join(settings.SHARD_DIR, name + ".db")
+                connections.databases[alias] = {"ENGINE": "django.db.backends.sqlite3", "NAME": path,
+                                                "USER": "", "PASSWORD": "", "HOST": "", "PORT": ""}
+                call_command("syncdb", database = alias, interactive = False, verbosity = 0)
+    return alias
+
+
+""" Every database that holds participants: the default one, then each of
+    the shards. """
+def databases():
+    return ["default"] + [open_shard(name) for name in getattr(settings, "SHARDS", [])]
+
+
+""" The database that a user's data lives in (given the User or their id). """
+def database_for(user):
+    user_id = getattr(user, "id", user)
+    alias   = _placements.get(user_id)
+    if alias is None and user_id is not None:
+        shard = Placement.objects.filter(user = user_id).values_list("shard", flat = True)
+        alias = open_shard(shard[0]) if shard else "default"
+        if len(_placements) >= PLACEMENT_CACHE_SIZE:
+            _placements.clear()
+        _placements[user_id] = alias
+    return alias or "default"
+
+
+""" Places users (already saved in the default database) in a shard: copies
+    their User rows over and records the Placements. Bulk inserts, so that
+    the User copies don't set off create_user_profile. Returns the shard's
+    database alias. """
+def place_users(users, shard):
+    alias = open_shard(shard)
+    if users:
+        User.objects.db_manager(alias).bulk_create(list(users))
+        Placement.objects.bulk_create([Placement(user_id = user.id, shard = shard)
+                                       for user in users])
+        for user in users:
+            _placements[user.id] = alias
+    return alias
+
+
+""" Deletes users, and everything of theirs, from wherever it lives. """
+def delete_users(user_ids):
+    for alias in set(database_for(user_id) for user_id in user_ids) - set(["default"]):
+        User.objects.using(alias).filter(id__in = user_ids).delete()
+    User.objects.filter(id__in = user_ids).delete()
+    for user_id in user_ids:
+        _placements.pop(user_id, None)
+
+
+
+###################
+### CURRENT ONE ###
+###################
+
+""" The database that this thread's queries for participants' models go to
+    (None for the default database). """
+def current():
+    return getattr(_local, "alias", None)
+
+def activate(alias):
+    _local.alias = alias
+
+def deactivate():
+    _local.alias = None
+
+
+""" Sends this thread's queries to the given database for a while:
+
+        with use_database(database_for(user)):
+            ...
+"""
+@contextmanager
+def use_database(alias):
+    previous = current()
+    activate(alias)
+    try:
+        yield alias
+    finally:
+        activate(previous)
+
+
+""" Points each request at the logged-in user's database. It goes after
+    AuthenticationMiddleware in MIDDLEWARE_CLASSES. """
+class ShardMiddleware(object):
+    def process_request(self, request):
+        deactivate()
+        if getattr(settings, "SHARDS", None) and request.user.is_authenticated():
+            activate(database_for(request.user))
+
+    def process_response(self, request, response):
+        deactivate()
+        return response
+
+
+
+###############
+### FAN OUT ###
+###############
+
+""" Runs function(*arguments, using = alias) for every database, each in a
+    thread of its own (with its own connection), and returns what each one
+    returned, by alias. The default database's turn is taken in this thread,
+    while the shards' threads run. """
+def fan_out(function, *arguments):
+    results, errors = {}, []
+    def run(alias):
+        try:
+            with use_database(alias):
+                results[alias] = function(*arguments, using = alias)
+        except Exception, error:
+            errors.append(error)
+        finally:
+            if alias != "default":
+                connections[alias].close()
+
+    threads = [threading.Thread(target = run, args = (alias,)) for alias in databases()[1:]]
+    for thread in threads:
+        thread.start()
+    run("default")
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,253 @@
+### SIMULATE.PY
+###
+### Before every study we need to know roughly how much money to bring. This
+### file plays synthetic participants through exactly the same machinery the
+### real ones go through: their trials are built with build_trials, their
+### responses are settled the way TrialAnswer.validate settles them, and they
+### are paid with the same optimum and the same payment formula as the payment
+### page. Run it from 'python manage.py shell':
+###
+###     from experiment.simulate import simulate, report
+###     report(simulate(100000, arms = {("static", "power"): 1,
+###                                      ("dynamic", "power"): 1}))
+###
+### The participants are split into chunks, and the chunks are spread over a
+### pool of processes (one per core unless told otherwise).
+
+from   array           import array
+from   bisect          import bisect
+from   multiprocessing import Pool, cpu_count
+from   random          import Random
+from   payoffs         import get_payoff, cached_optimum, settle, borrowable
+from   helpers         import calculate_payment
+from   builds.build_trials import build_schedule
+from   stats           import percentile
+
+
+##############
+### AGENTS ###
+##############
+
+""" Every synthetic participant follows one of the rules below. Each agent is
+    handed a trial's incomes and interests (as stored on a TrialAnswer), the
+    trial's optimum, and a random number generator, and returns what it would
+    type into the form: one response per day, bar the last, rounded to cents.
+    The form only takes 5 digits, so nobody types more than 999.99.
+"""
+def form_value(food):
+    return min(round(max(food, 0.), 2), 999.99)
+
+
+# Feeds the dog exactly the optimum.
+def optimal_agent(incomes, interests, optimum, rng):
+    return [form_value(food) for food in optimum[:-1]]
+
+
+# Feeds the optimum, give or take 20% on any given day.
+def noisy_agent(incomes, interests, optimum, rng):
+    return [form_value(food * rng.lognormvariate(0, 0.2)) for food in optimum[:-1]]
+
+
+# Spends whatever cash is on hand every day, and never borrows.
+def myopic_agent(incomes, interests, optimum, rng):
+    return [form_value(income) for income in incomes[:-1]]
+
+
+# Splits whatever can be spent evenly over the days that are left.
+def rule_of_thumb_agent(incomes, interests, optimum, rng):
+    incomes    = map(float, incomes)
+    rates      = [float(interest) / 100. for interest in interests]
+    carry_over = 0.
+    responses  = []
+    for index in range(len(incomes) - 1):
+        today_money = carry_over + incomes[index]
+        spendable   = today_money + borrowable(incomes, rates, index)
+        response    = form_value(spendable / (len(incomes) - index))
+        responses.append(response)
+        carry_over  = (today_money - response) * (1 + rates[index])
+    return responses
+
+
+AGENTS = {"optimal":       optimal_agent,
+          "noisy":         noisy_agent,
+          "myopic":        myopic_agent,
+          "rule_of_thumb": rule_of_thumb_agent}
+
+
+
+##################
+### SIMULATION ###
+##################
+
+""" Picks one of the keys of a {key: weight} dictionary, with probability
+    proportional to its weight. The dictionary is turned into a list of keys
+    and cumulative weights once, up front, by cumulate.
+"""
+def cumulate(weights):
+    keys   = sorted(weights)
+    totals = []
+    total  = 0.
+    for key in keys:
+        total += weights[key]
+        totals.append(total)
+    return keys, totals
+
+def pick(rng, keys, totals):
+    return keys[bisect(totals, rng.random() * totals[-1])]
+
+
+""" Simulates count participants. This is what every process in the pool
+    runs. Each participant gets an arm (a user class and a payoff) and an
+    agent, has their schedule built, and is paid for their payment trial.
+    Returns the payments along with the index of each participant's arm and
+    agent, packed into arrays so that they're cheap to send back.
+"""
+def simulate_chunk(task):
+    seed, count, arms, agents, b = task
+    rng                   = Random(seed)
+    arm_keys, arm_totals  = cumulate(arms)
+    agent_keys, agent_totals = cumulate(agents)
+
+    payments      = array("d")
+    arm_indices   = array("B")
+    agent_indices = array("B")
+    for participant in xrange(count):
+        arm        = pick(rng, arm_keys,   arm_totals)
+        agent      = pick(rng, agent_keys, agent_totals)
+        user_class, payoff = arm[0], get_payoff(arm[1])
+
+        # Build their schedule, just as add_user would, and grab the trial
+        # they'll be paid for.
+        trials, payment_trial = build_schedule(user_class, rng.getrandbits(60))
+        problem   = trials[payment_trial]
+        optimum   = cached_optimum(problem.incomes, problem.interests, payoff)
+
+        # Play the trial, settle it, and pay for it.
+        responses = AGENTS[agent](problem.incomes, problem.interests, optimum, rng)
+        responses = settle(problem.incomes, problem.interests, responses)
+        payments.append(calculate_payment(sum(payoff.wags(responses)),
+                                          sum(payoff.wags(optimum)), b))
+        arm_indices.append(arm_keys.index(arm))
+        agent_indices.append(agent_keys.index(agent))
+    return payments, arm_indices, agent_indices
+
+
+""" Simulates a whole study's worth of participants and summarizes what they
+    get paid.
+
+    participants -- How many participants to simulate.
+    arms         -- {(user_class, payoff): weight}. By default half static and
+                    half dynamic, both with the usual payoff.
+    agents       -- {agent name: weight}, names from AGENTS. By default an
+                    even mix of all of them.
+    session_size -- How many participants show up to a session. Participants
+                    are grouped into sessions of this size to estimate what a
+                    session costs.
+    processes    -- How many processes to use. Defaults to one per core; 1
+                    runs everything right here without a pool.
+    seed         -- Everything is derived from this, so the same arguments
+                    always give the same answer.
+    b            -- The payment's scaling parameter.
+"""
+def simulate(participants, arms = None, agents = None, session_size = 40,
+             processes = None, seed = 0, b = 0.01, chunk_size = 20000):
+    arms      = arms   or {("static", "power"): 1, ("dynamic", "power"): 1}
+    agents    = agents or dict((name, 1) for name in AGENTS)
+    processes = processes or cpu_count()
+
+    # Split the participants into chunks, each with its own seed.
+    rng   = Random(seed)
+    tasks = []
+    for start in range(0, participants, chunk_size):
+        count = min(chunk_size, participants - start)
+        tasks.append((rng.getrandbits(60), count, arms, agents, b))
+
+    if processes == 1:
+        results = map(simulate_chunk, tasks)
+    else:
+        pool    = Pool(processes)
+        results = pool.map(simulate_chunk, tasks)
+        pool.close()
+        pool.join()
+
+    payments, arm_indices, agent_indices = array("d"), array("B"), array("B")
+    for chunk_payments, chunk_arms, chunk_agents in results:
+        payments.extend(chunk_payments)
+        arm_indices.extend(chunk_arms)
+        agent_indices.extend(chunk_agents)
+
+    # Summarize everything, then each arm and each agent on their own.
+    arm_keys, agent_keys = sorted(arms), sorted(agents)
+    summary = {"participants": participants,
+               "overall":      summarize(payments),
+               "histogram":    histogram(payments),
+               "sessions":     summarize(session_costs(payments, session_size)),
+               "session_size": session_size,
+               "arms":         {},
+               "agents":       {}}
+    for index, arm in enumerate(arm_keys):
+        chosen = [payment for payment, which in zip(payments, arm_indices) if which == index]
+        summary["arms"][arm] = summarize(chosen)
+    for index, agent in enumerate(agent_keys):
+        chosen = [payment for payment, which in zip(payments, agent_indices) if which == index]
+        summary["agents"][agent] = summarize(chosen)
+    return summary
+
+
+
+###############
+### SUMMARY ###
+###############
+
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+""" Count, mean, standard deviation, extremes and percentiles of a list of
+    payments. """
+def summarize(payments):
+    ordered = sorted(payments)
+    count   = len(ordered)
+    if not count:
+        return {"count": 0}
+    mean     = sum(ordered) / count
+    variance = sum((payment - mean)**2 for payment in ordered) / count
+    return {"count": count, "mean": mean, "sd": variance ** 0.5, "total": sum(ordered),
+            "min":   ordered[0], "max": ordered[-1],
+            "percentiles": [(percent, percentile(ordered, percent)) for percent in PERCENTILES]}
+
+
+""" How many participants got paid each whole number of dollars. """
+def histogram(payments):
+    counts = {}
+    for payment in payments:
+        dollars         = int(payment // 1)
+        counts[dollars] = counts.get(dollars, 0) + 1
+    return sorted(counts.items())
+
+
+""" What each session cost, grouping the participants into sessions in the
+    order they were simulated. A trailing partial session is left out. """
+def session_costs(payments, session_size):
+    return [sum(payments[start:start + session_size])
+            for start in range(0, len(payments) - session_size + 1, session_size)]
+
+
+""" Prints a summary from simulate in a readable form. """
+def report(summary):
+    def line(label, stats):
+        if not stats["count"]:
+            return "%-24s (nobody)" % label
+        percentiles = "  ".join("p%i=%.2f" % pair for pair in stats["percentiles"])
+        return "%-24s n=%-8i mean=%-8.2f sd=%-7.2f %s" % (label, stats["count"], stats["mean"],
+                                                         stats["sd"], percentiles)
+
+    print "Simulated %i participants" % summary["participants"]
+    print line("Per participant", summary["overall"])
+    print line("Per session of %i" % summary["session_size"], summary["sessions"])
+    for arm, stats in sorted(summary["arms"].items()):
+        print line("  %s/%s" % arm, stats)
+    for agent, stats in sorted(summary["agents"].items()):
+        print line("  %s" % agent, stats)
+    print "Payment histogram ($):"
+    for dollars, count in summary["histogram"]:
+        print "  %4i  %i" % (dollars, count)
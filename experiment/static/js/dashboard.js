@@ -0,0 +1,72 @@
+/* Asks the server for url every so often, and hands the answer to show *
+ * (which fills in one of the dashboard's tables).                       */
+function poll(url, interval, show)
+{
+    var request = new XMLHttpRequest();
+    request.onreadystatechange = function() {
+        if (request.readyState != 4) return;
+        if (request.status == 200) show(JSON.parse(request.responseText));
+        setTimeout(function() { poll(url, interval, show); }, interval);
+    };
+    request.open("GET", url, true);
+    request.send();
+}
+
+function poll_progress(url, interval) { poll(url, interval, show_progress); }
+function poll_tasks(url, interval)    { poll(url, interval, show_tasks); }
+function poll_admission(url, interval) { poll(url, interval, show_admission); }
+
+
+/* Fills in the stage counts and the table of unfinished users. Trials *
+ * are counted from 1 for display.                                      */
+function show_progress(data)
+{
+    for (var stage in data.stages) {
+        var cell = document.getElementById("count_" + stage);
+        if (cell) cell.innerHTML = data.stages[stage];
+    }
+
+    var rows = "";
+    for (var index = 0; index < data.users.length; index++) {
+        var user = data.users[index];
+        rows += "<tr><td class=\"data\">" + user.username + "</td>" +
+                "<td class=\"data\">" + user.stage + "</td>" +
+                "<td class=\"data\">" + (user.trial + 1) + "</td>" +
+                "<td class=\"data\">" + user.day + "</td></tr>";
+    }
+    document.getElementById("user_rows").innerHTML = rows;
+}
+
+
+/* Fills in the task counts and the latest failed tasks. Only the last *
+ * line of each traceback is shown.                                     */
+function show_tasks(data)
+{
+    for (var state in data.counts) {
+        var cell = document.getElementById("tasks_" + state);
+        if (cell) cell.innerHTML = data.counts[state];
+    }
+
+    var rows = "";
+    for (var index = 0; index < data.failed.length; index++) {
+        var task  = data.failed[index];
+        var lines = task.error.replace(/\s+$/, "").split("\n");
+        rows += "<tr><td class=\"data\">" + task.name + "</td>" +
+                "<td class=\"data\">" + task.arguments + "</td>" +
+                "<td class=\"data\">" + task.attempts + "</td>" +
+                "<td class=\"data\">" + lines[lines.length - 1] + "</td></tr>";
+    }
+    document.getElementById("task_rows").innerHTML = rows;
+}
+
+
+/* Fills in how this worker's queue for submissions is doing. Nothing's *
+ * shown if admission control is off.                                    */
+function show_admission(data)
+{
+    if (!data) return;
+    for (var name in data) {
+        var cell = document.getElementById("admission_" + name);
+        if (cell) cell.innerHTML = data[name];
+    }
+}
@@ -0,0 +1,14 @@
+### STATS.PY
+###
+### Small bits of arithmetic shared between the simulator and the serving
+### code. This file mustn't import anything of ours: the admission queue
+### (see admission.py) runs in every worker, and workers never need the
+### trial builder or xlrd that the simulator brings along.
+
+
+""" Interpolated percentile of an already-sorted list. """
+def percentile(ordered, percent):
+    position = (len(ordered) - 1) * percent / 100.
+    lower    = int(position)
+    upper    = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
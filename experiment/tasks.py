@@ -0,0 +1,244 @@
+### TASKS.PY
+###
+### Some of what happens when a participant finishes a trial doesn't need to
+### happen before they see the next page: working out their analytics, say,
+### or settling their payment once they're done with the experiment. That
+### work is queued up here instead, as rows of the Task table, so that it
+### survives a restart, and done by a thread in one worker (see
+### warmup.start_services). Every worker starts the thread, but only the one
+### holding the lock on TASK_LOCK works the queue; the others wait on the
+### lock, and the next one takes over if that worker dies. A task that fails is tried again a
+### little later, up to MAX_ATTEMPTS times; the staff dashboard shows how
+### the queue is doing. Done tasks, and old claims (see models.Claim), are
+### cleared out every PURGE_INTERVAL seconds once they're PURGE_AFTER_HOURS
+### old.
+###
+### Tasks can be queued from 'python manage.py shell' too, and the queue can
+### be worked through by hand:
+###
+###     from experiment.tasks import enqueue, work
+###     enqueue("archive", "spring_2026")
+###     work()
+
+from   django.conf       import settings
+from   django.db.models  import F, Q
+from   django.utils      import timezone
+from   datetime          import timedelta
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from   models    import Task, Claim, UserProfile, TrialAnswer
+from   payoffs   import get_payoff, cached_optimum
+from   analytics import analyze_trials
+from   sharding  import databases, use_database
+import helpers
+
+
+# How many times a task is tried before it's marked as failed, and how long
+# to wait before trying again (doubling with every attempt).
+MAX_ATTEMPTS  = 5
+RETRY_DELAY   = 10
+
+# A task that has been running for this long (in seconds) is assumed to have
+# died with its worker, and is handed out again.
+TASK_TIMEOUT  = 10 * 60
+
+# How often (in seconds) the runner clears out done tasks and old claims.
+PURGE_INTERVAL = 60 * 60
+
+logger     = logging.getLogger("experiment.tasks")
+_runner    = None
+_lock_file = None
+
+
+
+#############
+### TASKS ###
+#############
+
+""" Settles a user's payment as soon as they're done with the experiment,
+    so that the payment page only has to read it. This is the same sum that
+    the payment page does. """
+def freeze_payment(user_id):
+    profile      = UserProfile.objects.get(user = user_id)
+    trial_object = TrialAnswer.objects.get(user = user_id, question = profile.payment_trial)
+    payoff       = get_payoff(profile.payoff)
+    optimum      = cached_optimum(trial_object.incomes.split(","),
+                                  trial_object.interests.split(","), payoff)
+    payment      = helpers.calculate_payment(sum(payoff.wags(trial_object.responses.split(","))),
+                                             sum(payoff.wags(optimum)))
+    UserProfile.objects.filter(user = user_id).update(payment = str(payment))
+
+
+""" Works out the analytics for a trial the user has just finished. """
+def analyze_trial(trial_id):
+    analyze_trials([trial_id])
+
+
+""" Moves a finished study's participants into its archive. (archive.py
+    needs helpers, which needs this file, hence the late import.) """
+def archive_study(study):
+    from archive import archive
+    archive(study)
+
+
+TASKS = {"freeze_payment": freeze_payment,
+         "analyze_trial":  analyze_trial,
+         "archive":        archive_study}
+
+
+def register_task(name, function):
+    TASKS[name] = function
+
+
+
+#############
+### QUEUE ###
+#############
+
+""" Queues up a task, to be run with the given arguments (which must be
+    JSON-friendly) as soon as a worker gets to it. Every database (see
+    sharding.py) has a queue of its own, and the task goes in the current
+    one, which is where it runs. """
+def enqueue(name, *arguments):
+    if name not in TASKS:
+        raise ValueError("Unknown task: %s" % name)
+    return Task.objects.create(name = name, arguments = json.dumps(arguments),
+                               run_after = timezone.now())
+
+
+""" Takes the next task that's ready to run, if there is one. A task only
+    goes to whoever manages to flip its status, so several workers can share
+    the queue. """
+def claim():
+    now   = timezone.now()
+    ready = Task.objects.filter(Q(status = "pending", run_after__lte = now) |
+                                Q(status = "running", started__lt = now - timedelta(seconds = TASK_TIMEOUT)))
+    for task in ready.order_by("run_after", "id")[:10]:
+        claimed = Task.objects.filter(id = task.id, status = task.status, attempts = task.attempts) \
+                              .update(status = "running", started = now, attempts = F("attempts") + 1)
+        if claimed:
+            return Task.objects.get(id = task.id)
+    return None
+
+
+""" Runs a claimed task, and records how it went. """
+def run_task(task):
+    try:
+        TASKS[task.name](*json.loads(task.arguments))
+    except Exception:
+        task.error = traceback.format_exc()
+        if task.attempts < MAX_ATTEMPTS:
+            task.status    = "pending"
+            task.run_after = timezone.now() + timedelta(seconds = RETRY_DELAY * 2 ** (task.attempts - 1))
+        else:
+            task.status    = "failed"
+    else:
+        task.status = "done"
+    task.finished = timezone.now()
+    task.save()
+    return task.status == "done"
+
+
+""" Runs tasks until there are none ready (or until limit have been run),
+    going through every database's queue in turn. Returns how many were run. """
+def work(limit = None):
+    count = 0
+    for alias in databases():
+        with use_database(alias):
+            while limit is None or count < limit:
+                task = claim()
+                if task is None:
+                    break
+                run_task(task)
+                count += 1
+    return count
+
+
+""" How the queues are doing: how many tasks there are of each status, and
+    the latest failures. """
+def status(failures = 20):
+    counts = dict((state, 0) for state in ["pending", "running", "done", "failed"])
+    failed = []
+    for alias in databases():
+        for state in counts:
+            counts[state] += Task.objects.using(alias).filter(status = state).count()
+        failed.extend(Task.objects.using(alias).filter(status = "failed").order_by("-finished")
+                                  .values("id", "name", "arguments", "attempts", "error", "finished")[:failures])
+    failed.sort(key = lambda task: task["finished"], reverse = True)
+    for task in failed:
+        del task["finished"]
+    return {"counts": counts, "failed": failed[:failures]}
+
+
+""" Deletes the tasks that finished, and the claims that were made, more
+    than hours (by default PURGE_AFTER_HOURS) ago, from every database.
+    Failed tasks are kept, for somebody to look at. Returns how many tasks
+    and claims were deleted. """
+def purge(hours = None):
+    if hours is None:
+        hours = getattr(settings, "PURGE_AFTER_HOURS", 48)
+    cutoff = timezone.now() - timedelta(hours = hours)
+    tasks, claims = 0, 0
+    for alias in databases():
+        done    = Task.objects.using(alias).filter(status = "done", finished__lt = cutoff)
+        old     = Claim.objects.using(alias).filter(created__lt = cutoff)
+        tasks  += done.count()
+        claims += old.count()
+        done.delete()
+        old.delete()
+    return {"tasks": tasks, "claims": claims}
+
+
+
+##############
+### RUNNER ###
+##############
+
+""" Starts this worker's task thread, which waits until this is the worker
+    running tasks, then works through the queue and checks back every
+    TASK_INTERVAL seconds. """
+def start():
+    global _runner
+    if _runner is None:
+        _runner        = threading.Thread(target = run)
+        _runner.daemon = True
+        _runner.start()
+
+
+def run():
+    hold_lock()
+    purged = 0
+    while True:
+        try:
+            work()
+            if time.time() - purged > PURGE_INTERVAL:
+                purge()
+                purged = time.time()
+        except Exception:
+            logger.exception("Working through the task queue failed; trying again.")
+        time.sleep(settings.TASK_INTERVAL)
+
+
+""" Waits until this process holds the lock on TASK_LOCK, which it then
+    keeps until it exits. Without the lock file (or fcntl, which Windows
+    doesn't have), every worker runs tasks, as they can share the queue. """
+def hold_lock():
+    global _lock_file
+    path = getattr(settings, "TASK_LOCK", None)
+    if not path or fcntl is None:
+        return
+    _lock_file = open(path, "a")
+    fcntl.flock(_lock_file.fileno(), fcntl.LOCK_EX)
+    _lock_file.truncate(0)
+    _lock_file.write("%i\n" % os.getpid())
+    _lock_file.flush()
@@ -14,3 +14,1271 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+from payoffs import PAYOFFS, growth_factors, wealth, solve_numeric, solve_optimum
+
+
+class PayoffTest(TestCase):
+    incomes   = [100, 150, 80, 120, 90, 60, 110]
+    interests = [5, 10, -5, 3, 20, 2]
+
+    def test_optimum_spends_the_budget(self):
+        """
+        Every payoff's optimum spends exactly the trial's wealth.
+        """
+        factors = growth_factors(self.interests)
+        total   = wealth(self.incomes, factors)
+        for name, payoff in PAYOFFS.items():
+            optimum = payoff.solve(factors, total)
+            spent   = sum(food / factor for food, factor in zip(optimum, factors))
+            self.assertAlmostEqual(spent, total, places = 6, msg = name)
+
+    def test_closed_forms_match_numeric_solver(self):
+        """
+        Where there's a closed form, the numeric solver agrees with it.
+        """
+        factors = growth_factors(self.interests)
+        total   = wealth(self.incomes, factors)
+        for name, payoff in PAYOFFS.items():
+            closed = payoff.closed_form(factors, total)
+            if closed is None:
+                continue
+            numeric = solve_numeric(payoff, factors, total)
+            for expected, found in zip(closed, numeric):
+                self.assertAlmostEqual(expected, found, places = 6, msg = name)
+
+    def test_power_optimum_two_days(self):
+        """
+        With wags = food^0.5 and 10% interest, Tuesday's food is 1.1^2 times
+        Monday's, and the two together exhaust the budget.
+        """
+        self.assertEqual(solve_optimum(["100", "100"], ["10"]), [90.91, 110.0])
+
+
+from payoffs import CaraPayoff, cached_optimum
+
+
+class ConstrainedOptimumTest(TestCase):
+
+    def test_never_spends_negative(self):
+        """
+        A flat CARA payoff's closed form wants negative food on Monday when
+        interest is high; the constrained optimum feeds nothing instead, and
+        still spends the whole budget.
+        """
+        payoff  = CaraPayoff(a = 0.01)
+        factors = growth_factors([100, 100])
+        optimum = solve_optimum([10, 10, 10], [100, 100], payoff)
+        self.assertTrue(min(payoff.closed_form(factors, 17.5)) < 0)
+        self.assertEqual(optimum[0], 0.)
+        self.assertAlmostEqual(optimum[1] / 2. + optimum[2] / 4., 17.5, places = 1)
+
+    def test_borrowing_limit(self):
+        """
+        With no borrowing allowed, nothing can be spent before the first
+        income arrives; the rest follows the usual Euler condition.
+        """
+        self.assertEqual(solve_optimum([0, 0, 100], [0, 0], limit = 0), [0., 0., 100.])
+        self.assertEqual(solve_optimum([0, 100, 100], [0, 0], limit = 0), [0., 100., 100.])
+        self.assertEqual(solve_optimum([0, 100, 100], [0, 0]), [66.67, 66.67, 66.67])
+
+    def test_cache(self):
+        """
+        The cached optimum matches a fresh solve and can't be modified by
+        whoever asked for it.
+        """
+        optimum = cached_optimum(["50", "50"], ["0"])
+        optimum.append(0)
+        self.assertEqual(cached_optimum([50, 50], [0]), solve_optimum([50, 50], [0]))
+
+
+from builds.build_trials import build_schedule, participant_seed
+
+
+class ScheduleTest(TestCase):
+
+    def test_seed_rebuilds_schedule(self):
+        """
+        The same seed always gives the same trials, RAND incomes and
+        payment trial; different seeds (almost surely) don't.
+        """
+        def flatten(schedule):
+            trials, payment_trial = schedule
+            return [(trial.get_incomes(), trial.get_interests()) for trial in trials], payment_trial
+
+        for user_class, length in [("static", 17), ("dynamic", 5)]:
+            first  = flatten(build_schedule(user_class, 1234))
+            second = flatten(build_schedule(user_class, 1234))
+            self.assertEqual(first, second)
+            self.assertEqual(len(first[0]), length)
+        self.assertNotEqual(flatten(build_schedule("static", 1)),
+                            flatten(build_schedule("static", 2)))
+
+    def test_study_seed(self):
+        """
+        A participant's seed depends only on the study seed and username.
+        """
+        self.assertEqual(participant_seed("alice", 7), participant_seed("alice", 7))
+        self.assertNotEqual(participant_seed("alice", 7), participant_seed("bob", 7))
+        self.assertTrue(participant_seed("alice", 7) < 2**60)
+
+    def test_add_user_stores_seed(self):
+        """
+        Provisioning a user stores their seed, and their TrialAnswers can be
+        rebuilt from it.
+        """
+        from builds.create_user import add_user
+        from models import TrialAnswer
+        user    = add_user("seeded", "password", "dynamic", seed = 42)
+        profile = user.get_profile()
+        trials, payment_trial = build_schedule("dynamic", profile.seed)
+        stored  = TrialAnswer.objects.filter(user = user).order_by("question")
+        self.assertEqual(profile.payment_trial, payment_trial)
+        self.assertEqual([(answer.incomes, answer.interests) for answer in stored],
+                         [(trial.get_incomes(), trial.get_interests()) for trial in trials])
+
+
+from simulate import simulate
+
+
+class SimulateTest(TestCase):
+
+    def test_optimal_agents_earn_full_payment(self):
+        """
+        Participants who feed the optimum lose nothing, and the same seed
+        gives the same simulation.
+        """
+        summary = simulate(50, agents = {"optimal": 1}, processes = 1, seed = 3)
+        self.assertEqual(summary["overall"]["min"], 40.)
+        self.assertEqual(summary["overall"]["max"], 40.)
+
+        first  = simulate(50, session_size = 10, processes = 1, seed = 3)
+        second = simulate(50, session_size = 10, processes = 1, seed = 3)
+        self.assertEqual(first["histogram"], second["histogram"])
+        self.assertEqual(first["sessions"]["count"], 5)
+
+
+from django.contrib.auth.models import User
+from models  import TrialAnswer, UserProfile
+from payoffs import settle
+
+
+""" Makes a bare user of the given class, without any trials. """
+def make_user(username, user_class = "static"):
+    user = User.objects.create_user(username, "fake@fake.com", "password")
+    profile, created   = UserProfile.objects.get_or_create(user = user, defaults = {"payment_trial": 0})
+    profile.user_class = user_class
+    profile.save()
+    return User.objects.get(pk = user.pk)
+
+
+class CheckpointTest(TestCase):
+
+    def test_checkpoint_matches_settle(self):
+        """
+        Answering a dynamic trial a day at a time keeps a checkpoint that
+        agrees with settling the whole week, overspending included.
+        """
+        user = make_user("checkpoint", "dynamic")
+
+        trial_object = TrialAnswer.objects.create(user = user, question = 0,
+                                                  incomes = "100,0,0,50",
+                                                  interests = "10,0,20")
+        expected = settle(["100", "0", "0", "50"], ["10", "0", "20"],
+                          ["40", "500", "10"])
+        for response in ["40", "500", "10"]:
+            trial_object.add_response(user, [response])
+        self.assertEqual(trial_object.checkpoint_day, 3)
+        self.assertEqual(trial_object.discounted_income, None)
+
+        trial_object.validate()
+        self.assertEqual(trial_object.responses, ",".join(map(str, expected)))
+
+    def test_budget_without_checkpoint(self):
+        """
+        Trials stored before checkpoints existed still get the right budget.
+        """
+        from helpers import calculate_budget
+        user = make_user("legacy", "dynamic")
+        trial_object = TrialAnswer.objects.create(user = user, question = 0,
+                                                  incomes = "100,0,0,50",
+                                                  interests = "10,0,20",
+                                                  responses = "40")
+        self.assertEqual(calculate_budget(trial_object, 1), (66.0, 41.67))
+
+
+import json
+from django.core.cache  import cache
+from django.test.client import Client
+
+
+class DashboardTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_follow_users(self):
+        """
+        Finishing the training moves a user from the training count to the
+        experiment count, and the dashboard reports it.
+        """
+        from builds.create_user import add_user
+        add_user("participant", "password", "static", seed = 5)
+
+        client = Client()
+        client.login(username = "participant", password = "password")
+        for trial in range(2):
+            client.post("/training/", {"Monday": "50", "Tuesday": "50",
+                                       "Wednesday": "50", "Thursday": "50"})
+
+        staff = User.objects.create_user("staff", "fake@fake.com", "password")
+        staff.is_staff = True
+        staff.save()
+        client = Client()
+        client.login(username = "staff", password = "password")
+        data = json.loads(client.get("/dashboard/progress/").content)
+        self.assertEqual(data["stages"]["training"], 0)
+        self.assertEqual(data["stages"]["experiment"], 1)
+        self.assertEqual(data["users"], [{"username": "participant", "stage": "experiment",
+                                          "trial": 2, "day": "Monday"}])
+
+    def test_overwritten_users_leave_the_counts(self):
+        """
+        Overwriting a user takes the old one out of the counts, so that
+        only the new one is counted.
+        """
+        from builds import create_user
+        create_user.add_user("again", "password", "static", seed = 5)
+        create_user.raw_input = lambda prompt: "yes"
+        try:
+            create_user.add_user("again", "password", "static", seed = 6)
+        finally:
+            del create_user.raw_input
+        self.assertEqual(StageCount.objects.get(stage = "training").count, 1)
+
+    def test_staff_only(self):
+        """
+        Participants can't see the dashboard.
+        """
+        make_user("nosy")
+        client = Client()
+        client.login(username = "nosy", password = "password")
+        self.assertEqual(client.get("/dashboard/progress/").status_code, 302)
+
+
+from analytics import analyze
+from models    import TrialAnalytics
+
+
+class AnalyticsTest(TestCase):
+
+    def test_incremental_analysis(self):
+        """
+        Completed trials get analyzed once; only changed trials are redone.
+        """
+        user = make_user("analyzed", "static")
+        done = TrialAnswer.objects.create(user = user, question = 0, incomes = "100,0,0",
+                                          interests = "0,0", responses = "500,10")
+        done.validate()
+        TrialAnswer.objects.create(user = user, question = 1, incomes = "100,0,0",
+                                   interests = "0,0", responses = "")
+
+        self.assertEqual(analyze(), {"created": 1, "updated": 0, "unchanged": 0, "skipped": 0})
+        row = TrialAnalytics.objects.get(trial = done)
+        self.assertEqual((row.clipped_days, row.clipped_amount), (2, 410.))
+        self.assertEqual((row.days_borrowed, row.max_debt), (0, 0.))
+        self.assertAlmostEqual(row.shortfall, 3 * (100 / 3.)**0.5 - 10, places = 1)
+        self.assertEqual(analyze()["unchanged"], 1)
+
+        done.responses = "50,50,0"
+        done.save()
+        self.assertEqual(analyze()["updated"], 1)
+        self.assertEqual(TrialAnalytics.objects.get(trial = done).days_borrowed, 0)
+
+
+from rescore import rescore
+
+
+class RescoreTest(TestCase):
+
+    def test_rescore_grid(self):
+        """
+        Rescoring with today's k and b gives today's payment; a bigger b
+        costs more for the same shortfall. Nobody's payment is touched.
+        """
+        user    = make_user("rescored", "static")
+        profile = user.get_profile()
+        profile.finished_experiment, profile.payment_trial = True, 2
+        profile.save()
+        TrialAnswer.objects.create(user = user, question = 2, incomes = "100,0,0",
+                                   interests = "0,0", responses = "100,0,0")
+
+        grid   = rescore([0.5], [0.01, 0.02], processes = 1)
+        wags   = 10.
+        best   = 3 * round((100 / 3.)**0.5, 2)
+        self.assertEqual(grid[(0.5, 0.01)]["mean"], round(40 - 0.01 * (best - wags)**2, 2))
+        self.assertEqual(grid[(0.5, 0.02)]["mean"], round(40 - 0.02 * (best - wags)**2, 2))
+        self.assertEqual(UserProfile.objects.get(user = user).payment, 0)
+
+
+
+from caching import user_state, user_trial, warm_user, invalidate_user, design_info
+import caching
+import time
+
+
+class DeadCache(object):
+    """
+    A cache whose server is down: nothing is ever stored.
+    """
+    def get(self, key, default = None):
+        return default
+    def add(self, key, value, timeout = None):
+        return False
+    def set(self, key, value, timeout = None):
+        pass
+    def delete(self, key):
+        pass
+    def incr(self, key, delta = 1):
+        raise ValueError("Key '%s' not found" % key)
+
+
+class CachingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_user_state_invalidation(self):
+        """
+        A user's cached state is served until something is written for them.
+        """
+        user = make_user("cached", "static")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "50,50",
+                                   interests = "0")
+        profile, trial_object = user_state(user)
+        self.assertEqual((profile.trials_done, trial_object.question), (0, 0))
+
+        UserProfile.objects.filter(user = user).update(trials_done = 1)
+        self.assertEqual(user_state(user)[0].trials_done, 0)
+        invalidate_user(user)
+        self.assertEqual(user_state(user), (UserProfile.objects.get(user = user), None))
+
+    def test_design_info(self):
+        """
+        Design computations come back the same from the cache.
+        """
+        first = design_info(["100", "100"], ["10"])
+        self.assertEqual(first["optimum"], [90.91, 110.0])
+        self.assertEqual(design_info([100, 100], [10]), first)
+
+    def test_warm_user(self):
+        """
+        Once a user is warmed up, their trials are served without the database.
+        """
+        user = make_user("warmed", "static")
+        for question in range(3):
+            TrialAnswer.objects.create(user = user, question = question,
+                                       incomes = "100,100", interests = "10")
+        warm_user(user)
+        with self.assertNumQueries(0):
+            self.assertEqual(user_trial(user, 2).question, 2)
+            self.assertEqual(user_trial(user, 5), None)
+            self.assertEqual(user_state(user)[1].question, 0)
+            info = design_info(["100", "100"], ["10"])
+        self.assertAlmostEqual(info["borrowable"][0], 100 / 1.1)
+
+    def test_dead_cache(self):
+        """
+        With the cache down, everything comes from the database, without
+        waiting on locks that nobody holds.
+        """
+        user = make_user("uncached", "static")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "100,100",
+                                   interests = "10")
+        caching.cache = DeadCache()
+        try:
+            start = time.time()
+            self.assertEqual(user_state(user)[1].question, 0)
+            self.assertEqual(design_info(["100", "100"], ["10"])["optimum"], [90.91, 110.0])
+            invalidate_user(user)
+            self.assertTrue(time.time() - start < caching.LOCK_WAIT)
+        finally:
+            caching.cache = cache
+
+
+import logging
+import os
+import tasks
+import warmup
+import writebehind
+
+
+class WarmupTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        warmup.READY   = False
+        warmup.FAILURE = None
+
+    def tearDown(self):
+        warmup.READY   = False
+        warmup.FAILURE = None
+
+    def test_ready_after_warm_up(self):
+        """
+        A worker only reports ready once it has been warmed up.
+        """
+        client = Client()
+        self.assertEqual(client.get("/ready/").status_code, 503)
+        user   = make_user("warming", "static")
+        for question in range(2):
+            TrialAnswer.objects.create(user = user, question = question,
+                                       incomes = "100,100", interests = "10")
+        counts = warmup.warm_up()
+        self.assertEqual(counts["designs"], 1)
+        self.assertTrue(counts["templates"] > 0)
+        self.assertEqual(client.get("/ready/").status_code, 200)
+
+    def test_services_start_without_warming_up(self):
+        """
+        The task runner starts whether or not the worker is warmed up, and a
+        service that can't start doesn't stop the others.
+        """
+        started = []
+        def broken():
+            raise IOError("no journal")
+        saved = tasks.start, writebehind.start
+        tasks.start, writebehind.start = lambda: started.append("tasks"), broken
+        logger = logging.getLogger("experiment.warmup")
+        logger.disabled = True
+        try:
+            # Kept connections would be rolled back after every request, and
+            # the other tests' data with them.
+            with self.settings(TASK_RUNNER = True, WRITE_BEHIND = True, MEMORY_INTERVAL = 0,
+                               CONNECTION_MAX_AGE = 0):
+                warmup.start_services()
+        finally:
+            tasks.start, writebehind.start = saved
+            logger.disabled = False
+        self.assertEqual(started, ["tasks"])
+        self.assertFalse(warmup.READY)
+
+    def test_failed_warm_up_is_never_ready(self):
+        """
+        If warming up fails, the worker stays not ready, and says why.
+        """
+        directory = warmup.TEMPLATE_DIR
+        warmup.TEMPLATE_DIR = os.path.join(directory, "missing")
+        logger = logging.getLogger("experiment.warmup")
+        logger.disabled = True
+        try:
+            warmup.warm_up_or_log()
+        finally:
+            warmup.TEMPLATE_DIR = directory
+            logger.disabled = False
+        self.assertFalse(warmup.READY)
+        self.assertTrue("OSError" in warmup.FAILURE)
+        response = Client().get("/ready/")
+        self.assertEqual((response.status_code, response.content), (503, "warm-up failed"))
+
+
+from trials import Trial, trial_for
+import helpers
+
+
+class TrialTest(TestCase):
+
+    def test_trial_is_fixed(self):
+        """
+        Trials can't be changed, and their optimum is the cached one.
+        """
+        problem = Trial(["100", "100", "0"], ["10", "0"])
+        self.assertEqual(problem.days, ("Monday", "Tuesday", "Wednesday"))
+        self.assertEqual(problem.factors, [1., 1.1, 1.1])
+        self.assertRaises(AttributeError, setattr, problem, "incomes", ())
+        self.assertEqual(problem.calculate_optimum(), problem.calculate_optimum())
+        self.assertEqual(problem.calculate_optimum(),
+                         cached_optimum(problem.incomes, problem.interests))
+
+    def test_optimum_follows_k(self):
+        """
+        Changing the exponent changes a trial's optimum, even once the trial
+        has been used.
+        """
+        problem = Trial(["100", "0"], ["50"])
+        before  = problem.calculate_optimum()
+        saved   = helpers.k
+        helpers.k = 0.9
+        try:
+            after = problem.calculate_optimum()
+        finally:
+            helpers.k = saved
+        self.assertNotEqual(before, after)
+        self.assertEqual(problem.calculate_optimum(), before)
+
+    def test_trial_for(self):
+        """
+        Answers with the same design share the same Trial.
+        """
+        first  = TrialAnswer(incomes = "50,60", interests = "5")
+        second = TrialAnswer(incomes = "50,60", interests = "5")
+        self.assertTrue(trial_for(first) is trial_for(second))
+        self.assertEqual(trial_for(first).incomes, ("50", "60"))
+
+
+from django.db import DatabaseError, connection, transaction
+from caching   import claim_submission, finish_submission
+from helpers   import process_input, record_submission
+from models    import Claim
+import views
+
+
+class SubmissionTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_repeat_submission(self):
+        """
+        Submitting the same form twice only records the responses once.
+        """
+        user = make_user("clicker", "dynamic")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "100,0,0",
+                                   interests = "0,0")
+        client = Client()
+        client.login(username = "clicker", password = "password")
+
+        data = {"Monday": "30", "token": "a" * 32}
+        for attempt in range(2):
+            response = client.post("/training/", data)
+            self.assertEqual(response["Location"], "http://testserver/training/")
+        self.assertEqual(TrialAnswer.objects.get(user = user).responses, "30")
+        self.assertEqual(UserProfile.objects.get(user = user).day, "Tuesday")
+
+    def test_repeats_skip_the_database(self):
+        """
+        A repeat that the cache knows about is answered without a query.
+        """
+        user = make_user("clicker", "dynamic")
+        self.assertEqual(claim_submission(user, "d" * 32), None)
+        finish_submission(user, "d" * 32, "/training/review/")
+        with self.assertNumQueries(0):
+            self.assertEqual(claim_submission(user, "d" * 32), "/training/review/")
+        self.assertEqual(Claim.objects.count(), 1)
+
+    def test_claims_outlive_the_cache(self):
+        """
+        A form's token is claimed in the database, so a repeat is still
+        caught when the cache has lost track of it.
+        """
+        user = make_user("clicker", "dynamic")
+        self.assertEqual(claim_submission(user, "b" * 32), None)
+        cache.clear()
+        self.assertEqual(claim_submission(user, "b" * 32), "")
+        self.assertEqual(Claim.objects.count(), 1)
+
+    def test_failed_submission_can_be_retried(self):
+        """
+        A submission that fails to be recorded gives up its token, so that
+        submitting the form again records it.
+        """
+        user = make_user("clicker", "dynamic")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "100,0,0",
+                                   interests = "0,0")
+        client = Client()
+        client.login(username = "clicker", password = "password")
+
+        def locked(*arguments):
+            raise DatabaseError("database is locked")
+        data = {"Monday": "30", "token": "c" * 32}
+        views.process_input = locked
+        try:
+            self.assertRaises(DatabaseError, client.post, "/training/", data)
+        finally:
+            views.process_input = process_input
+        self.assertEqual(Claim.objects.count(), 0)
+        client.post("/training/", data)
+        self.assertEqual(TrialAnswer.objects.get(user = user).responses, "30")
+
+    def test_submission_locks_the_profile(self):
+        """
+        A submission reads the user's profile with its row locked (FOR
+        UPDATE, on databases that lock rows) before anything else, and
+        stores the responses in the same transaction.
+        """
+        user = make_user("clicker", "dynamic")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "100,0,0",
+                                   interests = "0,0")
+        debug = connection.use_debug_cursor
+        start = len(connection.queries)
+        connection.use_debug_cursor = True
+        try:
+            transaction.commit_on_success()(record_submission)(user, ["30"])
+        finally:
+            connection.use_debug_cursor = debug
+        first = connection.queries[start]["sql"]
+        self.assertTrue(first.startswith("SELECT") and "experiment_userprofile" in first)
+        self.assertEqual(first.endswith("FOR UPDATE"), connection.features.has_select_for_update)
+        self.assertEqual(TrialAnswer.objects.get(user = user).responses, "30")
+        self.assertEqual(UserProfile.objects.get(user = user).day, "Tuesday")
+
+
+from django.db   import connections
+from django.test import TransactionTestCase
+import pooling
+
+
+class PoolingTest(TransactionTestCase):
+
+    # connection is only a proxy, so what's put on it is taken off the real one.
+    def tearDown(self):
+        for name in ["close", "_rollback", "opened"]:
+            if name in connections["default"].__dict__:
+                delattr(connections["default"], name)
+
+    def test_release_rolls_back(self):
+        """
+        Whatever a request leaves open is rolled back once it's over, and the
+        connection is kept for the next request.
+        """
+        with self.settings(CONNECTION_MAX_AGE = 60):
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            Claim.objects.create(key = "left open")
+            pooling.release_connections()
+        self.assertFalse(transaction.is_managed())
+        self.assertTrue(connection.connection is not None)
+        self.assertFalse(Claim.objects.filter(key = "left open").exists())
+
+    def test_release_retires_connections(self):
+        """
+        Connections are closed once they're older than CONNECTION_MAX_AGE, or
+        as soon as they fail.
+        """
+        closed = []
+        connection.close = lambda: closed.append(True)
+        Claim.objects.count()
+        with self.settings(CONNECTION_MAX_AGE = 60):
+            connection.opened = time.time() - 30
+            pooling.release_connections()
+            self.assertEqual(closed, [])
+
+            connection.opened = time.time() - 90
+            pooling.release_connections()
+            self.assertEqual(closed, [True])
+
+            def broken():
+                raise DatabaseError("server closed the connection unexpectedly")
+            connection.opened    = time.time()
+            connection._rollback = broken
+            pooling.release_connections()
+            self.assertEqual(closed, [True, True])
+
+
+import os
+import shutil
+import tempfile
+import writebehind
+
+
+class WriteBehindTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.journal = tempfile.mkdtemp()
+        self.user    = make_user("hasty", "dynamic")
+        TrialAnswer.objects.create(user = self.user, question = 0, incomes = "100,0,0,0",
+                                   interests = "0,0,0")
+
+    def tearDown(self):
+        writebehind.stop()
+        if writebehind._journal is not None:
+            writebehind._journal.close()
+            writebehind._journal = None
+        del writebehind._queue[:]
+        shutil.rmtree(self.journal)
+
+    def test_reads_see_queued_writes(self):
+        """
+        A queued submission is seen right away, and written with the next
+        batch exactly as it would have been written straight away. The first
+        submission starts the writer, whether or not the worker was warmed up.
+        """
+        with self.settings(WRITE_BEHIND = True, WRITE_BEHIND_JOURNAL = self.journal,
+                           WRITE_BEHIND_INTERVAL = 60):
+            self.assertEqual(writebehind._flusher, None)
+            client = Client()
+            client.login(username = "hasty", password = "password")
+            client.post("/training/", {"Monday": "30"})
+            client.post("/training/", {"Tuesday": "20"})
+            self.assertTrue(writebehind._flusher.is_alive())
+
+            profile, trial_object = user_state(self.user)
+            self.assertEqual((profile.day, trial_object.responses), ("Wednesday", "30,20"))
+            self.assertEqual(TrialAnswer.objects.get(user = self.user).responses, "")
+            self.assertEqual(len(writebehind.pending_entries(self.user.id)), 2)
+
+            self.assertEqual(writebehind.flush(), 2)
+            self.assertEqual(writebehind.pending_entries(self.user.id), [])
+            self.assertEqual(TrialAnswer.objects.get(user = self.user).responses, "30,20")
+            self.assertEqual(UserProfile.objects.get(user = self.user).day, "Wednesday")
+            self.assertEqual(os.path.getsize(writebehind._journal.name), 0)
+
+    def test_cache_can_forget(self):
+        """
+        If the cache forgets a user before their submissions are written, the
+        submissions are read back from the journal.
+        """
+        with self.settings(WRITE_BEHIND = True, WRITE_BEHIND_JOURNAL = self.journal,
+                           WRITE_BEHIND_INTERVAL = 60):
+            client = Client()
+            client.login(username = "hasty", password = "password")
+            client.post("/training/", {"Monday": "30"})
+            client.post("/training/", {"Tuesday": "20"})
+            cache.clear()
+
+            profile, trial_object = user_state(self.user)
+            self.assertEqual((profile.day, trial_object.responses), ("Wednesday", "30,20"))
+            self.assertEqual(TrialAnswer.objects.get(user = self.user).responses, "")
+
+    def test_recover(self):
+        """
+        A dead worker's journal is replayed, and replaying it twice is harmless.
+        """
+        entry = {"user": self.user.id, "question": 0, "day": 0,
+                 "responses": ["30"], "time": 1.}
+        for name in ["journal-1.log", "journal-2.log"]:
+            with open(os.path.join(self.journal, name), "w") as journal:
+                journal.write(json.dumps(entry) + "\n")
+
+        with self.settings(WRITE_BEHIND_JOURNAL = self.journal):
+            self.assertEqual(writebehind.recover(), 2)
+        self.assertEqual(TrialAnswer.objects.get(user = self.user).responses, "30")
+        self.assertEqual(UserProfile.objects.get(user = self.user).day, "Tuesday")
+        self.assertEqual(os.listdir(self.journal), [])
+
+    def dead_letters(self):
+        with open(os.path.join(self.journal, "dead-letter.log")) as letters:
+            return [json.loads(line) for line in letters]
+
+    def test_lost_submissions_are_kept(self):
+        """
+        Entries that can't be written, whether queued here or left by a dead
+        worker, go to the dead-letter file before their journal is emptied
+        or deleted.
+        """
+        ahead = {"user": self.user.id, "question": 1, "day": 0,
+                 "responses": ["30"], "time": 1.}
+        logger = logging.getLogger("experiment.writebehind")
+        logger.disabled = True
+        try:
+            with self.settings(WRITE_BEHIND_JOURNAL = self.journal):
+                with open(os.path.join(self.journal, "journal-1.log"), "w") as journal:
+                    journal.write(json.dumps(ahead) + "\n")
+                self.assertEqual(writebehind.recover(), 1)
+                self.assertEqual(os.listdir(self.journal), ["dead-letter.log"])
+
+                writebehind.write_journal([ahead])
+                writebehind._queue.append(ahead)
+                self.assertEqual(writebehind.flush(), 1)
+        finally:
+            logger.disabled = False
+        self.assertEqual(os.path.getsize(writebehind._journal.name), 0)
+        letters = self.dead_letters()
+        self.assertEqual(len(letters), 2)
+        self.assertEqual(letters[1]["question"], 1)
+        self.assertTrue("waited" in letters[1]["reason"])
+        self.assertEqual(TrialAnswer.objects.get(user = self.user).responses, "")
+
+    def test_pending_entries(self):
+        """
+        A user's submissions count as pending, in any worker's journal, until
+        they're marked as written.
+        """
+        first  = {"user": self.user.id, "question": 0, "day": 0, "responses": ["30"],
+                  "time": 1., "id": "1-0"}
+        second = dict(first, day = 1, responses = ["20"], time = 2., id = "1-1")
+        with open(os.path.join(self.journal, "journal-1.log"), "w") as journal:
+            journal.write(json.dumps(second) + "\n" + json.dumps(first) + "\n")
+            journal.write(json.dumps({"written": ["1-0"]}) + "\n" + '{"user": ')
+
+        with self.settings(WRITE_BEHIND_JOURNAL = self.journal):
+            self.assertEqual(writebehind.pending_entries(self.user.id), [second])
+            self.assertEqual(writebehind.pending_entries(self.user.id + 1), [])
+
+
+from django.db import connections
+from archive   import archive, open_archive
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        alias = "archive_test_study"
+        if alias in connections.databases:
+            connections[alias].close()
+            del connections.databases[alias]
+        shutil.rmtree(self.directory)
+
+    def test_archive_finished_users(self):
+        """
+        Finished users move to the archive, whatever they were paid, and can
+        still be analyzed there.
+        """
+        paid = make_user("paid", "static")
+        UserProfile.objects.filter(user = paid).update(finished_training = True,
+                                                       finished_experiment = True,
+                                                       payment = "31.50")
+        TrialAnswer.objects.create(user = paid, question = 0, incomes = "100,100",
+                                   interests = "0", responses = "100,100")
+        broke = make_user("broke", "static")
+        UserProfile.objects.filter(user = broke).update(finished_training = True,
+                                                        finished_experiment = True)
+        busy  = make_user("busy", "static")
+
+        with self.settings(ARCHIVE_DIR = self.directory):
+            self.assertEqual(archive("test_study"), 2)
+            alias = open_archive("test_study")
+
+        self.assertEqual(list(User.objects.values_list("username", flat = True)), ["busy"])
+        self.assertEqual(TrialAnswer.objects.count(), 0)
+        self.assertEqual(UserProfile.objects.using(alias).get(user = paid).payment, 31.5)
+        self.assertEqual(analyze(using = alias)["created"], 1)
+        self.assertEqual(TrialAnalytics.objects.using(alias).get().wags, 20.)
+
+
+from models import TrialDesign
+
+
+class TrialDesignTest(TestCase):
+
+    def test_designs_are_shared(self):
+        """
+        Answers to the same design share one TrialDesign, and still read like
+        they have their own incomes and interests.
+        """
+        for username in ["first", "second"]:
+            TrialAnswer.objects.create(user = make_user(username), question = 0,
+                                       incomes = "100,50", interests = "10")
+        TrialAnswer.objects.create(user = User.objects.get(username = "first"), question = 1,
+                                   incomes = "100,60", interests = "10")
+        self.assertEqual(TrialDesign.objects.count(), 2)
+
+        answer = TrialAnswer.objects.get(user__username = "second")
+        self.assertEqual((answer.incomes, answer.interests), ("100,50", "10"))
+
+
+from builds.generate import generate
+from models          import StageCount
+
+
+class GenerateTest(TestCase):
+
+    def test_generate(self):
+        """
+        Generated participants are consistent with their stage, and are
+        counted on the dashboard.
+        """
+        counts = generate(30, stages = {"training": 1, "experiment": 1, "finished": 1}, seed = 3)
+        self.assertEqual(sum(counts.values()), 30)
+        self.assertEqual(dict(StageCount.objects.values_list("stage", "count")),
+                         dict((stage, count) for stage, count in counts.items() if count))
+
+        for profile in UserProfile.objects.filter(finished_experiment = True):
+            answers = TrialAnswer.objects.filter(user = profile.user)
+            self.assertEqual(answers.count(), profile.trials_done)
+            paid    = answers.get(question = profile.payment_trial)
+            self.assertEqual(len(paid.responses.split(",")), len(paid.incomes.split(",")))
+            self.assertNotEqual(profile.payment, 0)
+
+
+import tasks
+from   models import Task, claim_key
+from   django.utils import timezone
+from   datetime     import timedelta
+
+
+class TaskTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_retry_then_fail(self):
+        """
+        A task that keeps failing is tried MAX_ATTEMPTS times, then marked
+        as failed with its traceback.
+        """
+        calls = []
+        def broken(value):
+            calls.append(value)
+            raise ValueError("no good")
+        tasks.register_task("broken", broken)
+        try:
+            task = tasks.enqueue("broken", 7)
+            for attempt in range(tasks.MAX_ATTEMPTS):
+                self.assertEqual(tasks.work(), 1)
+                Task.objects.filter(id = task.id, status = "pending") \
+                            .update(run_after = task.run_after)
+            self.assertEqual(tasks.work(), 0)
+        finally:
+            del tasks.TASKS["broken"]
+
+        self.assertEqual(calls, [7] * tasks.MAX_ATTEMPTS)
+        status = tasks.status()
+        self.assertEqual(status["counts"]["failed"], 1)
+        self.assertTrue("no good" in status["failed"][0]["error"])
+
+    def test_finishing_freezes_payment(self):
+        """
+        Finishing the experiment queues up the trial's analytics and the
+        user's payment, which the payment page then only reads.
+        """
+        user    = make_user("finisher", "static")
+        profile = user.get_profile()
+        profile.trials_done, profile.payment_trial = 16, 16
+        profile.finished_training = True
+        profile.save()
+        TrialAnswer.objects.create(user = user, question = 16, incomes = "100,100",
+                                   interests = "0")
+        client  = Client()
+        client.login(username = "finisher", password = "password")
+        client.post("/experiment/", {"Monday": "50"})
+
+        self.assertEqual(sorted(Task.objects.values_list("name", flat = True)),
+                         ["analyze_trial", "freeze_payment"])
+        self.assertEqual(tasks.work(), 2)
+        self.assertEqual(TrialAnalytics.objects.count(), 1)
+        payment = UserProfile.objects.get(user = user).payment
+        self.assertNotEqual(payment, 0)
+        client.get("/payment/")
+        self.assertEqual(UserProfile.objects.get(user = user).payment, payment)
+
+    def test_purge(self):
+        """
+        Done tasks and claims are cleared out once they're old; failed and
+        pending tasks, and new claims, are kept.
+        """
+        old = timezone.now() - timedelta(hours = 49)
+        for state in ["done", "failed", "pending"]:
+            Task.objects.create(name = "analyze_trial", status = state, run_after = old,
+                                finished = old)
+        Task.objects.create(name = "analyze_trial", status = "done", run_after = old,
+                            finished = timezone.now())
+        claim_key("old")
+        claim_key("new")
+        Claim.objects.filter(key = "old").update(created = old)
+
+        self.assertEqual(tasks.purge(), {"tasks": 1, "claims": 1})
+        self.assertEqual(Task.objects.count(), 3)
+        self.assertEqual(list(Claim.objects.values_list("key", flat = True)), ["new"])
+
+
+import models
+import sharding
+from   sharding import fan_out, use_database
+
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.settings  = self.settings(SHARDS = ["room1", "room2"], SHARD_DIR = self.directory)
+        self.settings.enable()
+
+    def tearDown(self):
+        sharding.deactivate()
+        sharding._placements.clear()
+        for name in ["room1", "room2"]:
+            if "shard_" + name in connections.databases:
+                connections["shard_" + name].close()
+                delattr(connections._connections, "shard_" + name)
+                del connections.databases["shard_" + name]
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def test_rooms_have_their_own_database(self):
+        """
+        Each room's participants are stored in, and answer from, their own
+        shard, while the dashboard and the tools see every room.
+        """
+        for room in ["room1", "room2"]:
+            generate(3, arms = {("static", "power"): 1}, stages = {"experiment": 1},
+                     prefix = room + "_", shard = room)
+        self.assertEqual(UserProfile.objects.count(), 0)
+        self.assertEqual(UserProfile.objects.using("shard_room1").count(), 3)
+        self.assertEqual(User.objects.count(), 6)
+
+        user = User.objects.get(username = "room1_0")
+        with use_database("shard_room1"):
+            profile, trial_object = user_state(user)
+            data = dict((day, "10") for day in trial_for(trial_object).days[:-1])
+        client = Client()
+        client.login(username = "room1_0", password = "password")
+        client.post("/experiment/", data)
+        answer = TrialAnswer.objects.using("shard_room1").get(user = user, question = profile.trials_done)
+        self.assertTrue(answer.responses.startswith("10"))
+
+        def count(using):
+            return UserProfile.objects.using(using).count()
+        self.assertEqual(fan_out(count), {"default": 0, "shard_room1": 3, "shard_room2": 3})
+
+        User.objects.create_user("staff", "fake@fake.com", "password")
+        User.objects.filter(username = "staff").update(is_staff = True)
+        client.login(username = "staff", password = "password")
+        data = json.loads(client.get("/dashboard/progress/").content)
+        self.assertEqual(data["stages"]["experiment"], 6)
+
+    def test_designs_come_from_the_answers_database(self):
+        """
+        An answer read from a shard finds its design in that shard, and a
+        new one saved to a shard stores its design there.
+        """
+        generate(1, arms = {("static", "power"): 1}, prefix = "room1_", shard = "room1")
+        models._designs.clear()
+        answer = TrialAnswer.objects.using("shard_room1").all()[0]
+        self.assertTrue(answer.incomes)
+
+        user = User.objects.get(username = "room1_0")
+        sharding.open_shard("room2")
+        TrialAnswer(user_id = user.id, question = 99, incomes = "1,2",
+                    interests = "3").save(using = "shard_room2")
+        self.assertTrue(TrialDesign.objects.using("shard_room2").filter(incomes = "1,2").exists())
+        self.assertFalse(TrialDesign.objects.filter(incomes = "1,2").exists())
+
+
+
+from links import make_token, claim_token
+
+
+class LoginLinkTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user("linked", "static")
+
+    def test_link_logs_in_once(self):
+        """
+        Following a login link only asks the participant to confirm, however
+        many times it's fetched; confirming logs them in and sends them to
+        the consent page, but only the first time.
+        """
+        token  = make_token(self.user)
+        client = Client()
+        for fetch in range(2):
+            response = client.get("/login/%s/" % token)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context["link_user"], self.user)
+        self.assertEqual(client.get("/consent/").status_code, 302)
+
+        response = client.post("/login/%s/" % token)
+        self.assertEqual(response["Location"], "http://testserver/consent/")
+        self.assertEqual(client.get("/consent/").status_code, 200)
+
+        cache.clear()
+        response = Client().post("/login/%s/" % token)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["bad_link"])
+
+    def test_bad_links(self):
+        """
+        Expired, tampered with and inactive users' links don't log anyone in.
+        """
+        expired  = make_token(self.user, hours = -1)
+        token    = make_token(self.user)
+        tampered = token[:-1] + ("1" if token.endswith("0") else "0")
+        for token in [expired, tampered]:
+            response = Client().get("/login/%s/" % token)
+            self.assertTrue(response.context["bad_link"])
+
+        User.objects.filter(id = self.user.id).update(is_active = False)
+        token    = make_token(User.objects.get(id = self.user.id))
+        response = Client().post("/login/%s/" % token)
+        self.assertTrue(response.context["already_done"])
+        self.assertTrue(claim_token(token))     # Turning them away didn't use it up.
+
+
+from builds.provision import provision
+
+
+class ProvisionTest(TestCase):
+
+    def test_provision(self):
+        """
+        Participants built in the pool get the same schedules add_user would
+        give them, passwords that work, and are counted as in training.
+        """
+        accounts = provision(6, arms = {("static", "power"): 1}, prefix = "p", study_seed = 5,
+                             processes = 2, batch_size = 4)
+        self.assertEqual([username for username, _ in accounts], ["p%i" % index for index in range(6)])
+        self.assertEqual(StageCount.objects.get(stage = "training").count, 6)
+
+        username, password = accounts[3]
+        user    = User.objects.get(username = username)
+        profile = UserProfile.objects.get(user = user)
+        self.assertTrue(user.check_password(password))
+        self.assertEqual(profile.seed, participant_seed(username, 5))
+        trials, payment_trial = build_schedule("static", profile.seed)
+        self.assertEqual(profile.payment_trial, payment_trial)
+        answers = TrialAnswer.objects.filter(user = user).order_by("question")
+        self.assertEqual([(answer.incomes, answer.interests) for answer in answers],
+                         [(problem.get_incomes(), problem.get_interests()) for problem in trials])
+
+        accounts = provision(2, prefix = "linked", links_only = True, processes = 1)
+        self.assertEqual([password for _, password in accounts], [None, None])
+        self.assertFalse(User.objects.get(username = "linked0").has_usable_password())
+
+
+from crosscheck import crosscheck, passed
+
+
+def rounded_down_settle(incomes, interests, responses):
+    return [int(response) for response in settle(incomes, interests, responses)]
+
+
+class CrosscheckTest(TestCase):
+
+    def test_current_code_matches_original(self):
+        """
+        What the experiment does now scores trials the way the original code
+        did, and an engine that doesn't is caught.
+        """
+        results = crosscheck(200, processes = 1, seed = 1)
+        self.assertTrue(passed(results))
+        self.assertEqual(results["settle"]["largest"], 0.)
+        self.assertTrue(results["optimum (legacy)"]["largest"] > 1)
+        self.assertFalse(passed(results, strict = True))
+
+        results = crosscheck(200, engines = {"settle": rounded_down_settle}, processes = 1)
+        self.assertFalse(passed(results))
+        self.assertFalse(results["settle"]["within"])
+        self.assertTrue(results["validate"]["within"])
+
+
+import subprocess
+import sys
+import threading
+import time
+from   django.conf import settings
+import admission
+
+
+class AdmissionTest(TestCase):
+
+    def test_turns_go_round_participants(self):
+        """
+        With every place taken, a participant who submits twice waits behind
+        everybody else, and anybody who waits too long is turned away.
+        """
+        gate     = admission.Gate(1)
+        admitted = []
+        def submit(participant):
+            if gate.enter(participant, 5):
+                admitted.append(participant)
+                gate.leave()
+
+        gate.enter("first", 1)
+        threads = []
+        for participant in ["a", "a", "b"]:
+            threads.append(threading.Thread(target = submit, args = (participant,)))
+            threads[-1].start()
+            while gate.depth < len(threads):
+                time.sleep(0.001)
+        gate.leave()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, ["a", "b", "a"])
+
+        gate.enter("first", 1)
+        self.assertFalse(gate.enter("c", 0.01))
+        data = gate.status()
+        self.assertEqual((data["writing"], data["waiting"], data["peak"], data["turned_away"]),
+                         (1, 0, 3, 1))
+
+    def test_workers_leave_out_the_builder(self):
+        """
+        Serving doesn't bring in the trial builder (or xlrd) along with the
+        admission queue.
+        """
+        script = ("import sys; import experiment.views; "
+                  "print 'xlrd' in sys.modules or 'experiment.builds.build_trials' in sys.modules")
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd = settings.PROJECT_DIR, env = dict(os.environ,
+                                         DJANGO_SETTINGS_MODULE = "settings"))
+        self.assertEqual(output.strip(), "False")
+
+    def test_only_submissions_wait(self):
+        """
+        When the gate is full, submissions are told to try again, while pages
+        that are only being looked at go straight through.
+        """
+        cache.clear()
+        user = make_user("queued", "dynamic")
+        TrialAnswer.objects.create(user = user, question = 0, incomes = "100,0,0",
+                                   interests = "0,0")
+        client = Client()
+        client.login(username = "queued", password = "password")
+        with self.settings(ADMISSION_LIMIT = 1, ADMISSION_TIMEOUT = 0.01):
+            gate = admission.get_gate()
+            gate.enter("someone else", 1)
+            data = {"Monday": "30", "token": "b" * 32}
+            self.assertEqual(client.post("/training/", data).status_code, 503)
+            self.assertEqual(client.get("/training/").status_code, 200)
+            gate.leave()
+            self.assertEqual(client.post("/training/", data).status_code, 302)
+            self.assertEqual(gate.status()["turned_away"], 1)
+
+
+import memory
+from   trials import cached_trial, _trials
+
+
+class MemoryTest(TestCase):
+
+    # What the memory log says goes here rather than to the console.
+    class Capture(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.lines = []
+
+        def emit(self, record):
+            self.lines.append(record.getMessage())
+
+    def setUp(self):
+        self.capture  = self.Capture()
+        self.handlers = memory.logger.handlers
+        memory.logger.handlers = [self.capture]
+
+    def tearDown(self):
+        memory.logger.handlers = self.handlers
+        memory._first = None
+        memory._snapshots.clear()
+        memory._views.clear()
+
+    def test_growth_shows_up(self):
+        """
+        A cache that grows between snapshots, and the views that ran in
+        between, show up in the comparison and on the staff page.
+        """
+        _trials.clear()
+        memory.watch()
+        for index in range(5):
+            cached_trial("%i,0" % index, "10")
+
+        User.objects.create_user("staff", "fake@fake.com", "password")
+        User.objects.filter(username = "staff").update(is_staff = True)
+        client = Client()
+        client.login(username = "staff", password = "password")
+        client.get("/dashboard/")
+        data = json.loads(client.get("/dashboard/memory/").content)
+
+        self.assertTrue(data["rss"] > 0)
+        self.assertTrue(self.capture.lines[0].startswith("pid %i: " % os.getpid()))
+        self.assertEqual(data["caches"]["trials"], 5)
+        self.assertTrue(["trials", 5, 5] in data["since_last"]["caches"])
+        self.assertEqual([view[:2] for view in data["since_start"]["views"]
+                          if view[0] == "dashboard"], [["dashboard", 1]])
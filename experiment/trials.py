@@ -0,0 +1,94 @@
+### TRIALS.PY
+###
+### What a trial looks like while the experiment is running. Building users'
+### trials (reading the workbook, shuffling life cycles, filling in RAND
+### incomes) lives in builds/build_trials.py, and is only ever needed when
+### users are being created. Serving a page only needs a trial's incomes,
+### interests and the things that follow from them, which is all this file
+### has -- so the workers never have to import xlrd at all.
+
+from   payoffs import growth_factors, cached_optimum
+
+
+DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+""" TRIAL
+    A single trial's design. Once made it can't be changed, which is what
+    lets the growth factors be remembered the first time they're asked for.
+    The optimum isn't kept here: it depends on the payoff as well (whose
+    exponent can change; see helpers.k), so it comes from the shared optimum
+    cache, which is keyed by the payoff.
+
+    PARAMETERS
+    incomes   -- How many bucks the user is given each day, one per day of
+                 the trial. Numbers or strings, as stored on a TrialAnswer.
+    interests -- The interest rates (in percents) for every day but the last.
+"""
+class Trial(object):
+    __slots__ = ("incomes", "interests", "days", "_factors")
+
+    def __init__(self, incomes, interests):
+        assign = object.__setattr__
+        assign(self, "incomes",   tuple(incomes))
+        assign(self, "interests", tuple(interests))
+        assign(self, "days",      DAYS[:len(self.incomes)])
+        assign(self, "_factors",  None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("trials can't be changed")
+
+    def __repr__(self):
+        return "Trial Object: (length %i)" % len(self.incomes)
+
+    # Pickle (for the cache or another process) by design alone.
+    def __reduce__(self):
+        return (self.__class__, (self.incomes, self.interests))
+
+    def __eq__(self, other):
+        return isinstance(other, Trial) and \
+               (self.incomes, self.interests) == (other.incomes, other.interests)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.incomes, self.interests))
+
+
+    """ How much a buck saved on Monday is worth on each day. """
+    @property
+    def factors(self):
+        if self._factors is None:
+            object.__setattr__(self, "_factors", tuple(growth_factors(self.interests)))
+        return list(self._factors)
+
+
+    """ The optimal way to feed the dog (see payoffs.py). By default that's
+        under wags = food^k with no borrowing limit. """
+    def calculate_optimum(self, payoff = None, limit = None):
+        return cached_optimum(self.incomes, self.interests, payoff, limit)
+
+
+""" The Trial for a design, as stored on a TrialAnswer (comma-separated
+    strings). Users see the same designs over and over (on every page of a
+    trial, and everybody gets the same training trials), so trials are kept
+    around, keyed on the strings, and the same Trial is handed back each
+    time. Dropped wholesale if it gets big. """
+TRIAL_CACHE_SIZE = 10000
+_trials          = {}
+
+def cached_trial(incomes, interests):
+    key     = (incomes, interests)
+    problem = _trials.get(key)
+    if problem is None:
+        if len(_trials) >= TRIAL_CACHE_SIZE:
+            _trials.clear()
+        problem = Trial(incomes.split(","), interests.split(","))
+        _trials[key] = problem
+    return problem
+
+
+""" The Trial for a TrialAnswer. """
+def trial_for(trial_object):
+    return cached_trial(trial_object.incomes, trial_object.interests)
@@ -2,16 +2,29 @@
 # Django imports
 from django.shortcuts               import render_to_response
 from django.contrib.auth            import authenticate, login, logout
-from django.http                    import HttpResponseRedirect
-from django.contrib.auth.decorators import login_required
+from django.http                    import HttpResponse, HttpResponseRedirect
+from django.contrib.auth.decorators import login_required, user_passes_test
 
 # Python imports
+import json
 import math
 
 # Local imports
 from forms   import LoginForm, DogForm, DiagnosticForm
-from models  import TrialAnswer, DiagnosticAnswer
-from helpers import calculate_days, process_input, calculate_wags
+from models  import UserProfile, DiagnosticAnswer, Progress, StageCount
+from helpers import calculate_days, process_input, calculate_payment, calculate_budget
+from helpers import record_progress, STAGES
+from caching import user_state, user_trial, design_info, invalidate_user, warm_user
+from caching import new_token, claim_submission, finish_submission, release_submission
+from payoffs import get_payoff
+from trials  import trial_for
+from writebehind import wait_for_user
+from sharding import activate, database_for, databases
+from links   import check_token, claim_token
+import warmup
+import tasks
+import admission
+import memory
 
 
 ##################
@@ -42,6 +55,12 @@ def login_user(request):
             if user is not None:                # The user exists!
                 if user.is_active:              # A successful login!
                     login(request, user)
+                    activate(database_for(user))
+
+                    # They're about to go through all of their trials, so
+                    # get everything about them ready now.
+                    if not user.is_staff:
+                        warm_user(user)
                     return HttpResponseRedirect("/consent/")
 
                 else:                           # User exists but isn't active.
@@ -65,6 +84,40 @@ def login_user(request):
     return render_to_response("login.html", context)
 
 
+""" Logs a participant in with a login link (see links.py) instead of their
+    password, and sends them on just like login_user does. A link that's
+    expired, forged or already used gets them the login page. Following the
+    link only asks them to confirm: link previews and QR scanners fetch it
+    ahead of time, so only the confirmation (a POST) uses it up. """
+def login_link(request, token):
+    anonymous = request.user.is_anonymous
+    user      = check_token(token)
+    if user is None:
+        context = {"user": request.user, "form": LoginForm(), "anonymous": anonymous, "bad_link": True}
+        return render_to_response("login.html", context)
+    if not user.is_active:
+        context = {"user": request.user, "form": LoginForm(), "anonymous": anonymous, "already_done": True}
+        return render_to_response("login.html", context)
+
+    # Not confirmed yet, so leave the link as it is.
+    if request.method != "POST":
+        context = {"user": request.user, "form": LoginForm(), "anonymous": anonymous, "link_user": user}
+        return render_to_response("login.html", context)
+
+    # Only now, with everything checked, is the link used up.
+    if not claim_token(token):
+        context = {"user": request.user, "form": LoginForm(), "anonymous": anonymous, "bad_link": True}
+        return render_to_response("login.html", context)
+
+    # Nothing checked a password, so tell Django which backend let them in.
+    user.backend = "django.contrib.auth.backends.ModelBackend"
+    login(request, user)
+    activate(database_for(user))
+    if not user.is_staff:
+        warm_user(user)
+    return HttpResponseRedirect("/consent/")
+
+
 
 ###################
 ### LOGOUT_USER ###
@@ -113,7 +166,7 @@ def examples(request):
 
     # The examples that we give are going to differ if the user is on
     # the static arm or the dynamic arm.
-    user_class = request.user.get_profile().user_class
+    user_class = user_state(request.user)[0].user_class
     context    = {"user": request.user, "dynamic": user_class == "dynamic"}
     return render_to_response("examples.html", context)
 
@@ -129,7 +182,8 @@ def examples(request):
 def training(request):
 
     # If the user has finished the training session, redirect them.
-    if request.user.get_profile().finished_training:
+    profile, trial_object = user_state(request.user)
+    if profile.finished_training:
         return HttpResponseRedirect("/experiment/")
 
     # If the trial form has been submitted, let's check the inputs.
@@ -137,32 +191,48 @@ def training(request):
         form = DogForm(request.POST)
 
         if form.is_valid():
-            trials_done_before = request.user.get_profile().trials_done
-            process_input(form, request.user, True)
-            trials_done_after  = request.user.get_profile().trials_done
+
+            # If they've already submitted this very form (a double-click,
+            # or a refresh), send them where we sent them the first time.
+            token  = form.cleaned_data["token"]
+            replay = claim_submission(request.user, token) if token else None
+            if replay is not None:
+                return HttpResponseRedirect(replay or "/training/")
+
+            # If it can't be recorded, the claim is given up, so that they
+            # can submit it again.
+            trials_done_before = user_state(request.user)[0].trials_done
+            try:
+                process_input(form, request.user, True)
+            except Exception:
+                if token:
+                    release_submission(request.user, token)
+                raise
+            trials_done_after  = user_state(request.user)[0].trials_done
 
             # If they completed a trial in this submission -- not necessarily
             # a given for dynamic users -- we send them to check out their
-            # feedback.
-            if trials_done_after != trials_done_before:
-                return HttpResponseRedirect("/training/review/")
+            # feedback. Otherwise it's back here for the next day.
+            next_url = "/training/review/" if trials_done_after != trials_done_before \
+                                           else "/training/"
+            if token:
+                finish_submission(request.user, token, next_url)
+            return HttpResponseRedirect(next_url)
                 
     # Load the form.
-    form = DogForm(auto_id = "whatever")
+    form = DogForm(auto_id = "whatever", initial = {"token": new_token()})
 
-    # Grab the problem.
-    profile       = request.user.get_profile()
-    problem_index = profile.trials_done
-    trial_object  = TrialAnswer.objects.filter(user     = request.user,
-                                               question = problem_index)[0]
+    # Grab the problem. This comes out of the shared cache unless something
+    # has been written for the user since it was last read.
+    profile, trial_object = user_state(request.user)
+    problem_index         = profile.trials_done
     
 
     # Reconstruct the trial
-    from builds.build_trials import trial
-    problem      = trial(trial_object.incomes.split(","), trial_object.interests.split(","))
+    problem      = trial_for(trial_object)
     days_to_show = problem.days[:-1] if    profile.user_class == "static" \
                                      else [profile.day]
-    days_inputs  = calculate_days(problem, request.user)
+    days_inputs  = calculate_days(problem, profile)
     user_class   = profile.user_class
 
     # Create the info for the dynamic users.
@@ -179,22 +249,9 @@ def training(request):
 
     # We want to inform them how much money they can spend today. To do
     # so, we'll tell them how much money they actually have, plus how much
-    # they can borrow from future days. First, calculate how much money they
-    # have currently.
-    incomes   = map(float, problem.incomes)
-    interests = map(float, problem.interests)
-    carry_over = 0
-    for index in range(today_index):
-        carry_over += incomes[index] - spendings[index]
-        carry_over *= (interests[index] / 100. + 1)
-    today_money = round(carry_over + incomes[today_index], 2)
-    
-
-    # Now calculate how much they can borrow.
-    borrowable = float(incomes[-1])
-    for day in reversed(range(today_index, len(interests))):
-        borrowable = borrowable / (1 + interests[day] / 100.) + (incomes[day] if day != today_index else 0)
-    borrowable = round(borrowable, 2) 
+    # they can borrow from future days. Both come straight off the trial's
+    # budget checkpoint.
+    today_money, borrowable = calculate_budget(trial_object, today_index)
 
     # The amount of cash we can spend today is how much we have physically
     # plus how much we can borrow
@@ -224,21 +281,20 @@ def training(request):
 def training_review(request):
 
     # Grab the user's profile
-    profile = request.user.get_profile()
+    profile = user_state(request.user)[0]
 
     # We want to grab the most recent answer.
-    from builds.build_trials import trial
     current_problem_index = profile.trials_done - 1
-    trial_object          = TrialAnswer.objects.filter(user     = request.user,
-                                                       question = current_problem_index)[0]
+    trial_object          = user_trial(request.user, current_problem_index)
 
-    trial                 = trial(trial_object.incomes.split(','),
-                                  trial_object.interests.split(','))
-    days_to_show          = trial.days
+    problem               = trial_for(trial_object)
+    payoff                = get_payoff(profile.payoff)
+    days_to_show          = problem.days
     responses             = trial_object.responses.split(',')
-    wags                  = [calculate_wags(float(food)) for food in responses]
-    optimum               = trial.calculate_optimum()
-    optimum_wags          = map(calculate_wags, optimum)
+    wags                  = payoff.wags(responses)
+    design                = design_info(problem.incomes, problem.interests, payoff)
+    optimum               = design["optimum"]
+    optimum_wags          = design["optimum_wags"]
     totals                = {"wags":    reduce(lambda x, y: x + y, wags,         0),
                              "optimum": reduce(lambda x, y: x + y, optimum_wags, 0)}
 
@@ -268,7 +324,7 @@ def training_review(request):
 def experiment(request):
 
     # Get the profile
-    profile = request.user.get_profile()
+    profile, trial_object = user_state(request.user)
 
     # If the user has finished the training session, redirect them.
     if profile.finished_experiment:
@@ -281,28 +337,41 @@ def experiment(request):
         form = DogForm(request.POST)
 
         if form.is_valid():
-            process_input(form, request.user, True)
+
+            # Repeats of a submission go where the first one went.
+            token  = form.cleaned_data["token"]
+            replay = claim_submission(request.user, token) if token else None
+            if replay is not None:
+                return HttpResponseRedirect(replay or "/experiment/")
+
+            try:
+                process_input(form, request.user, True)
+            except Exception:
+                if token:
+                    release_submission(request.user, token)
+                raise
 
             # Check to see if they're now done with the experiment
-            if request.user.get_profile().finished_experiment:
-                return HttpResponseRedirect("/diagnostics/")
+            next_url = "/diagnostics/" if user_state(request.user)[0].finished_experiment \
+                                       else "/experiment/"
+            if token:
+                finish_submission(request.user, token, next_url)
+            return HttpResponseRedirect(next_url)
                 
 
     # Load the form.
-    form = DogForm(auto_id = "whatever")
+    form = DogForm(auto_id = "whatever", initial = {"token": new_token()})
 
-    # Grab the problem.
-    profile       = request.user.get_profile()
-    problem_index = profile.trials_done
-    trial_object  = TrialAnswer.objects.filter(user     = request.user,
-                                               question = problem_index)[0]
+    # Grab the problem. This comes out of the shared cache unless something
+    # has been written for the user since it was last read.
+    profile, trial_object = user_state(request.user)
+    problem_index         = profile.trials_done
 
     # Reconstruct the trial
-    from builds.build_trials import trial
-    problem      = trial(trial_object.incomes.split(","), trial_object.interests.split(","))
+    problem      = trial_for(trial_object)
     days_to_show = problem.days[:-1] if    profile.user_class == "static" \
                                      else [profile.day]
-    days_inputs  = calculate_days(problem, request.user)
+    days_inputs  = calculate_days(problem, profile)
     user_class   = profile.user_class
 
         # Create the info for the dynamic users.
@@ -319,22 +388,9 @@ def experiment(request):
 
     # We want to inform them how much money they can spend today. To do
     # so, we'll tell them how much money they actually have, plus how much
-    # they can borrow from future days. First, calculate how much money they
-    # have currently.
-    incomes   = map(float, problem.incomes)
-    interests = map(float, problem.interests)
-    carry_over = 0
-    for index in range(today_index):
-        carry_over += incomes[index] - spendings[index]
-        carry_over *= (interests[index] / 100. + 1)
-    today_money = round(carry_over + incomes[today_index], 2)
-    
-
-    # Now calculate how much they can borrow.
-    borrowable = float(incomes[-1])
-    for day in reversed(range(today_index, len(interests))):
-        borrowable = borrowable / (1 + interests[day] / 100.) + (incomes[day] if day != today_index else 0)
-    borrowable = round(borrowable, 2) 
+    # they can borrow from future days. Both come straight off the trial's
+    # budget checkpoint.
+    today_money, borrowable = calculate_budget(trial_object, today_index)
 
     # The amount of cash we can spend today is how much we have physically
     # plus how much we can borrow
@@ -358,8 +414,10 @@ def experiment(request):
 @login_required
 def diagnostics(request):
 
-    # Get the profile
-    profile = request.user.get_profile()
+    # Get the profile, once any submissions of theirs still waiting to be
+    # written are in.
+    wait_for_user(request.user)
+    profile = UserProfile.objects.get(user = request.user)
     
     # If the user is static, they don't take the diagnostic questions.
     # Also, if they're already done with the diagnostics, redirect them.
@@ -397,6 +455,8 @@ def diagnostics(request):
             # the survey.
             profile.finished_diagnostics = True
             profile.save()
+            record_progress(request.user, profile, "diagnostics")
+            invalidate_user(request.user)
 
             # Finally, redirect the user to the payment page.
             return HttpResponseRedirect("/payment/")
@@ -415,39 +475,39 @@ def diagnostics(request):
 @login_required
 def payment(request):
 
-    # Grab the profile
-    profile = request.user.get_profile()
+    # Grab the profile (with all of their submissions written)
+    wait_for_user(request.user)
+    profile = UserProfile.objects.get(user = request.user)
 
     # Grab the user's payment trial
     payment_trial = profile.payment_trial
-    trial_object  = TrialAnswer.objects.filter(user     = request.user,
-                                               question = payment_trial)[0]
+    trial_object  = user_trial(request.user, payment_trial)
 
     # Reconstruct the trial
-    from builds.build_trials import trial
-    problem = trial(trial_object.incomes.split(","),
-                    trial_object.interests.split(","))
+    problem = trial_for(trial_object)
 
     # Get the responses, the wags, and, the optimal food profile, and the
     # totals.
+    payoff       = get_payoff(profile.payoff)
     days_to_show = problem.days
     responses    = trial_object.responses.split(',')
-    wags         = [calculate_wags(float(food)) for food in responses]
-    optimum      = problem.calculate_optimum()
-    optimum_wags = map(calculate_wags, optimum)
+    wags         = payoff.wags(responses)
+    design       = design_info(problem.incomes, problem.interests, payoff)
+    optimum      = design["optimum"]
+    optimum_wags = design["optimum_wags"]
     totals       = {"wags":    reduce(lambda x, y: x + y, wags,         0),
                     "optimum": reduce(lambda x, y: x + y, optimum_wags, 0)}
 
     # The difference between the optimum solution and the subject's solution
-    # is involved in the payment calculation. So is the value b, which
-    # is a scaling parameter
-    b       = 0.01
-    dif     = totals["optimum"] - totals["wags"]
-    payment = round(40 - b * (dif**2), 2)
+    # is involved in the payment calculation.
+    payment = calculate_payment(totals["wags"], totals["optimum"])
 
-    # Set the payment
-    profile.payment = payment
-    profile.save()
+    # Set the payment, unless the freeze_payment task (see tasks.py) has
+    # already done it.
+    if round(float(profile.payment), 2) != round(payment, 2):
+        profile.payment = payment
+        profile.save()
+        invalidate_user(request.user)
 
     # Add on the proper suffix.
     suffix = {2:  "nd", 3:  "rd", 4:  "th", 5:  "th", 6:  "th", 7:  "th", 8:  "th", 9:  "th",
@@ -461,7 +521,77 @@ def payment(request):
     context = {"user":    request.user, "days":  days, "totals": totals,
                "payment": payment,      "trial": payment_trial}
     return render_to_response("payment.html", context)
-    
 
-    
 
+
+#################
+### DASHBOARD ###
+#################
+
+""" Only staff get to see the dashboard. Everybody else is sent back to the
+    login page. """
+staff_required = user_passes_test(lambda user: user.is_staff, login_url = "/")
+
+
+""" The experimenter's view of a running session. The page itself is just a
+    shell; it polls progress() below every couple of seconds. """
+@staff_required
+def dashboard(request):
+    context = {"user": request.user, "stages": STAGES}
+    return render_to_response("dashboard.html", context)
+
+
+""" How many users are in each stage, and where every unfinished user is.
+    This only reads the summary tables kept by helpers.record_progress, so
+    it's cheap enough to poll while a session is running. With shards (see
+    sharding.py), every room's tables are added up. """
+@staff_required
+def progress(request):
+    counts = dict((stage, 0) for stage in STAGES)
+    users  = []
+    for alias in databases():
+        for stage, count in StageCount.objects.using(alias).values_list("stage", "count"):
+            counts[stage] = counts.get(stage, 0) + count
+        users.extend(Progress.objects.using(alias).exclude(stage = "finished")
+                                     .values("username", "stage", "trial", "day"))
+    users.sort(key = lambda user: user["username"])
+    data   = {"stages": counts, "users": users}
+    return HttpResponse(json.dumps(data), mimetype = "application/json")
+
+
+""" How the task queue is doing (see tasks.py): how many tasks are pending,
+    running, done and failed, and what went wrong with the latest failures. """
+@staff_required
+def task_status(request):
+    return HttpResponse(json.dumps(tasks.status()), mimetype = "application/json")
+
+
+""" How the queue for submissions is doing in this worker (see admission.py):
+    how many are writing and waiting, how many were turned away, and how
+    long submissions have waited. """
+@staff_required
+def admission_status(request):
+    return HttpResponse(json.dumps(admission.status()), mimetype = "application/json")
+
+
+""" How much memory this worker is using, how fast it's growing, and what
+    grew since its last snapshot and since it started (see memory.py). """
+@staff_required
+def memory_status(request):
+    return HttpResponse(json.dumps(memory.status()), mimetype = "application/json")
+
+
+
+#############
+### READY ###
+#############
+
+""" For the load balancer: is this worker warmed up yet (see warmup.py)? It
+    won't send anybody here until we say so, which we never do if warming
+    up failed. """
+def ready(request):
+    if warmup.FAILURE is not None:
+        return HttpResponse("warm-up failed", status = 503, mimetype = "text/plain")
+    if not warmup.READY:
+        return HttpResponse("warming up", status = 503, mimetype = "text/plain")
+    return HttpResponse("ready", mimetype = "text/plain")
@@ -0,0 +1,109 @@
+### WARMUP.PY
+###
+### A freshly started worker is slow on its first few requests: it has yet to
+### compile the templates and solve any trials, and whichever participant
+### happens to land on it pays for all of that. So every
+### worker runs warm_up as it starts (see wsgi.py), in a thread of its own so
+### that the worker can answer straight away, and only says it's ready --
+### through the /ready/ page, which the load balancer checks -- once it's
+### done. If warming up fails, the worker never says it's ready, and why is
+### logged to 'experiment.warmup'. What runs in the background (the task
+### runner and so on) is started separately, by start_services, so that it
+### doesn't wait on warming up, or on warming up working.
+
+import logging
+import os
+import threading
+import traceback
+
+from   django.conf            import settings
+from   django.template.loader import get_template
+from   models                 import TrialAnswer, load_designs
+from   payoffs                import cached_optimum
+from   caching                import design_info
+from   trials                 import cached_trial
+from   sharding               import databases, use_database
+import writebehind
+import tasks
+import pooling
+import memory
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+# Set once warm_up has finished in this process, or, if it failed, what went
+# wrong (a traceback).
+READY   = False
+FAILURE = None
+
+logger  = logging.getLogger("experiment.warmup")
+_warmer = None
+
+
+""" Compiles every template, and solves every trial design in the database
+    under the payoff of each user who has it, both here and in the shared
+    cache. The designs come from the database rather than the workbook: that
+    way the RAND incomes are already filled in, and workers never need xlrd.
+    The designs themselves are loaded too (see models.TrialDesign).
+    Returns how many templates and designs were warmed up. """
+def warm_up():
+    global READY
+
+    # The templates only stay compiled if the cached loader is on (it is,
+    # unless DEBUG is set; see settings.py).
+    templates = sorted(name for name in os.listdir(TEMPLATE_DIR) if name.endswith(".html"))
+    for name in templates:
+        get_template(name)
+
+    # Every room's database has designs of its own (see sharding.py).
+    designs = set()
+    for alias in databases():
+        with use_database(alias):
+            found = list(TrialAnswer.objects.values_list("design", "design__incomes",
+                                                         "design__interests",
+                                                         "user__userprofile__payoff").distinct())
+            load_designs(digest for digest, incomes, interests, payoff in found)
+        designs.update(found)
+    for digest, incomes, interests, payoff in designs:
+        problem = cached_trial(incomes, interests)
+        cached_optimum(problem.incomes, problem.interests, payoff)
+        design_info(problem.incomes, problem.interests, payoff)
+
+    READY = True
+    return {"templates": len(templates), "designs": len(designs)}
+
+
+""" Starts what runs in the background of every worker, whether or not it
+    has been (or ever will be) warmed up: the task runner, the write-behind
+    writer and the memory watcher, each if it's turned on. Whichever of
+    them can't start is logged, and the rest start anyway. """
+def start_services():
+    services = [("connection pooling",  True,                                       pooling.keep_connections),
+                ("write-behind writer", writebehind.enabled(),                      writebehind.start),
+                ("task runner",         getattr(settings, "TASK_RUNNER", False),    tasks.start),
+                ("memory watcher",      getattr(settings, "MEMORY_INTERVAL", 0),    memory.start)]
+    for name, wanted, start_service in services:
+        if wanted:
+            try:
+                start_service()
+            except Exception:
+                logger.exception("Starting the %s in worker %i failed." % (name, os.getpid()))
+
+
+""" Starts warming this worker up in the background, if it isn't already. """
+def start():
+    global _warmer
+    if _warmer is None:
+        _warmer        = threading.Thread(target = warm_up_or_log)
+        _warmer.daemon = True
+        _warmer.start()
+
+
+""" Runs warm_up, and if it fails, leaves the worker not ready and logs why. """
+def warm_up_or_log():
+    global FAILURE
+    try:
+        warm_up()
+    except Exception:
+        FAILURE = traceback.format_exc()
+        logger.exception("Warming up worker %i failed; it won't report ready." % os.getpid())
@@ -0,0 +1,397 @@
+### WRITEBEHIND.PY
+###
+### SQLite only lets one connection write at a time, so when a whole session
+### of participants clicks Submit at once, they all queue up behind each
+### other, each with a commit or three of their own. Write-behind mode (turn
+### it on with WRITE_BEHIND in settings.py) takes the database out of the
+### click altogether:
+###
+### 1) The submission is applied to the user's cached state right away (see
+###    caching.store_state), so every page they see from then on already
+###    has it, whichever worker serves it.
+### 2) It's appended to this worker's journal, a file in WRITE_BEHIND_JOURNAL
+###    that is synced to disk before the user is answered.
+### 3) A thread in every worker writes whatever has queued up to TrialAnswer
+###    and UserProfile every WRITE_BEHIND_INTERVAL seconds, in a single
+###    transaction, notes in the journal which entries are written, and
+###    empties the journal once everything is.
+###
+### The journals are also how anybody tells whether a user still has
+### submissions waiting to be written, in any worker (see pending_entries).
+###
+### If a worker dies, whatever is left in its journal gets written by the
+### next worker to start (see recover). Writing an entry is safe to repeat:
+### each entry says which trial, and which day of it, it answers, and is
+### skipped if the database is already past that point.
+###
+### A journal is only ever emptied or deleted once everything in it has been
+### written. An entry that can't be written (it's waiting on an earlier
+### submission that never turns up) is moved to dead-letter.log, next to the
+### journals, and logged to 'experiment.writebehind', for somebody to look
+### at; each line of it is the entry, as JSON, with why it was given up on.
+###
+### Until a batch is written, a submission is only in the cache and in its
+### worker's journal. The cache is allowed to forget it: whenever a user's
+### state has to be read back from the database, whatever of theirs is still
+### in the journals is applied on top (see catch_up).
+
+from   django.conf                import settings
+from   django.contrib.auth.models import User
+from   django.db                  import transaction
+import atexit
+import fcntl
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from   models   import UserProfile, TrialAnswer
+from   caching  import user_state, store_state, invalidate_user, PROFILE_FIELDS, TRIAL_FIELDS
+from   sharding import database_for, use_database
+import helpers
+
+
+# An entry can have to wait for an earlier one of the same user's that's
+# still queued in another worker. If it's been waiting this long (in
+# seconds), the earlier one is lost and we give up on it (see dead_letter).
+PENDING_TIMEOUT = 60
+
+# How long, at most, a page that needs the database to be up to date for a
+# user waits for their queued submissions to be written.
+WAIT_TIMEOUT = 2
+
+logger = logging.getLogger("experiment.writebehind")
+
+_queue       = []
+_queue_lock  = threading.RLock()
+_flush_lock  = threading.Lock()
+_start_lock  = threading.Lock()
+_stopping    = threading.Event()
+_journal     = None
+_flusher     = None
+_entry_ids   = itertools.count()
+
+
+def enabled():
+    return getattr(settings, "WRITE_BEHIND", False)
+
+
+def journal_dir():
+    return settings.WRITE_BEHIND_JOURNAL
+
+
+
+##################
+### SUBMITTING ###
+##################
+
+""" Takes a submission in write-behind mode. The user's cached state moves
+    on immediately; the database catches up with the next batch. The writer
+    thread is started here if it isn't running yet, so that nothing waits
+    on the worker being warmed up (or on it being warmed up at all). """
+def submit(user, responses):
+    if _flusher is None:
+        start()
+    with _queue_lock:
+        profile, trial_object = user_state(user)
+        if trial_object is None:
+            return
+
+        # Which day of which trial these responses answer. Static users
+        # answer the whole trial at once, so for them it's always Monday.
+        answered = trial_object.responses.split(",") if trial_object.responses else []
+        entry    = {"user":      user.id,
+                    "question":  trial_object.question,
+                    "day":       len(answered) if profile.user_class == "dynamic" else 0,
+                    "responses": responses,
+                    "time":      time.time(),
+                    "id":        "%i-%i" % (os.getpid(), next(_entry_ids))}
+
+        helpers.apply_responses(user, profile, trial_object, responses)
+        write_journal([entry])
+        _queue.append(entry)
+        store_state(user, profile, trial_object)
+
+
+""" For pages that read or write a user's profile straight from the database
+    (diagnostics and payment): writes this worker's queue, then waits (a
+    little) for any other worker holding submissions of the user's. """
+def wait_for_user(user):
+    if not enabled():
+        return
+    flush()
+    waited = 0.
+    while pending_entries(user.id) and waited < WAIT_TIMEOUT:
+        time.sleep(0.01)
+        waited += 0.01
+
+
+
+###############
+### JOURNAL ###
+###############
+
+""" This worker's journal, opened (and locked, so that nobody mistakes it
+    for a dead worker's) the first time it's needed. Any dead workers'
+    journals are written to the database first. """
+def journal():
+    global _journal
+    if _journal is None:
+        recover()
+        if not os.path.isdir(journal_dir()):
+            os.makedirs(journal_dir())
+        path     = os.path.join(journal_dir(), "journal-%i.log" % os.getpid())
+        _journal = open(path, "a")
+        fcntl.flock(_journal, fcntl.LOCK_EX)
+    return _journal
+
+
+def write_journal(entries):
+    handle = journal()
+    for entry in entries:
+        handle.write(json.dumps(entry) + "\n")
+    handle.flush()
+    os.fsync(handle.fileno())
+
+
+""" Notes in the journal that the given entries are taken care of (written,
+    skipped or dead-lettered). This isn't synced: if it's lost, the entries
+    are only written again, which is harmless. """
+def mark_written(entries):
+    ids = [entry["id"] for entry in entries if "id" in entry]
+    if ids:
+        _journal.write(json.dumps({"written": ids}) + "\n")
+        _journal.flush()
+
+
+""" The entries in a journal that haven't been marked as written, in order.
+    A line that's still being written by its worker is skipped. """
+def read_journal(handle):
+    entries, written = [], set()
+    for line in handle:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "written" in record:
+            written.update(record["written"])
+        else:
+            entries.append(record)
+    return [entry for entry in entries if entry.get("id") not in written]
+
+
+""" Every entry, in every worker's journal, that's still waiting to be
+    written (just the given user's, if there is one), oldest first. """
+def pending_entries(user_id = None):
+    entries = []
+    for path in glob.glob(os.path.join(journal_dir(), "journal-*.log")):
+        try:
+            with open(path) as handle:
+                entries.extend(read_journal(handle))
+        except IOError:
+            continue
+    if user_id is not None:
+        entries = [entry for entry in entries if entry["user"] == user_id]
+    return sorted(entries, key = lambda entry: entry["time"])
+
+
+""" Writes every journal left behind by a dead worker to the database, then
+    deletes it. A journal whose lock can't be had belongs to a live worker,
+    and is left alone. Returns how many entries were replayed. """
+def recover():
+    if not os.path.isdir(journal_dir()):
+        return 0
+
+    entries, journals = [], []
+    for path in glob.glob(os.path.join(journal_dir(), "journal-*.log")):
+        handle = open(path, "a+")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            handle.close()
+            continue
+        handle.seek(0)
+        entries.extend(read_journal(handle))
+        journals.append((path, handle))
+
+    # Put the workers' entries back in the order they were submitted in.
+    entries.sort(key = lambda entry: entry["time"])
+    waiting = write_batch(entries) if entries else []
+    if waiting:
+        dead_letter(waiting, "couldn't be replayed from a dead worker's journal")
+
+    for user_id in set(entry["user"] for entry in entries):
+        invalidate_user(User(id = user_id))
+    for path, handle in journals:
+        os.remove(path)
+        handle.close()
+    return len(entries)
+
+
+""" Moves entries that can't be written out of the way, into the dead-letter
+    file (synced to disk, like the journal), and logs them. """
+def dead_letter(entries, reason):
+    if not os.path.isdir(journal_dir()):
+        os.makedirs(journal_dir())
+    path = os.path.join(journal_dir(), "dead-letter.log")
+    with open(path, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        for entry in entries:
+            handle.write(json.dumps(dict(entry, reason = reason)) + "\n")
+        handle.flush()
+        os.fsync(handle.fileno())
+    for entry in entries:
+        logger.error("Submission %s; moved to %s: %s" % (reason, path, json.dumps(entry)))
+
+
+
+###############
+### WRITING ###
+###############
+
+""" Writes a batch of entries, in a single transaction for each database
+    (see sharding.py) they belong in. Entries that the database is already
+    past are skipped; entries that are ahead of the database (an earlier
+    submission is still queued somewhere) are returned, to be tried again
+    with the next batch, in the order they came in. """
+def write_batch(entries):
+    databases = {}
+    for entry in entries:
+        databases.setdefault(database_for(entry["user"]), []).append(entry)
+
+    waiting = []
+    for alias, group in databases.items():
+        with use_database(alias):
+            waiting.extend(transaction.commit_on_success(using = alias)(write_entries)(group))
+    waiting.sort(key = lambda entry: entry["time"])
+    return waiting
+
+
+def write_entries(entries):
+    users   = User.objects.in_bulk(set(entry["user"] for entry in entries))
+    waiting = []
+    for entry in entries:
+        user = users.get(entry["user"])
+        if user is None:
+            continue
+
+        profile      = UserProfile.objects.select_for_update().get(user = user)
+        trial_object = None
+        if profile.trials_done == entry["question"]:
+            trial_object = TrialAnswer.objects.filter(user     = user,
+                                                      question = entry["question"])[0]
+        position = standing(entry, profile, trial_object)
+        if position != 0:
+            if position > 0:
+                waiting.append(entry)
+            continue
+
+        stage = helpers.calculate_stage(profile)
+        done  = helpers.apply_responses(user, profile, trial_object, entry["responses"])
+        profile.save()
+        trial_object.save()
+        helpers.record_progress(user, profile, stage)
+        helpers.queue_followups(profile, trial_object, done)
+    return waiting
+
+
+""" Where an entry stands against a user's profile and the trial they're on
+    (None if the entry isn't for that trial): 0 if it answers the very day
+    they're on, -1 if they're already past it, and 1 if it's ahead of them
+    (an earlier submission of theirs hasn't been applied yet). """
+def standing(entry, profile, trial_object):
+    if profile.trials_done != entry["question"] or trial_object is None:
+        return cmp(entry["question"], profile.trials_done) or -1
+    answered = len(trial_object.responses.split(",")) if trial_object.responses else 0
+    if profile.user_class == "dynamic":
+        return cmp(entry["day"], answered)
+    return 0
+
+
+""" Brings a user's schedule, as just read from the database (a profile and
+    trials as tuples of field values; see caching.user_schedule), up to date
+    with their submissions that are still waiting in the journals. """
+def catch_up(user, profile, trials):
+    if not enabled():
+        return profile, trials
+    pending = pending_entries(user.id)
+    if not pending:
+        return profile, trials
+
+    profile = UserProfile(**dict(zip(PROFILE_FIELDS, profile)))
+    answers = [TrialAnswer(**dict(zip(TRIAL_FIELDS, trial))) for trial in trials]
+    for entry in pending:
+        trial_object = None
+        for answer in answers:
+            if answer.question == entry["question"]:
+                trial_object = answer
+        if standing(entry, profile, trial_object) == 0:
+            helpers.apply_responses(user, profile, trial_object, entry["responses"])
+    return (tuple(getattr(profile, field) for field in PROFILE_FIELDS),
+            tuple(tuple(getattr(answer, field) for field in TRIAL_FIELDS) for answer in answers))
+
+
+""" Writes everything queued in this worker. Entries still waiting on an
+    earlier one go back on the front of the queue, unless they've waited too
+    long, in which case they're dead-lettered. The journal is emptied once
+    the queue is (everything in it is then either written or dead-lettered).
+"""
+def flush():
+    with _flush_lock:
+        with _queue_lock:
+            batch = list(_queue)
+        if not batch:
+            return 0
+        waiting = write_batch(batch)
+
+        now  = time.time()
+        kept = [entry for entry in waiting if now - entry["time"] < PENDING_TIMEOUT]
+        lost = [entry for entry in waiting if entry not in kept]
+        if lost:
+            dead_letter(lost, "waited more than %i seconds for an earlier one" % PENDING_TIMEOUT)
+        with _queue_lock:
+            del _queue[:len(batch)]
+            _queue[0:0] = kept
+            if _queue:
+                mark_written([entry for entry in batch if entry not in kept])
+            else:
+                _journal.seek(0)
+                _journal.truncate()
+        return len(batch) - len(kept)
+
+
+""" Starts this worker's writer thread, if it isn't running. Called as the
+    worker starts (see warmup.py) if write-behind mode is on, and by the
+    first submission if it comes in before then. """
+def start():
+    global _flusher
+    with _start_lock:
+        journal()
+        if _flusher is None:
+            _stopping.clear()
+            _flusher        = threading.Thread(target = run)
+            _flusher.daemon = True
+            _flusher.start()
+            atexit.register(flush)
+
+
+""" Stops this worker's writer thread (the tests use this). Anything still
+    queued stays queued, and in the journal. """
+def stop():
+    global _flusher
+    with _start_lock:
+        if _flusher is not None:
+            _stopping.set()
+            _flusher.join()
+            _flusher = None
+
+
+def run():
+    while not _stopping.wait(settings.WRITE_BEHIND_INTERVAL):
+        try:
+            flush()
+        except Exception:
+            logger.exception("Writing queued submissions failed; trying again.")
@@ -1,5 +1,47 @@
 
 from experiment.builds import build_all
+from django.conf       import settings
+from django.core.cache import cache
+from django.db         import connection
+import os
+import shutil
 
 def restart():
+    # Whatever's cached belongs to the old database.
+    cache.clear()
     build_all.build_all()
+
+
+# Snapshots of the whole database, for starting load tests and benchmarks
+# from exactly the same data every time (see experiment/builds/generate.py):
+#
+#     generate(100000); snapshot("100k")
+#     ... run the benchmark ...
+#     restore("100k")
+#
+# These only work for SQLite, where the database is a single file; a snapshot
+# is just a copy of it, kept next to it in a 'snapshots' directory. Stop the
+# server before restoring: any process with the database open keeps reading
+# the old file.
+def snapshot_path(name):
+    database = settings.DATABASES["default"]
+    if database["ENGINE"] != "django.db.backends.sqlite3" or database["NAME"] == ":memory:":
+        raise ValueError("Snapshots only work with an SQLite database file.")
+    directory = os.path.join(os.path.dirname(database["NAME"]), "snapshots")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return database["NAME"], os.path.join(directory, name + ".db")
+
+def snapshot(name):
+    database, path = snapshot_path(name)
+    connection.close()
+    shutil.copyfile(database, path)
+
+# The snapshot is copied next to the database first and then renamed over
+# it, so that nobody ever sees half a database.
+def restore(name):
+    database, path = snapshot_path(name)
+    connection.close()
+    shutil.copyfile(path, database + ".restoring")
+    os.rename(database + ".restoring", database)
+    cache.clear()
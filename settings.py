@@ -1,4 +1,6 @@
 # Django settings for feed_the_dog project.
+import os
+import sys
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -9,17 +11,131 @@ ADMINS = (
 
 MANAGERS = ADMINS
 
-DATABASES = {
+# The database. By default that's SQLite, in a file next to this one, which
+# is all a single room needs. The file isn't kept in git: make it with
+# 'python manage.py syncdb', then restart_database.restart() from
+# 'python manage.py shell' to add the administrator. There are no
+# migrations, so whenever experiment/models.py changes, an existing database
+# has to be made again the same way (archive any study worth keeping first;
+# see experiment/archive.py).
+#
+# For several rooms at once, give each room a shard (below). PostgreSQL is
+# experimental: nobody has run the load test (experiment/loadtest.py)
+# against it yet, so don't run a session on it until somebody has, and
+# compared the numbers with SQLite's. To try it, set
+# FEED_THE_DOG_DATABASE=postgresql in the environment (along with
+# FEED_THE_DOG_DB_NAME, _USER, _PASSWORD, _HOST and _PORT if the defaults
+# don't do), install psycopg2, and run 'python manage.py syncdb'.
+# CONNECTION_MAX_AGE is how long (in seconds) a worker thread holds on to its
+# database connection between requests (see experiment/pooling.py); 0 closes
+# it after every request.
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if os.environ.get('FEED_THE_DOG_DATABASE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE':   'django.db.backends.postgresql_psycopg2',
+            'NAME':     os.environ.get('FEED_THE_DOG_DB_NAME',     'feed_the_dog'),
+            'USER':     os.environ.get('FEED_THE_DOG_DB_USER',     ''),
+            'PASSWORD': os.environ.get('FEED_THE_DOG_DB_PASSWORD', ''),
+            'HOST':     os.environ.get('FEED_THE_DOG_DB_HOST',     ''),
+            'PORT':     os.environ.get('FEED_THE_DOG_DB_PORT',     ''),
+        }
+    }
+    CONNECTION_MAX_AGE = 10 * 60
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
+            'NAME': os.path.join(PROJECT_DIR, 'feed_the_dog.db'),         # Or path to database file if using sqlite3.
+            'USER': '',                      # Not used with sqlite3.
+            'PASSWORD': '',                  # Not used with sqlite3.
+            'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
+            'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        }
+    }
+    CONNECTION_MAX_AGE = 0
+
+# The cache that all of the worker processes share (see
+# experiment/caching.py): a memcached on this machine (install memcached, and
+# python-memcached for Django to talk to it), with room for 256 MB or so.
+# Django's directory-of-files cache looks like it would do without one, but
+# every set on it walks the whole directory, so it gets slower than the
+# database as it fills up; it's only good for trying things out.
+#
+# Nothing that has to last relies on the cache. Things that must only
+# happen once (submitting a form, using a login link) are claimed in the
+# database (see experiment/models.py, Claim), and in write-behind mode
+# (below) a submission that's yet to be written is in the journal, which is
+# read back whenever the cache has forgotten a user.
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
-        'NAME': '/Users/Leonard/Downloads/cgu/feed_the_dog/feed_the_dog.db',                      # Or path to database file if using sqlite3.
-        'USER': '',                      # Not used with sqlite3.
-        'PASSWORD': '',                  # Not used with sqlite3.
-        'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
-        'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        'BACKEND':  'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'TIMEOUT':  60 * 60,
     }
 }
 
+# The tests get a cache of their own, in memory, so that running them on a
+# machine that's serving a session never touches the workers' cache.
+if sys.argv[1:2] == ['test']:
+    CACHES = {
+        'default': {
+            'BACKEND':  'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'feed_the_dog_tests',
+            'TIMEOUT':  60 * 60,
+            'OPTIONS':  {'MAX_ENTRIES': 100000},
+        }
+    }
+
+# Lab rooms that run at the same time can each have a database of their own
+# (see experiment/sharding.py): list the rooms' shards here, e.g.
+# ['room1', 'room2', 'room3']. Each is an SQLite file in SHARD_DIR.
+SHARDS           = []
+SHARD_DIR        = os.path.join(PROJECT_DIR, 'shards')
+DATABASE_ROUTERS = ['experiment.routers.ShardRouter']
+
+# How long login links (see experiment/links.py) work for, in hours, unless
+# they're made with hours of their own.
+LOGIN_LINK_HOURS = 12
+
+# Where finished studies are archived, one SQLite file per study (see
+# experiment/archive.py).
+ARCHIVE_DIR = os.path.join(PROJECT_DIR, 'archive')
+
+# Write-behind mode (see experiment/writebehind.py). Submissions are written
+# to a journal in WRITE_BEHIND_JOURNAL and to the database in batches, every
+# WRITE_BEHIND_INTERVAL seconds, rather than one by one as they come in. The
+# journal has to survive a reboot, so keep it out of the temporary directory.
+WRITE_BEHIND          = False
+WRITE_BEHIND_JOURNAL  = os.path.join(PROJECT_DIR, 'journal')
+WRITE_BEHIND_INTERVAL = 0.005
+
+# Work that can wait until after a participant sees their next page (see
+# experiment/tasks.py) is queued in the database and done by a thread in one
+# worker -- whichever holds the lock on TASK_LOCK -- which checks the queue
+# every TASK_INTERVAL seconds. Done tasks, and claims, are deleted once
+# they're PURGE_AFTER_HOURS old.
+TASK_RUNNER           = True
+TASK_INTERVAL         = 0.5
+TASK_LOCK             = os.path.join(PROJECT_DIR, 'tasks.lock')
+PURGE_AFTER_HOURS     = 48
+
+# How many submissions each worker process lets at the database at once
+# (see experiment/admission.py); the rest queue, for up to ADMISSION_TIMEOUT
+# seconds. 0 lets everybody straight in.
+ADMISSION_LIMIT       = 2
+ADMISSION_TIMEOUT     = 15
+
+# Every MEMORY_INTERVAL seconds, each worker logs how much memory it's using
+# and what grew (see experiment/memory.py); 0 turns this off. Set
+# MEMORY_LIMIT (in MB) to the workers' memory limit to be warned before they
+# reach it, and MEMORY_TRACE to see which lines allocate the most (this
+# needs the pytracemalloc backport, and slows the worker down).
+MEMORY_INTERVAL       = 5 * 60
+MEMORY_LIMIT          = None
+MEMORY_TRACE          = False
+
 # This is needed to provide a profile for each user, so that we can
 # store more than just the username and password.
 AUTH_PROFILE_MODULE = 'experiment.UserProfile'
@@ -95,10 +211,19 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+# Outside of debugging, keep every template compiled once it's been loaded
+# (each worker compiles all of them as it starts; see experiment/warmup.py).
+# While debugging we'd rather see our changes without restarting.
+if not DEBUG:
+    TEMPLATE_LOADERS = (('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),)
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'experiment.sharding.ShardMiddleware',
+    'experiment.admission.AdmissionMiddleware',
+    'experiment.memory.MemoryMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -148,6 +273,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -156,5 +285,21 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'experiment.memory': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'experiment.warmup': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'experiment.writebehind': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'experiment.tasks': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     }
 }
@@ -8,6 +8,7 @@ views = "experiment.views."
 
 urlpatterns = patterns('',
     (r'^$',                 views + 'login_user'),
+    (r'^login/(?P<token>[0-9]+-[0-9a-z]+-[0-9a-f]+)/$', views + 'login_link'),
     (r'^logout/$',          views + 'logout_user'),
     (r'^consent/$',         views + 'consent'),
     (r'^instructions/$',    views + 'instructions'),
@@ -17,6 +18,12 @@ urlpatterns = patterns('',
     (r'^experiment/$',      views + 'experiment'),
     (r'^diagnostics/',      views + 'diagnostics'),
     (r'^payment/',          views + 'payment'),
+    (r'^dashboard/$',       views + 'dashboard'),
+    (r'^dashboard/progress/$', views + 'progress'),
+    (r'^dashboard/tasks/$',    views + 'task_status'),
+    (r'^dashboard/admission/$', views + 'admission_status'),
+    (r'^dashboard/memory/$',    views + 'memory_status'),
+    (r'^ready/$',           views + 'ready'),
 )
 
 urlpatterns += staticfiles_urlpatterns()
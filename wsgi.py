@@ -28,6 +28,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "feed_the_dog.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Start the worker's background threads (the task runner and so on), then get
+# it ready before it's handed any participants. The warming up happens in the
+# background; /ready/ says when it's done (see experiment/warmup.py).
+from experiment import warmup
+warmup.start_services()
+warmup.start()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)